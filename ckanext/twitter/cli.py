@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+
+import click
+from ckan import model
+from ckan.lib import jobs as ckan_jobs
+from ckan.plugins import toolkit
+
+from ckanext.twitter.lib import (
+    cache_helpers,
+    config_helpers,
+    digest,
+    helpers as twitter_helpers,
+    jobs,
+    parsers as twitter_parsers,
+    scheduler,
+    stores,
+    twitter_api,
+)
+
+
+def get_commands():
+    return [twitter]
+
+
+@click.group()
+def twitter():
+    """
+    Generate and post tweets and manage the tweet queues and caches.
+    """
+    pass
+
+
+class Timings:
+    """
+    Records how long each stage of a command takes, for the --timings option.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage] = self.stages.get(stage, 0) + time.perf_counter() - start
+
+    def report(self):
+        for stage, seconds in self.stages.items():
+            click.echo(f'{stage}: {seconds:.3f}s', err=True)
+
+
+def _context():
+    user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+    return {'user': user['name'], 'ignore_auth': True}
+
+
+def _find_packages(context, query, pkg_ids, limit):
+    """
+    Gets the IDs of the packages given by ID or matching a search query.
+
+    :param context: The current context.
+    :param query: A solr query, or None.
+    :param pkg_ids: A list of package IDs or names.
+    :param limit: The maximum number of packages to return from the search (or None).
+    :return: list of package IDs
+    """
+    found = []
+    for pkg_id in pkg_ids:
+        package = model.Package.get(pkg_id)
+        if package is None:
+            click.echo(f'Package not found: {pkg_id}', err=True)
+        else:
+            found.append(package.id)
+    if query is None:
+        return found
+
+    rows = 1000 if limit is None else min(limit, 1000)
+    results = []
+    while limit is None or len(results) < limit:
+        result = toolkit.get_action('package_search')(
+            dict(context),
+            {
+                'q': query,
+                'fl': 'id',
+                'rows': rows,
+                'start': len(results),
+                'sort': 'id asc',
+            },
+        )
+        results.extend(pkg['id'] for pkg in result['results'])
+        if not result['results'] or len(results) >= result['count']:
+            break
+    return found + (results[:limit] if limit is not None else results)
+
+
+def _is_new(context, pkg_ids, new):
+    if new is not None:
+        return new
+    return {
+        pkg_id: twitter_helpers.package_is_new(dict(context), pkg_id)
+        for pkg_id in pkg_ids
+    }
+
+
+package_options = [
+    click.argument('query', required=False),
+    click.option(
+        '--id', 'pkg_ids', multiple=True, help='A package ID or name (repeatable).'
+    ),
+    click.option('--limit', type=int, help='The maximum number of search results.'),
+    click.option(
+        '--new/--updated',
+        default=None,
+        help='Use the new or updated template for every package (by default this is '
+        'worked out for each package).',
+    ),
+    click.option(
+        '--chunk-size',
+        type=int,
+        default=100,
+        show_default=True,
+        help='The number of packages to generate tweets for at once.',
+    ),
+    click.option('--timings', is_flag=True, help='Report how long each stage took.'),
+]
+
+
+def with_package_options(command):
+    for option in reversed(package_options):
+        command = option(command)
+    return command
+
+
+@twitter.command()
+@with_package_options
+def preview(query, pkg_ids, limit, new, chunk_size, timings):
+    """
+    Generates the tweets for the packages matching QUERY (or given with --id) without
+    posting them.
+    """
+    timer = Timings()
+    context = _context()
+    with timer.time('search'):
+        found = _find_packages(context, query, list(pkg_ids), limit)
+    with timer.time('is new'):
+        is_new = _is_new(context, found, new)
+    with timer.time('generate'):
+        for pkg_id, text in twitter_parsers.generate_tweets(
+            context, found, is_new, chunk_size
+        ):
+            click.echo(f'{pkg_id}\t{text if text is not None else "(no tweet)"}')
+    if timings:
+        timer.report()
+
+
+@twitter.command()
+@with_package_options
+@click.option(
+    '--enqueue',
+    is_flag=True,
+    help='Add the tweets to the background job queue instead of posting them.',
+)
+@click.option(
+    '--concurrency',
+    type=int,
+    default=1,
+    show_default=True,
+    help='The number of tweets to post at once.',
+)
+@click.option(
+    '--rate',
+    type=float,
+    help='The maximum number of tweets to post (or queue) per minute.',
+)
+@click.option('--dry-run', is_flag=True, help="Don't post anything.")
+def post(
+    query,
+    pkg_ids,
+    limit,
+    new,
+    chunk_size,
+    timings,
+    enqueue,
+    concurrency,
+    rate,
+    dry_run,
+):
+    """
+    Posts tweets about the packages matching QUERY (or given with --id). Packages
+    still in their rest period are skipped. Tweets posted this way have the lowest
+    priority if they have to be held because of the rate limit.
+    """
+    timer = Timings()
+    context = _context()
+    with timer.time('search'):
+        found = _find_packages(context, query, list(pkg_ids), limit)
+    with timer.time('rest period'):
+        eligible = cache_helpers.eligible(found)
+    skipped = len(found) - len(eligible)
+    found = [pkg_id for pkg_id in found if pkg_id in eligible]
+    with timer.time('is new'):
+        is_new = _is_new(context, found, new)
+
+    def send(pkg_id, text):
+        if enqueue:
+            job_id = jobs.enqueue_tweet(text, pkg_id, scheduler.BACKFILL)
+            return False, f'queued ({job_id})'
+        try:
+            return twitter_api.post_tweet(text, pkg_id, scheduler.BACKFILL)
+        finally:
+            # each thread has its own database session
+            model.Session.remove()
+
+    interval = 60 / rate if rate else 0
+    next_send = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        futures = []
+        with timer.time('generate and send'):
+            for pkg_id, text in twitter_parsers.generate_tweets(
+                context, found, is_new, chunk_size
+            ):
+                if text is None:
+                    click.echo(f'{pkg_id}\tskipped (no tweet)')
+                    continue
+                if dry_run:
+                    click.echo(f'{pkg_id}\tdry run\t{text}')
+                    continue
+                if interval:
+                    delay = next_send - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    next_send = max(next_send, time.monotonic()) + interval
+                futures.append((pkg_id, text, executor.submit(send, pkg_id, text)))
+        with timer.time('wait'):
+            for pkg_id, text, future in futures:
+                posted, reason = future.result()
+                click.echo(f'{pkg_id}\t{reason}\t{text}')
+
+    if skipped:
+        click.echo(f'{skipped} package(s) skipped (insufficient rest period)', err=True)
+    if timings:
+        timer.report()
+
+
+@twitter.command()
+@click.option('--list', 'list_only', is_flag=True, help="Only list the held posts.")
+def drain(list_only):
+    """
+    Posts the tweets held because the rate limit was reached, as far as the rate limit
+    (shared with the web processes) allows. Anything that can't be posted yet stays
+    held.
+    """
+    if list_only:
+        for held in scheduler.held():
+            held_at = datetime.fromtimestamp(held['held_at']).isoformat()
+            click.echo(f'{held["priority"]}\t{held_at}\t{held["tweet"]}')
+        return
+    wait = scheduler.rate_limit.wait_time()
+    if wait:
+        click.echo(f'Rate limited for another {wait:.0f}s', err=True)
+    for text, posted, reason in scheduler.drain():
+        click.echo(f'{reason}\t{text}')
+    still_held = len(scheduler.held())
+    if still_held:
+        click.echo(f'{still_held} post(s) still held', err=True)
+
+
+@twitter.command('flush-digest')
+def flush_digest():
+    """
+    Posts the digest tweets for the updates collected so far, whether the digest
+    window has passed or not.
+    """
+    for text, posted, reason in digest.flush():
+        click.echo(f'{reason}\t{text}')
+
+
+@twitter.command()
+@click.argument('queues', nargs=-1)
+@click.option('--burst', is_flag=True, help='Stop once the queues are empty.')
+def worker(queues, burst):
+    """
+    Starts a background job worker for QUEUES (by default, the queue tweets are added
+    to) that also runs delayed jobs, like the one that posts each digest once its
+    window has passed.
+    """
+    queues = list(queues) or [config_helpers.twitter_queue()]
+    ckan_jobs.Worker(queues).work(burst=burst, with_scheduler=True)
+
+
+@twitter.command()
+def initdb():
+    """
+    Creates the database table used by the database store (ckanext.twitter.store =
+    database). Existing tables are left alone.
+    """
+    stores.create_tables()
+    click.echo('Created the ckanext-twitter tables')
+
+
+@twitter.group()
+def cache():
+    """
+    Inspect and purge the record of when each package was last tweeted about.
+    """
+    pass
+
+
+def _shared_store():
+    """
+    Gets the rest period store, refusing to go on if it's only held in memory, as then
+    this command would only see (and change) its own empty copy rather than the one in
+    each web process.
+
+    :return: RestPeriodStore
+    """
+    store = stores.get_store()
+    if store.process_local:
+        raise click.ClickException(
+            f'The {config_helpers.twitter_store()} store is only held by each web '
+            f'process, so it can\'t be inspected or purged from the command line; set '
+            f'ckanext.twitter.store to file, redis or database to use this command'
+        )
+    return store
+
+
+@cache.command('show')
+@click.argument('pkg_ids', nargs=-1, required=True)
+def cache_show(pkg_ids):
+    """
+    Shows when each of the given packages was last tweeted about and whether it can be
+    tweeted about now.
+    """
+    store = _shared_store()
+    eligible = cache_helpers.eligible(pkg_ids)
+    for pkg_id in pkg_ids:
+        last_tweeted = store.get(pkg_id)
+        when = (
+            datetime.fromtimestamp(last_tweeted).isoformat()
+            if last_tweeted is not None
+            else 'never'
+        )
+        status = 'eligible' if pkg_id in eligible else 'resting'
+        click.echo(f'{pkg_id}\t{when}\t{status}')
+
+
+@cache.command('purge')
+@click.argument('pkg_ids', nargs=-1)
+@click.option('--all', 'purge_all', is_flag=True, help='Purge every package.')
+def cache_purge(pkg_ids, purge_all):
+    """
+    Forgets when the given packages (or, with --all, every package) were last tweeted
+    about, so they can be tweeted about again straight away. Purging everything also
+    clears the cached record counts.
+    """
+    _shared_store()
+    if purge_all:
+        cache_helpers.reset_cache()
+        click.echo('Purged all packages')
+        return
+    if not pkg_ids:
+        raise click.UsageError('Give some package IDs or --all')
+    for pkg_id in pkg_ids:
+        cache_helpers.remove_from_cache(pkg_id)
+    click.echo(f'Purged {len(pkg_ids)} package(s)')
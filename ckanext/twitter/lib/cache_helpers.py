@@ -4,57 +4,264 @@
 # This file is part of ckanext-twitter
 # Created by the Natural History Museum in London, UK
 
-from datetime import datetime as dt
+import json
+import time
 
-from beaker.cache import CacheManager, cache_managers
+import flask
+from beaker.cache import CacheManager
 from beaker.util import parse_cache_config_options
-from ckanext.twitter.lib import config_helpers
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins import toolkit
+from ckanext.twitter.lib import config_helpers, metrics, prompts, stores
 
-cache_opts = {'cache.type': 'memory', 'cache.lock_dir': '/tmp/cache/lock'}
 
-cache_manager = CacheManager(**parse_cache_config_options(cache_opts))
-twitter_cache = cache_manager.get_cache('twitter')
+def _rest_period():
+    """
+    Gets the rest period between tweets about the same package.
+
+    :return: the rest period in seconds (float)
+    """
+    return config_helpers.twitter_hours_between_tweets() * 3600
 
 
 def cache(pkg_id):
     """
-    Adds the package id and current time to the 'twitter' cache. Clears any existing
-    entries for the given package id first.
+    Records the current time as the time the package was last tweeted about, replacing
+    any existing entry for the given package id.
 
     :param pkg_id: The package id to store.
     """
-    twitter_cache.remove_value(pkg_id)
-    twitter_cache.put(pkg_id, dt.now())
+    stores.get_store().set(pkg_id, time.time(), _rest_period())
+
+
+def claim(pkg_id):
+    """
+    Atomically checks that the package's rest period is over and, if it is, records the
+    current time as the time it was last tweeted about. Only one of several concurrent
+    callers (in any process sharing the store) can claim a package.
+
+    :param pkg_id: The package id.
+    :return: boolean, True if the package was claimed
+    """
+    return stores.get_store().claim(pkg_id, time.time(), _rest_period())
+
+
+def eligible(pkg_ids):
+    """
+    Finds which of the given packages are outside their rest period, i.e. could be
+    tweeted about now. All the packages are checked in a single lookup, so this is much
+    quicker than calling expired for each one.
+
+    :param pkg_ids: An iterable of package IDs.
+    :return: set of package IDs
+    """
+    return stores.get_store().eligible(pkg_ids, time.time(), _rest_period())
 
 
 def reset_cache():
     """
-    Clears everything from the 'twitter' cache.
+    Clears everything from the rest period store and the record count cache.
     """
-    twitter_cache.clear()
-    for k, c in cache_managers.items():
-        c.clear()
+    stores.get_store().clear()
+    _record_counts().clear()
 
 
 def remove_from_cache(pkg_id):
     """
-    Remove the package id from the cache.
+    Remove the package id from the rest period store.
 
     :param pkg_id:
     """
-    twitter_cache.remove_value(pkg_id)
+    stores.get_store().remove(pkg_id)
 
 
 def expired(pkg_id):
     """
-    Checks to see if the cache entry for the package's last tweet (if any) is old enough
-    to be overwritten.
+    Checks to see if the entry for the package's last tweet (if any) is old enough to
+    be overwritten.
 
     :param pkg_id: The package ID.
     :return: boolean
     """
-    if not twitter_cache.has_key(pkg_id):
+    last_posted = stores.get_store().get(pkg_id)
+    if last_posted is None:
         return True
-    last_posted = twitter_cache.get(pkg_id)
-    hours_since = (dt.now() - last_posted).seconds / 3600
+    hours_since = (time.time() - last_posted) / 3600
     return hours_since > config_helpers.twitter_hours_between_tweets()
+
+
+def _request_packages():
+    """
+    Retrieves the package cache for the current request, creating it if necessary.
+    Outside of a request there is nothing to scope the cache to, so None is returned.
+
+    :return: dict or None
+    """
+    if not flask.has_request_context():
+        return None
+    return flask.g.setdefault('twitter_packages', {})
+
+
+def _package_key(context, pkg_id):
+    # what package_show returns depends on who's asking, so each user has their own
+    # entries
+    return prompts.current_user(context), bool(context.get('ignore_auth')), pkg_id
+
+
+def get_package(context, pkg_id):
+    """
+    Retrieves the package dict via package_show, reusing any copy already fetched for
+    the same user during the current request. This means the suitability check, the
+    tweet generation and the record count share a single package_show call. Each call
+    gets its own shallow copy of the dict, so callers can set its keys without affecting
+    others. The nested values (e.g. resources and extras) are shared, so a caller that
+    changes them must copy them first.
+
+    :param context: The current context.
+    :param pkg_id: The package ID (or name).
+    :return: dict
+    """
+    packages = _request_packages()
+    key = _package_key(context, pkg_id) if packages is not None else None
+    if key is not None and key in packages:
+        metrics.incr('package_cache.hit')
+        return dict(packages[key])
+    metrics.incr('package_cache.miss')
+    metrics.incr('actions.package_show')
+    package = toolkit.get_action('package_show')(context, {'id': pkg_id})
+    if packages is not None:
+        for name in {pkg_id, package['id'], package.get('name')}:
+            packages[key[:2] + (name,)] = package
+        package = dict(package)
+    return package
+
+
+def forget_package(pkg_id):
+    """
+    Removes the package from the current request's package cache (if present), for
+    every user, e.g. because it has just been updated.
+
+    :param pkg_id: The package ID (or name).
+    """
+    packages = _request_packages()
+    if not packages:
+        return
+    names = {pkg_id}
+    for key, package in packages.items():
+        if key[2] == pkg_id:
+            names.update({package['id'], package.get('name')})
+    for key in [key for key in packages if key[2] in names]:
+        del packages[key]
+
+
+_record_count_cache = None
+
+
+def configure_record_counts():
+    """
+    Discards the record count cache so that it's created again from the current config
+    on next use.
+    """
+    global _record_count_cache
+    _record_count_cache = None
+
+
+def _record_counts():
+    """
+    Gets the record count cache, creating it from the config on first use.
+
+    :return: beaker.cache.Cache
+    """
+    global _record_count_cache
+    if _record_count_cache is None:
+        options = parse_cache_config_options(
+            config_helpers.twitter_count_cache_options()
+        )
+        _record_count_cache = CacheManager(**options).get_cache('twitter_counts')
+    return _record_count_cache
+
+
+def _resource_version(resource):
+    """
+    Gets a value that changes whenever the resource is modified.
+
+    :param resource: The resource dict.
+    :return: str
+    """
+    return resource.get('last_modified') or resource.get('metadata_modified')
+
+
+def get_record_count(resource):
+    """
+    Retrieves the cached number of datastore records in the resource. Counts cached
+    before the resource was last modified are ignored.
+
+    :param resource: The resource dict.
+    :return: int, or None if there isn't a usable cached count
+    """
+    try:
+        version, count = _record_counts().get(resource['id'])
+    except KeyError:
+        return None
+    return count if version == _resource_version(resource) else None
+
+
+def set_record_count(resource, count):
+    """
+    Caches the number of datastore records in the resource.
+
+    :param resource: The resource dict.
+    :param count: The number of records.
+    """
+    _record_counts().put(resource['id'], (_resource_version(resource), count))
+
+
+def forget_record_count(resource_id):
+    """
+    Removes the cached record count for the resource, e.g. because its datastore table
+    has been written to.
+
+    :param resource_id: The resource ID.
+    """
+    _record_counts().remove_value(resource_id)
+
+
+precomputed_key_prefix = 'ckanext-twitter:tweet:'
+
+
+def get_precomputed_tweet(pkg_id, version):
+    """
+    Retrieves the tweet text generated for the package by a background job. Text that
+    was generated for a different version of the package is ignored.
+
+    :param pkg_id: The package ID.
+    :param version: The current version of the package's tweet (see
+                    helpers.tweet_version).
+    :return: dict with the tweet and is_new, or None
+    """
+    if not config_helpers.twitter_precompute():
+        # nothing will have been precomputed, so don't go to redis on every preview
+        return None
+    value = connect_to_redis().get(f'{precomputed_key_prefix}{pkg_id}')
+    if value is None:
+        return None
+    precomputed = json.loads(value)
+    return precomputed if precomputed['version'] == version else None
+
+
+def set_precomputed_tweet(pkg_id, version, tweet_text, is_new):
+    """
+    Stores the tweet text generated for the package so that it can be shown without
+    being generated again.
+
+    :param pkg_id: The package ID.
+    :param version: The version of the package's tweet the text was generated for.
+    :param tweet_text: The generated text.
+    :param is_new: Whether the package was considered new.
+    """
+    value = json.dumps({'version': version, 'tweet': tweet_text, 'is_new': is_new})
+    connect_to_redis().set(
+        f'{precomputed_key_prefix}{pkg_id}',
+        value,
+        ex=config_helpers.twitter_precompute_ttl(),
+    )
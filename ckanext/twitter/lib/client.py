@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+import oauth2
+import urllib3
+from urllib3.util import Retry, Timeout
+
+
+class TwitterClient:
+    """
+    A client for the twitter API that signs requests with the OAuth credentials and
+    sends them over a pool of keep-alive connections. The connection pool is
+    thread-safe, so a single client can be shared by all of a process's threads.
+    """
+
+    def __init__(
+        self,
+        consumer_key,
+        consumer_secret,
+        token_key,
+        token_secret,
+        connect_timeout=5.0,
+        read_timeout=10.0,
+        retries=2,
+        backoff_factor=0.5,
+        pool_size=4,
+    ):
+        """
+        :param consumer_key: The twitter consumer key.
+        :param consumer_secret: The twitter consumer secret.
+        :param token_key: The twitter token key.
+        :param token_secret: The twitter token secret.
+        :param connect_timeout: Seconds to wait for a connection to be made.
+        :param read_timeout: Seconds to wait for a response once connected.
+        :param retries: The maximum number of times to retry a request that failed
+                        because of a connection error or a server error. Posts are
+                        only retried if they couldn't be sent at all.
+        :param backoff_factor: Scales the (exponentially increasing) delay between
+                               retries.
+        :param pool_size: The number of connections to keep open to each host.
+        """
+        self.consumer = oauth2.Consumer(consumer_key, consumer_secret)
+        self.token = oauth2.Token(token_key, token_secret)
+        self.pool = urllib3.PoolManager(
+            maxsize=pool_size,
+            timeout=Timeout(connect=connect_timeout, read=read_timeout),
+            retries=Retry(
+                total=retries,
+                backoff_factor=backoff_factor,
+                status_forcelist=(500, 502, 503, 504),
+                raise_on_status=False,
+            ),
+        )
+
+    def request(self, url, method='GET', parameters=None):
+        """
+        Signs and sends a request.
+
+        :param url: The full URL of the API endpoint.
+        :param method: The HTTP method.
+        :param parameters: A dict of parameters to send with the request. These are sent
+                           form encoded in the body of POST requests, and in the query
+                           string otherwise.
+        :return: the response (which has status, reason and headers attributes) and the
+                 content of the response
+        """
+        is_post = method == 'POST'
+        oauth_request = oauth2.Request.from_consumer_and_token(
+            self.consumer,
+            token=self.token,
+            http_method=method,
+            http_url=url,
+            parameters=parameters,
+            is_form_encoded=is_post,
+        )
+        oauth_request.sign_request(
+            oauth2.SignatureMethod_HMAC_SHA1(), self.consumer, self.token
+        )
+        if is_post:
+            response = self.pool.request(
+                method,
+                url,
+                body=oauth_request.to_postdata().encode('utf-8'),
+                headers={'Content-Type': 'application/x-www-form-urlencoded'},
+            )
+        else:
+            response = self.pool.request(method, oauth_request.to_url())
+        return response, response.data
+
+    def close(self):
+        """
+        Closes all the pooled connections.
+        """
+        self.pool.clear()
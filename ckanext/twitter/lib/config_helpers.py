@@ -4,8 +4,341 @@
 # This file is part of ckanext-twitter
 # Created by the Natural History Museum in London, UK
 
+from collections import namedtuple
+from types import MappingProxyType
+
+import jinja2
 from ckan.plugins import toolkit
 
+# every option, parsed and checked; the getters below read from a single instance of
+# this which is built when the plugin is configured, rather than parsing the config
+# each time they're called
+TwitterConfig = namedtuple(
+    'TwitterConfig',
+    [
+        'credentials',
+        'debug',
+        'hours_between_tweets',
+        'tweet_limit',
+        'new_format',
+        'updated_format',
+        'disable_edit',
+        'count_workers',
+        'count_timeout',
+        'count_sql',
+        'count_estimate_threshold',
+        'count_cache_options',
+        'sandbox',
+        'post_async',
+        'queue',
+        'auth_ttl',
+        'api_url',
+        'http_options',
+        'store',
+        'store_path',
+        'skip_non_interactive',
+        'digest',
+        'digest_window',
+        'digest_format',
+        'rate_limit_window',
+        'deferred',
+        'precompute',
+        'precompute_ttl',
+        'metrics',
+        'statsd_address',
+        'metrics_prefix',
+        'metrics_summary',
+        'prompt_store',
+        'prompt_ttl',
+        'dedupe',
+        'dedupe_lease',
+    ],
+)
+
+default_new_format = (
+    'New dataset: "{{ title }}" by {{ author }} ({'
+    '%- if records != 0 -%} {{ records }} records {'
+    '%- else -%} {{ resources }} resource {%- endif '
+    '-%}).'
+)
+default_updated_format = (
+    'Updated dataset: "{{ title }}" by {{ author }} '
+    '({%- if records != 0 -%} {{ records }} records '
+    '{%- elif resources == 1 -%} {{ resources }} '
+    'resource {%- else -%} {{ resources }} '
+    'resources {%- endif -%}).'
+)
+default_digest_format = (
+    '{{ count }} dataset{{ "s" if count != 1 }} updated in {{ organization }}.'
+)
+
+
+def _optional(parse):
+    def parse_optional(value):
+        return parse(value) if value not in (None, '') else None
+
+    return parse_optional
+
+
+def _template(value):
+    # only checks the syntax; the variables are filled in when the tweet is generated
+    jinja2.Environment().parse(value)
+    return value
+
+
+def _address(value):
+    host, _, port = value.rpartition(':')
+    return host, int(port)
+
+
+def _option(config, key, default, parse=None, check=None):
+    """
+    Gets an option from the config, parsing and checking it.
+
+    :param config: The CKAN config.
+    :param key: The option's name.
+    :param default: The value to use if the option isn't set.
+    :param parse: A function that converts the raw value, raising a ValueError or
+                  TypeError if it can't.
+    :param check: A function that returns False if the parsed value isn't allowed.
+    :return: the parsed value
+    """
+    value = config.get(key, default)
+    try:
+        parsed = parse(value) if parse is not None else value
+    except (TypeError, ValueError, jinja2.TemplateSyntaxError) as e:
+        raise ValueError(f'Invalid value for {key}: {value!r} ({e})')
+    if check is not None and not check(parsed):
+        raise ValueError(f'Invalid value for {key}: {value!r}')
+    return parsed
+
+
+def _positive(value):
+    return value is None or value > 0
+
+
+def _not_negative(value):
+    return value is None or value >= 0
+
+
+def _one_of(*choices):
+    return lambda value: value in choices
+
+
+def load_config(config=None):
+    """
+    Reads every ckanext.twitter option from the config, parsing and checking them all
+    so that a bad value is reported straight away instead of when it's first used.
+
+    :param config: The CKAN config; defaults to toolkit.config.
+    :return: TwitterConfig
+    """
+    if config is None:
+        config = toolkit.config
+    prefix = 'ckanext.twitter.count_cache.'
+    # counts cached in one process aren't cleared by datastore writes handled by
+    # another, so they expire after a few minutes unless a shared type is used instead
+    count_cache_options = {
+        'cache.type': 'memory',
+        'cache.lock_dir': '/tmp/cache/lock',
+        'cache.expire': 300,
+    }
+    for key, value in config.items():
+        if key.startswith(prefix):
+            count_cache_options[f'cache.{key[len(prefix):]}'] = value
+
+    return TwitterConfig(
+        credentials=(
+            config.get('ckanext.twitter.consumer_key', 'no-consumer-key-set'),
+            config.get('ckanext.twitter.consumer_secret', 'no-consumer-secret-set'),
+            config.get('ckanext.twitter.token_key', 'no-token-key-set'),
+            config.get('ckanext.twitter.token_secret', 'no-token-secret-set'),
+        ),
+        # the plugin-specific flag can override the global debug flag
+        debug=_option(
+            config,
+            'ckanext.twitter.debug',
+            config.get('debug', False),
+            toolkit.asbool,
+        ),
+        hours_between_tweets=_option(
+            config, 'ckanext.twitter.hours_between_tweets', 24, float, _not_negative
+        ),
+        tweet_limit=_option(
+            config, 'ckanext.twitter.tweet_limit', 280, toolkit.asint, _positive
+        ),
+        new_format=_option(
+            config, 'ckanext.twitter.new', default_new_format, _template
+        ),
+        updated_format=_option(
+            config, 'ckanext.twitter.updated', default_updated_format, _template
+        ),
+        disable_edit=_option(
+            config, 'ckanext.twitter.disable_edit', False, toolkit.asbool
+        ),
+        count_workers=_option(
+            config, 'ckanext.twitter.count_workers', 1, toolkit.asint, _positive
+        ),
+        count_timeout=_option(
+            config,
+            'ckanext.twitter.count_timeout',
+            None,
+            _optional(float),
+            _positive,
+        ),
+        count_sql=_option(config, 'ckanext.twitter.count_sql', False, toolkit.asbool),
+        count_estimate_threshold=_option(
+            config,
+            'ckanext.twitter.count_estimate_threshold',
+            None,
+            _optional(toolkit.asint),
+            _not_negative,
+        ),
+        count_cache_options=MappingProxyType(count_cache_options),
+        sandbox=_option(config, 'ckanext.twitter.sandbox', False, toolkit.asbool),
+        post_async=_option(config, 'ckanext.twitter.async', False, toolkit.asbool),
+        queue=config.get('ckanext.twitter.queue', 'default'),
+        auth_ttl=_option(
+            config, 'ckanext.twitter.auth_ttl', 3600, toolkit.asint, _not_negative
+        ),
+        api_url=config.get(
+            'ckanext.twitter.api_url', 'https://api.twitter.com/1.1'
+        ).rstrip('/'),
+        http_options=MappingProxyType(
+            {
+                'connect_timeout': _option(
+                    config, 'ckanext.twitter.connect_timeout', 5, float, _positive
+                ),
+                'read_timeout': _option(
+                    config, 'ckanext.twitter.read_timeout', 10, float, _positive
+                ),
+                'retries': _option(
+                    config, 'ckanext.twitter.retries', 2, toolkit.asint, _not_negative
+                ),
+                'backoff_factor': _option(
+                    config, 'ckanext.twitter.backoff', 0.5, float, _not_negative
+                ),
+                'pool_size': _option(
+                    config, 'ckanext.twitter.pool_size', 4, toolkit.asint, _positive
+                ),
+            }
+        ),
+        store=_option(
+            config,
+            'ckanext.twitter.store',
+            'memory',
+            check=_one_of('memory', 'file', 'redis', 'database'),
+        ),
+        store_path=config.get(
+            'ckanext.twitter.store_path', '/tmp/ckanext-twitter/last-tweeted.json'
+        ),
+        skip_non_interactive=_option(
+            config, 'ckanext.twitter.skip_non_interactive', False, toolkit.asbool
+        ),
+        digest=_option(config, 'ckanext.twitter.digest', False, toolkit.asbool),
+        digest_window=_option(
+            config,
+            'ckanext.twitter.digest_window',
+            60,
+            lambda value: float(value) * 60,
+            _positive,
+        ),
+        digest_format=_option(
+            config, 'ckanext.twitter.digest_format', default_digest_format, _template
+        ),
+        rate_limit_window=_option(
+            config,
+            'ckanext.twitter.rate_limit_window',
+            15,
+            lambda value: float(value) * 60,
+            _positive,
+        ),
+        deferred=_option(config, 'ckanext.twitter.deferred', False, toolkit.asbool),
+        precompute=_option(
+            config, 'ckanext.twitter.precompute', False, toolkit.asbool
+        ),
+        precompute_ttl=_option(
+            config, 'ckanext.twitter.precompute_ttl', 600, toolkit.asint, _positive
+        ),
+        metrics=_option(
+            config,
+            'ckanext.twitter.metrics',
+            'none',
+            check=_one_of('none', 'logging', 'statsd', 'memory'),
+        ),
+        statsd_address=_option(
+            config, 'ckanext.twitter.statsd', 'localhost:8125', _address
+        ),
+        metrics_prefix=config.get('ckanext.twitter.metrics_prefix', 'ckanext.twitter'),
+        metrics_summary=_option(
+            config, 'ckanext.twitter.metrics_summary', False, toolkit.asbool
+        ),
+        prompt_store=_option(
+            config,
+            'ckanext.twitter.prompt_store',
+            'session',
+            check=_one_of('session', 'memory', 'redis'),
+        ),
+        prompt_ttl=_option(
+            config, 'ckanext.twitter.prompt_ttl', 600, toolkit.asint, _positive
+        ),
+        dedupe=_option(
+            config,
+            'ckanext.twitter.dedupe',
+            'redis',
+            check=_one_of('none', 'memory', 'redis'),
+        ),
+        dedupe_lease=_option(
+            config, 'ckanext.twitter.dedupe_lease', 30, float, _positive
+        ),
+    )
+
+
+_config = None
+
+# functions called (with no arguments) after the config has been reloaded, e.g. to
+# recreate anything built from the old config
+reload_hooks = []
+
+
+def get_config():
+    """
+    Gets the current config, loading it if it hasn't been loaded yet.
+
+    :return: TwitterConfig
+    """
+    if _config is None:
+        return reload_config()
+    return _config
+
+
+def reload_config(config=None):
+    """
+    Loads the config again (e.g. after it has been changed) and then calls each of the
+    reload hooks. If any of the options are invalid, the current config is kept.
+
+    :param config: The CKAN config; defaults to toolkit.config.
+    :return: TwitterConfig
+    """
+    global _config
+    _config = load_config(config)
+    for hook in reload_hooks:
+        hook()
+    return _config
+
+
+def on_reload(hook):
+    """
+    Adds a function to call after the config has been reloaded. Adding the same
+    function again has no effect.
+
+    :param hook: A function that takes no arguments.
+    :return: the function, so this can be used as a decorator
+    """
+    if hook not in reload_hooks:
+        reload_hooks.append(hook)
+    return hook
+
 
 def twitter_get_credentials():
     """
@@ -13,37 +346,36 @@ def twitter_get_credentials():
 
     :return: (key, secret)
     """
-    consumer_key = toolkit.config.get(
-        'ckanext.twitter.consumer_key', 'no-consumer-key-set'
-    )
-    consumer_secret = toolkit.config.get(
-        'ckanext.twitter.consumer_secret', 'no-consumer-secret-set'
-    )
-    token_key = toolkit.config.get('ckanext.twitter.token_key', 'no-token-key-set')
-    token_secret = toolkit.config.get(
-        'ckanext.twitter.token_secret', 'no-token-secret-set'
-    )
-    return consumer_key, consumer_secret, token_key, token_secret
+    return get_config().credentials
 
 
 def twitter_is_debug():
-    '''
+    """
     Checks debug flags in the config - the plugin-specific flag can override
     the global debug flag.
+
     :return: boolean
-    '''
-    return toolkit.config.get(
-        'ckanext.twitter.debug', toolkit.config.get('debug', False)
-    )
+    """
+    return get_config().debug
 
 
 def twitter_hours_between_tweets():
     """
     For calculating the 'rest period' between subsequent tweets about the same dataset.
 
+    :return: float
+    """
+    return get_config().hours_between_tweets
+
+
+def twitter_tweet_limit():
+    """
+    Gets the maximum weighted length of a tweet (see tweet_length), which is 280 on
+    twitter: 280 ASCII characters, or 140 CJK characters.
+
     :return: int
     """
-    return toolkit.config.get('ckanext.twitter.hours_between_tweets', 24)
+    return get_config().tweet_limit
 
 
 def twitter_new_format():
@@ -53,13 +385,7 @@ def twitter_new_format():
 
     :return: string with replaceable jinja2 tags
     """
-    return toolkit.config.get(
-        'ckanext.twitter.new',
-        'New dataset: "{{ title }}" by {{ author }} ({'
-        '%- if records != 0 -%} {{ records }} records {'
-        '%- else -%} {{ resources }} resource {%- endif '
-        '-%}).',
-    )
+    return get_config().new_format
 
 
 def twitter_updated_format():
@@ -68,14 +394,7 @@ def twitter_updated_format():
 
     :return: string with replaceable jinja2 tags
     """
-    return toolkit.config.get(
-        'ckanext.twitter.updated',
-        'Updated dataset: "{{ title }}" by {{ author }} '
-        '({%- if records != 0 -%} {{ records }} records '
-        '{%- elif resources == 1 -%} {{ resources }} '
-        'resource {%- else -%} {{ resources }} '
-        'resources {%- endif -%}).',
-    )
+    return get_config().updated_format
 
 
 def twitter_disable_edit():
@@ -84,6 +403,298 @@ def twitter_disable_edit():
 
     If true, this prevents the
     user editing the tweet before it is posted.
+
+    :return: boolean
+    """
+    return get_config().disable_edit
+
+
+def twitter_count_workers():
+    """
+    The maximum number of threads used to count the records in a package's resources.
+    With the default of 1 the resources are counted one after another.
+
+    :return: int
+    """
+    return get_config().count_workers
+
+
+def twitter_count_timeout():
+    """
+    The number of seconds to wait for the record counts of a package's resources. Any
+    resources not counted by then are counted as 0. No timeout is applied by default.
+
+    :return: float or None
+    """
+    return get_config().count_timeout
+
+
+def twitter_count_sql():
+    """
+    Checks whether the record counts for all of a package's resources should be
+    retrieved in one datastore_search_sql query instead of one query per resource. This
+    requires ckan.datastore.sqlsearch.enabled to be true.
+
+    :return: boolean
+    """
+    return get_config().count_sql
+
+
+def twitter_count_estimate_threshold():
+    """
+    Datastore tables with more records than this are counted using the database's
+    statistics instead of an exact count. Exact counts are always used by default.
+
+    :return: int or None
+    """
+    return get_config().count_estimate_threshold
+
+
+def twitter_count_cache_options():
+    """
+    Gets the beaker options for the record count cache from any config options starting
+    with "ckanext.twitter.count_cache." (e.g. ckanext.twitter.count_cache.type = file).
+    Defaults to a memory cache whose entries expire after 5 minutes.
+
+    :return: dict
+    """
+    return dict(get_config().count_cache_options)
+
+
+def twitter_sandbox():
+    """
+    Checks whether the tweet templates should be rendered in a sandboxed jinja2
+    environment, which is recommended if the templates can be edited by people who
+    shouldn't have access to the server.
+
     :return: boolean
     """
-    return toolkit.config.get('ckanext.twitter.disable_edit', False)
+    return get_config().sandbox
+
+
+def twitter_async():
+    """
+    Checks whether tweets should be posted by a background job worker instead of during
+    the web request.
+
+    :return: boolean
+    """
+    return get_config().post_async
+
+
+def twitter_queue():
+    """
+    Gets the name of the background job queue that tweets are added to.
+
+    :return: str
+    """
+    return get_config().queue
+
+
+def twitter_auth_ttl():
+    """
+    The number of seconds that a successful verification of the credentials is trusted
+    for before they're verified again.
+
+    :return: int
+    """
+    return get_config().auth_ttl
+
+
+def twitter_api_url():
+    """
+    Gets the base URL of the twitter API. This only needs changing to point the
+    extension at a different (e.g. fake) server.
+
+    :return: str
+    """
+    return get_config().api_url
+
+
+def twitter_http_options():
+    """
+    Gets the connection options for the twitter API client: timeouts (in seconds),
+    retries and the number of connections to keep open.
+
+    :return: dict
+    """
+    return dict(get_config().http_options)
+
+
+def twitter_store():
+    """
+    Gets the type of store used to record when each package was last tweeted about:
+    memory (the default), file, redis or database. Only the memory store is limited to
+    a single process.
+
+    :return: str
+    """
+    return get_config().store
+
+
+def twitter_store_path():
+    """
+    Gets the path of the JSON file used by the file store.
+
+    :return: str
+    """
+    return get_config().store_path
+
+
+def twitter_skip_non_interactive():
+    """
+    Checks whether updates made outside the web interface (e.g. through the API or from
+    the command line) should skip the tweet prompt.
+
+    :return: boolean
+    """
+    return get_config().skip_non_interactive
+
+
+def twitter_digest():
+    """
+    Checks whether updates that don't show a tweet prompt (e.g. from harvesters or the
+    API) should be collected into digest tweets.
+
+    :return: boolean
+    """
+    return get_config().digest
+
+
+def twitter_digest_window():
+    """
+    Gets the length of time updates are collected for before a digest is posted.
+
+    :return: the window in seconds (float)
+    """
+    return get_config().digest_window
+
+
+def twitter_digest_format():
+    """
+    Gets the string defining the format of the digest tweets, which are posted for each
+    organisation.
+
+    :return: string with replaceable jinja2 tags (count and organization)
+    """
+    return get_config().digest_format
+
+
+def twitter_rate_limit_window():
+    """
+    Gets how long to hold posts for after the API says the rate limit has been reached
+    (with a 429 response) without saying when it resets.
+
+    :return: the window in seconds (float)
+    """
+    return get_config().rate_limit_window
+
+
+def twitter_deferred():
+    """
+    Checks whether the tweet text should be loaded after the dataset page has rendered
+    (from the preview endpoint) rather than generated while it's rendering.
+
+    :return: boolean
+    """
+    return get_config().deferred
+
+
+def twitter_precompute():
+    """
+    Checks whether the tweet text should be generated by a background job as soon as a
+    package is updated, so that it's ready by the time the dataset page loads.
+
+    :return: boolean
+    """
+    return get_config().precompute
+
+
+def twitter_precompute_ttl():
+    """
+    Gets the number of seconds a precomputed tweet is kept for. It's only needed until
+    the dataset page shown after the save has loaded it.
+
+    :return: int
+    """
+    return get_config().precompute_ttl
+
+
+def twitter_metrics():
+    """
+    Gets where timings and counters should be sent: none (the default), logging,
+    statsd or memory.
+
+    :return: str
+    """
+    return get_config().metrics
+
+
+def twitter_statsd_address():
+    """
+    Gets the address of the StatsD server metrics are sent to.
+
+    :return: host (str), port (int)
+    """
+    return get_config().statsd_address
+
+
+def twitter_metrics_prefix():
+    """
+    Gets the prefix for the names of the metrics sent to StatsD.
+
+    :return: str
+    """
+    return get_config().metrics_prefix
+
+
+def twitter_metrics_summary():
+    """
+    Checks whether a summary of each request's metrics should be logged.
+
+    :return: boolean
+    """
+    return get_config().metrics_summary
+
+
+def twitter_prompt_store():
+    """
+    Gets where to record which packages users should be prompted to tweet about:
+    session (the default), memory or redis. The memory and redis stores avoid reading
+    and writing the user's session.
+
+    :return: str
+    """
+    return get_config().prompt_store
+
+
+def twitter_prompt_ttl():
+    """
+    Gets how long a prompt is kept for (in the memory and redis prompt stores) if the
+    user doesn't load a page that shows it.
+
+    :return: the TTL in seconds (int)
+    """
+    return get_config().prompt_ttl
+
+
+def twitter_dedupe():
+    """
+    Gets where to record the tweets being posted, so that duplicate requests to post
+    the same tweet (e.g. from a double click) only post it once: none, memory or redis
+    (the default). The memory store only works within a single process.
+
+    :return: str
+    """
+    return get_config().dedupe
+
+
+def twitter_dedupe_lease():
+    """
+    Gets how long a request to post a tweet holds its claim (so that duplicate requests
+    are told it's already being posted) and how long the result of a successful post is
+    given to duplicate requests afterwards.
+
+    :return: the lease in seconds (float)
+    """
+    return get_config().dedupe_lease
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+import hashlib
+
+from ckanext.twitter.lib import config_helpers, metrics, stores
+
+key_prefix = 'ckanext-twitter:dedupe:'
+# the value stored while a key has been claimed but doesn't have a result yet
+pending = ''
+# unsuccessful results are only kept long enough for duplicate requests made at the
+# same time (e.g. from a double click) to get them, so that the user can try again
+# straight away
+failure_ttl = 2
+
+
+def create_store(store_type):
+    """
+    Creates the store used to record the tweets being posted (by a key made from the
+    text and the package ID) and the results of posting them. The memory store only
+    detects duplicates within a single process, so a duplicate request handled by
+    another web worker is posted again; use the redis store if there's more than one.
+
+    :param store_type: none, memory or redis.
+    :return: ExpiringStore, or None if duplicates aren't detected
+    """
+    if store_type == 'none':
+        return None
+    if store_type not in ('memory', 'redis'):
+        raise ValueError(f'Unknown ckanext.twitter.dedupe type: {store_type}')
+    return stores.create_expiring_store(store_type, key_prefix)
+
+
+_store = stores.ConfiguredStore(lambda: create_store(config_helpers.twitter_dedupe()))
+
+
+def configure_store():
+    """
+    Creates the dedupe store defined in the config, replacing any existing store.
+
+    :return: ExpiringStore or None
+    """
+    return _store.configure()
+
+
+def get_store():
+    """
+    Gets the configured dedupe store, creating it if it hasn't been configured yet.
+
+    :return: ExpiringStore, or None if duplicates aren't detected
+    """
+    return _store.get()
+
+
+def dedupe_key(text, pkg_id):
+    """
+    Gets the key identifying a request to post the text about the package.
+
+    :param text: The tweet text.
+    :param pkg_id: The package ID, or None.
+    :return: str
+    """
+    return hashlib.sha256(f'{pkg_id}\n{text}'.encode('utf-8')).hexdigest()
+
+
+def _succeeded(result):
+    return bool(result.get('success') or result.get('job_id') or result.get('held'))
+
+
+def run(text, pkg_id, function, store=None):
+    """
+    Calls the function to post the text about the package, unless another request has
+    already done so or is doing so. A duplicate request doesn't wait for the first one
+    to finish: it gets the first request's result if there is one yet, and None if not.
+    A successful result is returned to duplicate requests made within the lease.
+
+    :param text: The tweet text.
+    :param pkg_id: The package ID, or None.
+    :param function: A function that takes no arguments, posts the tweet and returns
+                     a JSON serialisable dict including "success" (and "job_id" if
+                     the tweet was queued).
+    :param store: The dedupe store; defaults to the configured store.
+    :return: the result dict, or None if a duplicate request is still in progress
+    """
+    if store is None:
+        store = get_store()
+    if store is None:
+        return function()
+
+    lease = config_helpers.twitter_dedupe_lease()
+    key = dedupe_key(text, pkg_id)
+    if not store.add(key, pending, lease):
+        result = store.get(key)
+        if result is None or result == pending:
+            metrics.incr('dedupe.in_progress')
+            return None
+        metrics.incr('dedupe.duplicate')
+        return result
+
+    try:
+        result = function()
+    except Exception:
+        store.delete(key)
+        raise
+    ttl = lease if _succeeded(result) else min(lease, failure_ttl)
+    store.set(key, result, ttl)
+    return result
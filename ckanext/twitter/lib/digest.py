@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+import json
+import logging
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from ckan import model
+from ckan.lib.jobs import get_queue
+from ckan.lib.redis import connect_to_redis
+
+from ckanext.twitter.lib import config_helpers, jobs, parsers, scheduler, twitter_api
+
+logger = logging.getLogger('ckanext.twitter')
+
+events_key = 'ckanext-twitter:digest:events'
+started_key = 'ckanext-twitter:digest:started'
+
+
+def record(pkg_dict, connection=None):
+    """
+    Adds an update to the digest buffer. This is all that happens for each update, so
+    it's cheap enough to do for every dataset in a large harvest.
+
+    :param pkg_dict: The updated package's dict (only the id and owner_org are used).
+    :param connection: Optionally, the redis connection to use.
+    :return: the time the window started (float) if this update started a new window,
+             otherwise None
+    """
+    redis = connection or connect_to_redis()
+    event = {'id': pkg_dict['id'], 'owner_org': pkg_dict.get('owner_org')}
+    started = time.time()
+    pipeline = redis.pipeline()
+    pipeline.rpush(events_key, json.dumps(event))
+    # the window starts with the first event
+    pipeline.set(started_key, started, nx=True)
+    _, is_new_window = pipeline.execute()
+    return started if is_new_window else None
+
+
+def enqueue_flush(started):
+    """
+    Adds a job to flush the digest once the window that started at the given time has
+    passed. The job is delayed, so it's only run by a worker that runs RQ's scheduler
+    (e.g. one started with the twitter worker command).
+
+    :param started: The time the window started (from record).
+    :return: the job ID (str)
+    """
+    queue = get_queue(config_helpers.twitter_queue())
+    job = queue.enqueue_in(
+        timedelta(seconds=config_helpers.twitter_digest_window()),
+        flush_job,
+        started,
+        description='Post the ckanext-twitter digest',
+    )
+    logger.debug(f'Queued digest flush as job {job.id}')
+    return job.id
+
+
+def flush_job(started):
+    """
+    Background job that posts the digest for the window that started at the given time.
+    If that window has already been flushed (e.g. from the CLI), nothing happens; any
+    newer window has its own job.
+
+    :param started: The time the window started (from record).
+    :return: list of (tweet text, posted, reason) tuples
+    """
+    current = connect_to_redis().get(started_key)
+    if current is None or float(current) != started:
+        return []
+    return flush(post_now=True)
+
+
+def due(connection=None):
+    """
+    Checks whether the digest window has passed since the first buffered event.
+
+    :param connection: Optionally, the redis connection to use.
+    :return: boolean
+    """
+    redis = connection or connect_to_redis()
+    started = redis.get(started_key)
+    if started is None:
+        return False
+    return time.time() - float(started) >= config_helpers.twitter_digest_window()
+
+
+def drain(connection=None):
+    """
+    Removes and returns all the buffered events. This is atomic, so if several
+    processes drain the buffer at once only one of them will get the events.
+
+    :param connection: Optionally, the redis connection to use.
+    :return: list of event dicts
+    """
+    redis = connection or connect_to_redis()
+    pipeline = redis.pipeline(transaction=True)
+    pipeline.lrange(events_key, 0, -1)
+    pipeline.delete(events_key, started_key)
+    events, _ = pipeline.execute()
+    return [json.loads(event) for event in events]
+
+
+def summarise(events):
+    """
+    Generates the digest tweets for the given events: one for each organisation, with
+    each dataset only counted once however many times it was updated.
+
+    :param events: A list of event dicts (from drain).
+    :return: list of tweet texts
+    """
+    datasets_by_org = OrderedDict()
+    for event in events:
+        datasets_by_org.setdefault(event.get('owner_org'), set()).add(event['id'])
+
+    compiled = parsers.compile_template(
+        config_helpers.twitter_digest_format(), config_helpers.twitter_sandbox()
+    )
+    tweets = []
+    for org_id, pkg_ids in datasets_by_org.items():
+        org = model.Group.get(org_id) if org_id else None
+        organization = (org.title or org.name) if org else 'no organisation'
+        text = compiled.template.render(count=len(pkg_ids), organization=organization)
+        tweets.append(parsers.truncate_tweet(text))
+    return tweets
+
+
+def flush(connection=None, post_now=False):
+    """
+    Drains the buffer and posts a digest tweet for each organisation (or queues them,
+    if tweets are posted asynchronously). Digest tweets aren't about a single package,
+    so they're not subject to the rest period.
+
+    :param connection: Optionally, the redis connection to use.
+    :param post_now: If True, post the tweets even if tweets are usually posted
+                     asynchronously (e.g. because this is already a background job).
+    :return: list of (tweet text, posted, reason) tuples
+    """
+    results = []
+    for text in summarise(drain(connection)):
+        if config_helpers.twitter_async() and not post_now:
+            job_id = jobs.enqueue_tweet(text, None, scheduler.DIGEST)
+            results.append((text, False, f'queued ({job_id})'))
+        else:
+            posted, reason = twitter_api.post_tweet(text, None, scheduler.DIGEST)
+            results.append((text, posted, reason))
+        logger.debug(f'Digest tweet {results[-1][2]}: {text}')
+    return results
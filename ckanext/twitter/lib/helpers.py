@@ -4,9 +4,23 @@
 # This file is part of ckanext-twitter
 # Created by the Natural History Museum in London, UK
 
+import hashlib
+
+import flask
+from ckan import model
 from ckan.common import session
 from ckan.plugins import toolkit
-from ckanext.twitter.lib import parsers as twitter_parsers
+from ckanext.twitter.lib import (
+    cache_helpers,
+    config_helpers,
+    metrics,
+    parsers as twitter_parsers,
+    prompts,
+)
+
+
+# packages with this many activities or fewer are considered new
+new_package_max_activities = 3
 
 
 class TwitterJSHelpers:
@@ -22,7 +36,7 @@ class TwitterJSHelpers:
         name or ID.
         :return: dict
         """
-        return toolkit.get_action('package_show')({}, {'id': package_name_or_id})
+        return cache_helpers.get_package({}, package_name_or_id)
 
     def _is_new(self, package_id):
         """
@@ -32,21 +46,26 @@ class TwitterJSHelpers:
         :param package_id: The ID of the package to check.
         :return: boolean
         """
-        revisions = toolkit.get_action('package_activity_list')({}, {'id': package_id})
-        return len(revisions) <= 3
+        return package_is_new({}, package_id)
 
+    @metrics.timed('tweet_ready')
     def tweet_ready(self, package_id):
         """
-        Checks the session to see if the package has been marked as ready for tweeting
-        via the update hook. Removes the 'twitter_is_suitable' key from the session if
+        Checks the session (or the configured prompt store) to see if the package has
+        been marked as ready for tweeting via the update hook. Removes the
+        'twitter_is_suitable' key from the session (or the prompt from the store) if
         present.
 
         :param package_id: The package ID.
         :return: boolean
         """
+        store = prompts.get_store()
+        if store is not None:
+            return store.pop(prompts.current_user(), package_id)
         in_session = session.pop('twitter_is_suitable', '') == package_id
         return in_session
 
+    @metrics.timed('get_tweet')
     def get_tweet(self, package_id):
         """
         Generates the tweet text for the given package.
@@ -57,10 +76,52 @@ class TwitterJSHelpers:
         return twitter_parsers.generate_tweet({}, package_id, self._is_new(package_id))
 
 
+def package_is_new(context, package_id):
+    """
+    Tests to see if the package is "new", i.e. it has only just had its first resource
+    added. Only enough activities to tell whether the package is over the limit are
+    requested, rather than the whole activity stream.
+
+    :param context: The current context.
+    :param package_id: The ID of the package to check.
+    :return: boolean
+    """
+    metrics.incr('actions.package_activity_list')
+    revisions = toolkit.get_action('package_activity_list')(
+        context, {'id': package_id, 'limit': new_package_max_activities + 1}
+    )
+    return len(revisions) <= new_package_max_activities
+
+
+def is_interactive(context):
+    """
+    Checks whether a package update could show the tweet prompt. Updates whose context
+    includes a truthy "skip_twitter" value never do. Otherwise, unless
+    ckanext.twitter.skip_non_interactive (or ckanext.twitter.digest, which collects these
+    updates instead) is enabled, every update does. If it is, only updates made by a
+    person using the web interface do, and updates made through the API, from the
+    command line or by background jobs (e.g. harvesters) don't.
+
+    :param context: The context of the update.
+    :return: boolean
+    """
+    if context.get('skip_twitter', False):
+        return False
+    if not (
+        config_helpers.twitter_skip_non_interactive() or config_helpers.twitter_digest()
+    ):
+        return True
+    if not flask.has_request_context():
+        return False
+    return not toolkit.request.path.startswith('/api/')
+
+
 def twitter_pkg_suitable(context, pkg_id, pkg_dict=None):
     """
     Various tests to determine if a package is suitable for tweeting about, e.g. it's
-    active & has resources.
+    active & has resources. Unless a package dict is provided, the checks are made
+    directly against the database, which only needs the package's row and a single
+    query for an active resource rather than a full package_show.
 
     :param context: The current context.
     :param pkg_id: The package ID.
@@ -68,13 +129,9 @@ def twitter_pkg_suitable(context, pkg_id, pkg_dict=None):
                      recommended - provided as a test helper.
     :return: boolean
     """
-    if pkg_dict:
-        package = pkg_dict
-    else:
-        try:
-            package = toolkit.get_action('package_show')(context, {'id': pkg_id})
-        except toolkit.ObjectNotFound:
-            return False
+    if not pkg_dict:
+        return _pkg_suitable_from_model(pkg_id)
+    package = pkg_dict
     if package.get('state', '') != 'active' and package.get('state', '') != 'draft':
         return False
     resources = package.get('resources', [])
@@ -85,3 +142,46 @@ def twitter_pkg_suitable(context, pkg_id, pkg_dict=None):
     if package.get('private', False):
         return False
     return True
+
+
+def _pkg_suitable_from_model(pkg_id):
+    """
+    Runs the same tests as twitter_pkg_suitable using the package model.
+
+    :param pkg_id: The package ID (or name).
+    :return: boolean
+    """
+    package = model.Package.get(pkg_id)
+    if package is None:
+        return False
+    if package.state != 'active' and package.state != 'draft':
+        return False
+    if package.private:
+        return False
+    active_resource = (
+        model.Session.query(model.Resource.id)
+        .filter(model.Resource.package_id == package.id)
+        .filter(model.Resource.state == 'active')
+        .first()
+    )
+    return active_resource is not None
+
+
+def tweet_version(package):
+    """
+    Gets a string identifying the version of the tweet text that would be generated for
+    the package. This changes whenever the package is modified or the tweet formats in
+    the config are changed, so it can be used as an ETag for the generated text.
+
+    :param package: The package model object.
+    :return: str
+    """
+    key = '\n'.join(
+        [
+            package.id,
+            package.metadata_modified.isoformat(),
+            config_helpers.twitter_new_format(),
+            config_helpers.twitter_updated_format(),
+        ]
+    )
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
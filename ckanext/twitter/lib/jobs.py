@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+import logging
+
+from ckan import model
+from ckan.lib.redis import connect_to_redis
+from ckan.plugins import toolkit
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+
+from ckanext.twitter.lib import (
+    cache_helpers,
+    config_helpers,
+    helpers as twitter_helpers,
+    parsers as twitter_parsers,
+    scheduler,
+    twitter_api,
+)
+
+logger = logging.getLogger('ckanext.twitter')
+
+
+def enqueue_tweet(tweet_text, pkg_id, priority=scheduler.INTERACTIVE):
+    """
+    Adds a tweet to the background job queue so that it can be posted by a worker
+    rather than in the web request.
+
+    :param tweet_text: The text to post.
+    :param pkg_id: The package ID (for caching).
+    :param priority: How urgent the tweet is if it has to be held (see scheduler).
+    :return: the job ID (str)
+    """
+    job = toolkit.enqueue_job(
+        post_tweet_job,
+        [tweet_text, pkg_id, priority],
+        title=f'Tweet about {pkg_id}',
+        queue=config_helpers.twitter_queue(),
+    )
+    logger.debug(f'Queued tweet as job {job.id}: {tweet_text}')
+    return job.id
+
+
+def post_tweet_job(tweet_text, pkg_id, priority=scheduler.INTERACTIVE):
+    """
+    Background job that posts the tweet. The result is stored by the job queue so that
+    it can be retrieved with get_job_status.
+
+    :param tweet_text: The text to post.
+    :param pkg_id: The package ID (for caching).
+    :param priority: How urgent the tweet is if it has to be held (see scheduler).
+    :return: dict
+    """
+    posted, reason = twitter_api.post_tweet(tweet_text, pkg_id, priority)
+    return tweet_result(tweet_text, posted, reason)
+
+
+def tweet_result(tweet_text, posted, reason):
+    """
+    Builds the result of an attempt to post a tweet, as returned to the browser. Posts
+    held because of the rate limit are marked as held, as they haven't failed and will
+    be posted later.
+
+    :param tweet_text: The text.
+    :param posted: Whether the tweet was posted.
+    :param reason: The reason given by post_tweet.
+    :return: dict
+    """
+    result = {'success': posted, 'reason': reason, 'tweet': tweet_text}
+    if reason == scheduler.HELD:
+        result['held'] = True
+    return result
+
+
+def get_job_status(job_id, pkg_id):
+    """
+    Retrieves the status of a queued tweet. Jobs that don't exist (or have expired) or
+    that were queued for a different package are reported as unknown.
+
+    :param job_id: The job ID returned by enqueue_tweet.
+    :param pkg_id: The package ID the tweet was about.
+    :return: dict
+    """
+    try:
+        job = Job.fetch(job_id, connection=connect_to_redis())
+    except NoSuchJobError:
+        job = None
+    if job is None or job.func_name != f'{__name__}.post_tweet_job':
+        return {'status': 'unknown'}
+    # jobs queued before priorities were added only have two arguments
+    tweet_text, job_pkg_id = job.args[:2]
+    if job_pkg_id != pkg_id:
+        return {'status': 'unknown'}
+
+    # newer versions of rq return an enum rather than a string
+    job_status = job.get_status()
+    status = {'status': getattr(job_status, 'value', job_status), 'tweet': tweet_text}
+    if job.is_finished:
+        status.update(job.result)
+    elif job.is_failed:
+        status.update({'success': False, 'reason': 'tweet job failed'})
+    return status
+
+
+def enqueue_precompute(pkg_id):
+    """
+    Adds a job to generate the package's tweet text in the background.
+
+    :param pkg_id: The package ID.
+    :return: the job ID (str)
+    """
+    job = toolkit.enqueue_job(
+        precompute_tweet_job,
+        [pkg_id],
+        title=f'Generate tweet for {pkg_id}',
+        queue=config_helpers.twitter_queue(),
+    )
+    return job.id
+
+
+def precompute_tweet_job(pkg_id):
+    """
+    Background job that generates the package's tweet text and stores it, keyed on the
+    version of the package it was generated from, for the preview endpoint to use.
+
+    :param pkg_id: The package ID.
+    """
+    package = model.Package.get(pkg_id)
+    if package is None:
+        return
+    version = twitter_helpers.tweet_version(package)
+    context = {'ignore_auth': True}
+    is_new = twitter_helpers.package_is_new(context, pkg_id)
+    tweet_text = twitter_parsers.generate_tweet(context, pkg_id, is_new)
+    if tweet_text is not None:
+        cache_helpers.set_precomputed_tweet(pkg_id, version, tweet_text, is_new)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+import functools
+import logging
+import re
+import socket
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+import flask
+
+from ckanext.twitter.lib import config_helpers
+
+logger = logging.getLogger('ckanext.twitter')
+
+
+class Sink(ABC):
+    """
+    Base class for the destinations metrics are sent to.
+    """
+
+    @abstractmethod
+    def count(self, name, value):
+        """
+        Records that something happened (value) times.
+
+        :param name: The metric name.
+        :param value: The number to add to the counter.
+        """
+
+    @abstractmethod
+    def timing(self, name, milliseconds):
+        """
+        Records how long something took.
+
+        :param name: The metric name.
+        :param milliseconds: The duration.
+        """
+
+
+class LoggingSink(Sink):
+    """
+    Writes each metric to the ckanext.twitter logger at debug level.
+    """
+
+    def count(self, name, value):
+        logger.debug(f'metric {name} +{value}')
+
+    def timing(self, name, milliseconds):
+        logger.debug(f'metric {name} {milliseconds:.2f}ms')
+
+
+class StatsdSink(Sink):
+    """
+    Sends each metric to a StatsD server over UDP. Sending is fire and forget, so a
+    missing server never slows anything down.
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='ckanext.twitter'):
+        """
+        :param host: The StatsD server's host.
+        :param port: The StatsD server's port.
+        :param prefix: Prepended (with a dot) to every metric name.
+        """
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def _send(self, line):
+        try:
+            self.socket.sendto(line.encode('utf-8'), self.address)
+        except OSError as e:
+            logger.debug(f'Could not send metric to StatsD: {e}')
+
+    def count(self, name, value):
+        self._send(f'{self.prefix}.{name}:{value}|c')
+
+    def timing(self, name, milliseconds):
+        self._send(f'{self.prefix}.{name}:{milliseconds:.3f}|ms')
+
+
+class MemorySink(Sink):
+    """
+    Keeps the metrics in memory, e.g. for inspecting in tests.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def count(self, name, value):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def timing(self, name, milliseconds):
+        with self.lock:
+            self.timings.setdefault(name, []).append(milliseconds)
+
+    def clear(self):
+        with self.lock:
+            self.counts.clear()
+            self.timings.clear()
+
+
+def create_sink(sink_type):
+    """
+    Creates a sink of the given type.
+
+    :param sink_type: none, logging, statsd or memory.
+    :return: Sink, or None if metrics are turned off
+    """
+    if sink_type == 'none':
+        return None
+    if sink_type == 'logging':
+        return LoggingSink()
+    if sink_type == 'statsd':
+        host, port = config_helpers.twitter_statsd_address()
+        return StatsdSink(host, port, config_helpers.twitter_metrics_prefix())
+    if sink_type == 'memory':
+        return MemorySink()
+    raise ValueError(f'Unknown ckanext.twitter.metrics type: {sink_type}')
+
+
+_sink = None
+_configured = False
+_summary = False
+
+
+def configure_metrics():
+    """
+    Creates the sink defined in the config, replacing any existing sink.
+
+    :return: Sink or None
+    """
+    global _sink, _configured, _summary
+    _sink = create_sink(config_helpers.twitter_metrics())
+    _summary = config_helpers.twitter_metrics_summary()
+    _configured = True
+    return _sink
+
+
+def set_sink(sink, summary=False):
+    """
+    Replaces the sink (e.g. with a MemorySink in tests).
+
+    :param sink: The new sink, or None to turn metrics off.
+    :param summary: Whether to keep the per-request summary.
+    """
+    global _sink, _configured, _summary
+    _sink = sink
+    _summary = summary
+    _configured = True
+
+
+def _enabled():
+    if not _configured:
+        configure_metrics()
+    return _sink is not None or _summary
+
+
+def _request_metrics():
+    if not _summary or not flask.has_request_context():
+        return None
+    return flask.g.setdefault('twitter_metrics', {})
+
+
+def incr(name, value=1):
+    """
+    Increments a counter.
+
+    :param name: The metric name.
+    :param value: The number to add.
+    """
+    if not _enabled():
+        return
+    if _sink is not None:
+        _sink.count(name, value)
+    summary = _request_metrics()
+    if summary is not None:
+        count, total = summary.get(name, (0, None))
+        summary[name] = (count + value, total)
+
+
+def timing(name, milliseconds):
+    """
+    Records a duration.
+
+    :param name: The metric name.
+    :param milliseconds: The duration.
+    """
+    if not _enabled():
+        return
+    if _sink is not None:
+        _sink.timing(name, milliseconds)
+    summary = _request_metrics()
+    if summary is not None:
+        count, total = summary.get(name, (0, 0.0))
+        summary[name] = (count + 1, (total or 0.0) + milliseconds)
+
+
+@contextmanager
+def timer(name):
+    """
+    Context manager that records how long its body takes.
+
+    :param name: The metric name.
+    """
+    if not _enabled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing(name, (time.perf_counter() - start) * 1000)
+
+
+def timed(name):
+    """
+    Decorator that records how long each call to the function takes.
+
+    :param name: The metric name.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled():
+                return function(*args, **kwargs)
+            with timer(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def metric_name(text):
+    """
+    Turns free text (e.g. a post outcome like "200 OK") into something that can be used
+    in a metric name.
+
+    :param text: The text.
+    :return: str
+    """
+    return re.sub(r'[^a-z0-9]+', '_', str(text).lower()).strip('_') or 'unknown'
+
+
+def log_request_summary(response):
+    """
+    Logs a single line summarising the metrics recorded during the current request, if
+    the summary is turned on and anything was recorded.
+
+    :param response: The response (returned unchanged so this can be used as an
+                     after_request function).
+    :return: the response
+    """
+    summary = _request_metrics()
+    if summary:
+        parts = []
+        for name, (count, total) in sorted(summary.items()):
+            if total is None:
+                parts.append(f'{name}={count}')
+            else:
+                parts.append(f'{name}={total:.1f}ms/{count}')
+        logger.info(
+            f'ckanext-twitter {flask.request.method} {flask.request.path}: '
+            + ' '.join(parts)
+        )
+    return response
@@ -4,18 +4,43 @@
 # This file is part of ckanext-twitter
 # Created by the Natural History Museum in London, UK
 
+import logging
 import math
 import re
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
 
+import flask
+from ckan import model
 from ckan.lib.search import SearchIndexError
 from ckan.plugins import toolkit
-from ckanext.twitter.lib import config_helpers
-from jinja2 import Environment
+from ckanext.twitter.lib import cache_helpers, config_helpers, metrics, tweet_length
+from jinja2 import Environment, meta
+from jinja2.sandbox import SandboxedEnvironment
 
-tweet_limit = 140
+logger = logging.getLogger('ckanext.twitter')
 
+# resource IDs are used as datastore table names, so only allow IDs that are safe to
+# drop into a query
+resource_id_rgx = re.compile(r'[\w-]+')
 
-def extract_info(context, pkg_dict, template_length, tokens):
+token_rgx = re.compile(r'(?:{{ )(\w+)(?:(?:|.+?)? }})')
+
+# separators between authors, and between the parts of an author's name
+sep_rgx = re.compile(r'\s?[,;]\s?')
+name_sep_rgx = re.compile(r'(?<=[^,;])\s')
+
+# one environment of each type is shared by all the compiled templates
+environments = {False: Environment(), True: SandboxedEnvironment()}
+
+CompiledTemplate = namedtuple(
+    'CompiledTemplate', ['template', 'tokens', 'variables', 'static_length']
+)
+
+
+def extract_info(context, pkg_dict, template_length, tokens, variables=None):
     """
     Creates a simplified dictionary for use in a tweet string template.
 
@@ -23,45 +48,54 @@ def extract_info(context, pkg_dict, template_length, tokens):
     :param pkg_dict: The package information to be simplified.
     :param template_length: The length of the text in the template (without any of the tokens).
     :param tokens: A list of token names in the template (extracted via regex).
+    :param variables: Optionally, the names of all the variables the template uses. If
+                      provided, only those values are added to the dictionary, so
+                      expensive values (like the number of records) are only worked out
+                      if the template needs them. If not, all values are added.
     :return: dict
     """
-    # get the values that are simple (i.e. not lists or dicts)
-    simplified = {
-        k: v
-        for k, v in pkg_dict.items()
-        if not isinstance(v, list) and not isinstance(v, dict) and v is not None
-    }
-
-    # turn the lists into counts
-    list_lengths = {
-        k: len(v)
-        for k, v in pkg_dict.items()
-        if isinstance(v, list) or isinstance(v, dict)
-    }
-    for k, v in list_lengths.items():
-        simplified[k] = v
-
-    # apply specific rules to certain fields
-    simplified['records'] = get_number_records(context, pkg_dict['id'])
-    simplified['author'] = truncate_author(simplified.get('author', 'Anon.'))
+    if variables is None:
+        variables = set(pkg_dict.keys()) | {'records', 'author'}
+
+    simplified = {}
+    for name in variables:
+        if name == 'records':
+            simplified['records'] = get_number_records(context, pkg_dict['id'], pkg_dict)
+        elif name == 'author':
+            author = pkg_dict.get('author')
+            simplified['author'] = truncate_author(
+                author if author is not None else 'Anon.'
+            )
+        elif pkg_dict.get(name) is not None:
+            value = pkg_dict[name]
+            # turn the lists into counts
+            if isinstance(value, (list, dict)):
+                value = len(value)
+            simplified[name] = value
 
     # truncate other fields
     other_tokens = [
         t for t in tokens if t not in ['records', 'author'] and t in simplified.keys()
     ]
-    max_total_token = tweet_limit - template_length
+    max_total_token = config_helpers.twitter_tweet_limit() - template_length
     total_token = sum(
-        [len(str(simplified[t])) for t in tokens if t in ['records', 'author']]
+        [
+            tweet_length.weighted_length(str(simplified[t]))
+            for t in tokens
+            if t in ['records', 'author']
+        ]
     )
     for i in range(len(other_tokens)):
         char_limit = math.floor(
             (max_total_token - total_token) / (len(other_tokens) - i)
         )
         val = str(simplified.get(other_tokens[i], '')).strip()
-        if len(val) > char_limit:
+        val_length = tweet_length.weighted_length(val)
+        if val_length > char_limit:
             val = truncate_field(val, char_limit)
+            val_length = tweet_length.weighted_length(val)
         simplified[other_tokens[i]] = val
-        total_token += len(val)
+        total_token += val_length
     return simplified
 
 
@@ -72,66 +106,353 @@ def truncate_author(author):
     :param author: The full author string.
     :return: str
     """
-    sep_rgx = '\s?[,;]\s?'
-    name_sep_rgx = '(?<=[^,;])\s'
-    separators = list(set(re.findall(sep_rgx, author)))
-    name_sep = re.search(name_sep_rgx, author)
-    if len(separators) == 0:
-        return re.split(name_sep_rgx, author)[-1] if name_sep else author
-    first_author = re.split(sep_rgx, author)[0]
+    # only the first separator is needed to find the first author, and only the first
+    # two distinct separators to tell how the authors are listed, so there's no need to
+    # scan the whole of a very long author list
+    first_sep = None
+    separators = set()
+    for match in sep_rgx.finditer(author):
+        if first_sep is None:
+            first_sep = match
+        separators.add(match.group())
+        if len(separators) > 1:
+            break
+
+    if first_sep is None:
+        # just one author, so use their surname (the last part of the name)
+        for i in range(len(author) - 1, 0, -1):
+            if author[i].isspace():
+                return author[i + 1 :]
+        return author
+
+    first_author = author[: first_sep.start()]
     if len(separators) == 1:
-        first_author = re.split(name_sep_rgx, first_author)[1]
+        # a single type of separator (e.g. "Forename Surname; Forename Surname"), so
+        # use the first author's surname
+        parts = name_sep_rgx.split(first_author, maxsplit=2)
+        if len(parts) > 1:
+            first_author = parts[1]
     return f'{first_author} et al.'
 
 
+def truncate_authors(authors):
+    """
+    Shortens many author fields at once (see truncate_author). Each distinct value is
+    only processed once, which helps when the same author list appears many times.
+
+    :param authors: An iterable of author strings.
+    :return: list of str
+    """
+    truncated = {}
+    results = []
+    for author in authors:
+        if author not in truncated:
+            truncated[author] = truncate_author(author)
+        results.append(truncated[author])
+    return results
+
+
 def truncate_field(value, char_limit):
     """
-    Shortens the given value to a length equal to or less than the character limit and
-    appends a continuation marker.
+    Shortens the given value to a weighted length (see tweet_length) equal to or less
+    than the character limit and appends a continuation marker.
 
     :param value: The value to be truncated.
-    :param char_limit: The maximum number of characters in the output string.
+    :param char_limit: The maximum weighted length of the output string.
     :return: str
     """
     marker = '[...]'
-    truncated = []
-    if ' ' in value:
-        parts = value.split(' ')
-        for p in parts:
-            if sum([len(i) + 1 for i in truncated]) + len(p) + len(marker) < char_limit:
-                truncated.append(p)
-            else:
-                break
-        return ' '.join(truncated) + marker
-    return value[: char_limit - len(marker)] + marker
+    if ' ' not in value:
+        return tweet_length.truncate(value, max(char_limit - len(marker), 0)) + marker
+    # keep whole words while they (and the marker) fit; the length of the kept words
+    # includes a space after each one
+    kept_length = 0
+    end = 0
+    for p in value.split(' '):
+        p_length = tweet_length.weighted_length(p)
+        if kept_length + p_length + len(marker) >= char_limit:
+            break
+        kept_length += p_length + 1
+        end += len(p) + 1
+    return value[: max(end - 1, 0)] + marker
+
+
+def truncate_fields(values, char_limit):
+    """
+    Shortens many values at once to the length limit (see truncate_field). Values that
+    are already short enough are returned unchanged.
+
+    :param values: An iterable of strings.
+    :param char_limit: The maximum weighted length (see tweet_length) of each output
+                       string.
+    :return: list of str
+    """
+    return [
+        value
+        if tweet_length.weighted_length(value) <= char_limit
+        else truncate_field(value, char_limit)
+        for value in values
+    ]
 
 
-def get_number_records(context, pkg_id):
+@metrics.timed('get_number_records')
+def get_number_records(context, pkg_id, pkg_dict=None):
     """
     Counts the total number of records associated with a package.
 
     :param context: The current context.
     :param pkg_id: The package ID.
+    :param pkg_dict: Optionally, the already retrieved package dict; if not provided,
+                     the package is retrieved (via the request's package cache).
     :return: int
     """
-    pkg = toolkit.get_action('package_show')(context, {'id': pkg_id})
+    pkg = pkg_dict or cache_helpers.get_package(context, pkg_id)
     resources = pkg.get('resources', None)
     if not resources or len(resources) == 0:
         return 0
-    resource_ids = [r['id'] for r in resources]
-    total = 0
+    # resources that we know aren't in the datastore don't need to be queried at all
+    resources = [r for r in resources if r.get('datastore_active', True)]
+    return sum(count_records(context, resources).values())
+
+
+def count_records(context, resources):
+    """
+    Counts the number of datastore records in each of the given resources. Counts are
+    taken from the record count cache where possible; otherwise only the totals are
+    requested, not the records themselves. Resources that aren't in the datastore (or
+    that can't be counted within the configured timeout) count as 0.
+
+    :param context: The current context.
+    :param resources: A list of resource dicts.
+    :return: dict of resource ID -> number of records
+    """
+    counts = {}
+    uncounted = []
+    for resource in resources:
+        count = cache_helpers.get_record_count(resource)
+        if count is None:
+            uncounted.append(resource)
+        else:
+            counts[resource['id']] = count
+    metrics.incr('record_count_cache.hit', len(counts))
+    metrics.incr('record_count_cache.miss', len(uncounted))
+    if not uncounted:
+        return counts
+
+    resource_ids = [r['id'] for r in uncounted]
+    new_counts = None
+    if config_helpers.twitter_count_sql():
+        new_counts = _count_records_sql(context, resource_ids)
+    if new_counts is None:
+        workers = config_helpers.twitter_count_workers()
+        timeout = config_helpers.twitter_count_timeout()
+        if workers > 1 and len(resource_ids) > 1:
+            new_counts = _count_records_threaded(
+                context, resource_ids, workers, timeout
+            )
+        else:
+            new_counts = _count_records_serial(context, resource_ids, timeout)
+
+    for resource in uncounted:
+        count = new_counts.get(resource['id'])
+        # resources that couldn't be counted aren't cached so they're tried again next
+        # time
+        if count is not None:
+            cache_helpers.set_record_count(resource, count)
+        counts[resource['id']] = count or 0
+    return counts
+
+
+def _count_resource_records(context, resource_id):
+    """
+    Counts the records in a single resource using a datastore_search that doesn't
+    return any rows. If an estimate threshold is configured, tables larger than it are
+    counted using the database's statistics rather than a full count.
+
+    :param context: The current context.
+    :param resource_id: The resource ID.
+    :return: int
+    """
+    search_dict = {'resource_id': resource_id, 'limit': 0, 'include_total': True}
+    threshold = config_helpers.twitter_count_estimate_threshold()
+    if threshold is not None:
+        search_dict['total_estimation_threshold'] = threshold
+    metrics.incr('datastore.queries')
+    try:
+        resource_data = toolkit.get_action('datastore_search')(context, search_dict)
+        return resource_data.get('total', 0)
+    except (toolkit.ObjectNotFound, SearchIndexError):
+        return 0
+
+
+def _count_records_serial(context, resource_ids, timeout):
+    """
+    Counts the records in each resource in turn. A count that has started can't be
+    stopped, so the timeout is checked between resources, and any resources not
+    started before it ran out aren't counted.
+
+    :param context: The current context.
+    :param resource_ids: A list of resource IDs.
+    :param timeout: The number of seconds to spend counting (or None).
+    :return: dict of resource ID -> number of records (None if it couldn't be counted)
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    counts = {}
     for rid in resource_ids:
+        if deadline is not None and time.monotonic() >= deadline:
+            logger.warning(f'Timed out counting the records in resource {rid}')
+            counts[rid] = None
+            continue
+        counts[rid] = _count_resource_records(context, rid)
+    return counts
+
+
+def _count_records_threaded(context, resource_ids, workers, timeout):
+    """
+    Counts the records in each resource using a bounded pool of threads, giving up on
+    any resources that haven't been counted when the timeout runs out.
+
+    :param context: The current context. Each thread gets its own copy.
+    :param resource_ids: A list of resource IDs.
+    :param workers: The maximum number of threads to use.
+    :param timeout: The number of seconds to wait for all the resources (or None).
+    :return: dict of resource ID -> number of records (None if it couldn't be counted)
+    """
+
+    def count(resource_id):
         try:
-            resource_data = toolkit.get_action('datastore_search')(
-                context, {'resource_id': rid}
-            )
-            total += resource_data.get('total', 0)
-        except (toolkit.ObjectNotFound, SearchIndexError):
-            pass
-    return total
+            return _count_resource_records(dict(context), resource_id)
+        finally:
+            # threads get their own scoped database session, so make sure it's cleaned
+            # up before the thread is reused
+            model.Session.remove()
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(workers, len(resource_ids))))
+    futures = {}
+    for rid in resource_ids:
+        func = count
+        if flask.has_request_context():
+            func = flask.copy_current_request_context(count)
+        futures[rid] = executor.submit(func, rid)
+
+    counts = {}
+    try:
+        # one deadline for them all, however many are queued behind a slow one
+        done, _ = wait(futures.values(), timeout=timeout)
+        for rid, future in futures.items():
+            if future not in done:
+                logger.warning(f'Timed out counting the records in resource {rid}')
+                future.cancel()
+                counts[rid] = None
+                continue
+            try:
+                counts[rid] = future.result()
+            except Exception as e:
+                logger.warning(f'Failed to count the records in resource {rid}: {e}')
+                counts[rid] = None
+    finally:
+        # don't wait for any resources that timed out
+        executor.shutdown(wait=False)
+    return counts
+
+
+def _count_records_sql(context, resource_ids):
+    """
+    Counts the records in all the given resources with a single datastore_search_sql
+    query. If any of the resources can't be queried this way (e.g. because it isn't in
+    the datastore) None is returned so that the caller can fall back to counting each
+    resource separately. If an estimate threshold is configured, the query only counts
+    far enough to find out whether each table is larger than it, and the tables that
+    are get an estimated count instead.
+
+    :param context: The current context.
+    :param resource_ids: A list of resource IDs.
+    :return: dict of resource ID -> number of records, or None
+    """
+    if not all(resource_id_rgx.fullmatch(rid) for rid in resource_ids):
+        return None
+    threshold = config_helpers.twitter_count_estimate_threshold()
+    selects = []
+    for rid in resource_ids:
+        if threshold is None:
+            source = f'"{rid}"'
+        else:
+            source = f'(SELECT 1 FROM "{rid}" LIMIT {threshold + 1}) AS capped'
+        selects.append(f'SELECT \'{rid}\' AS id, COUNT(*) AS total FROM {source}')
+    sql = ' UNION ALL '.join(selects)
+    metrics.incr('datastore.queries')
+    try:
+        result = toolkit.get_action('datastore_search_sql')(context, {'sql': sql})
+    except (
+        KeyError,
+        toolkit.ObjectNotFound,
+        toolkit.NotAuthorized,
+        toolkit.ValidationError,
+        SearchIndexError,
+    ) as e:
+        logger.debug(f'Could not count records with datastore_search_sql: {e}')
+        return None
+    counts = {r['id']: int(r['total']) for r in result.get('records', [])}
+    if threshold is not None:
+        for rid, total in counts.items():
+            if total > threshold:
+                counts[rid] = _count_resource_records(context, rid)
+    return counts
+
+
+def truncate_tweet(text):
+    """
+    Cuts the text down to the tweet length limit, if it's over it. The limit applies to
+    the weighted length, as it does on twitter.
+
+    :param text: The tweet text.
+    :return: str
+    """
+    return tweet_length.truncate(text, config_helpers.twitter_tweet_limit())
+
+
+@lru_cache(maxsize=32)
+def compile_template(format_string, sandboxed=False):
+    """
+    Compiles a tweet format string. The result is cached for the lifetime of the
+    process and, as the cache is keyed on the format string itself, changing the format
+    in the config will result in it being compiled again.
+
+    :param format_string: The jinja2 format string.
+    :param sandboxed: If True, compile the template in a sandboxed environment so that
+                      untrusted templates can't access anything unsafe.
+    :return: CompiledTemplate containing the template, the list of token names in the
+             template, the set of all the variables the template uses (including
+             those only used in conditions or filters) and the length of the
+             template's static text
+    """
+    environment = environments[sandboxed]
+    template = environment.from_string(format_string)
+    tokens = token_rgx.findall(format_string)
+    variables = frozenset(
+        meta.find_undeclared_variables(environment.parse(format_string))
+    ) | frozenset(tokens)
+    static_length = tweet_length.weighted_length(str(template.module))
+    return CompiledTemplate(template, tokens, variables, static_length)
+
+
+def get_template(is_new):
+    """
+    Gets the compiled template for new or updated packages, as defined in the config.
+
+    :param is_new: True for the new package template, False for the updated one.
+    :return: CompiledTemplate
+    """
+    format_string = (
+        config_helpers.twitter_new_format()
+        if is_new
+        else config_helpers.twitter_updated_format()
+    )
+    return compile_template(format_string, config_helpers.twitter_sandbox())
 
 
-def generate_tweet(context, pkg_id, is_new, force_truncate=True):
+@metrics.timed('generate_tweet')
+def generate_tweet(context, pkg_id, is_new, force_truncate=True, pkg_dict=None):
     """
     Generates a standard tweet based on template values in the config. Does not post the
     tweet; just generates and returns the text.
@@ -141,23 +462,102 @@ def generate_tweet(context, pkg_id, is_new, force_truncate=True):
     :param is_new: True if the package has only just been created or given
     its first resource, False if it's being updated.
     :param force_truncate: If True, enforces an extra check at the end to
-    ensure the text is below 140 characters. This should not be necessary as
+    ensure the text's weighted length is below the limit. This should not be necessary as
     other methods account for this, but this is an optional final check.
+    :param pkg_dict: Optionally, the already retrieved package dict; if not provided,
+    the package is retrieved (via the request's package cache).
     :return: str
     """
-    pkg = toolkit.get_action('package_show')(context, {'id': pkg_id})
+    pkg = pkg_dict or cache_helpers.get_package(context, pkg_id)
     if pkg.get('private', False):
         return
-    format_string = (
-        config_helpers.twitter_new_format()
-        if is_new
-        else config_helpers.twitter_updated_format()
+    compiled = get_template(is_new)
+    simplified_dict = extract_info(
+        context, pkg, compiled.static_length, compiled.tokens, compiled.variables
     )
-    tokens = re.findall('(?:{{ )(\w+)(?:(?:|.+?)? }})', format_string)
-    template = Environment().from_string(format_string)
-    simplified_dict = extract_info(context, pkg, len(str(template.module)), tokens)
-    rendered = template.render(simplified_dict)
+    rendered = compiled.template.render(simplified_dict)
     # extra check to make sure the tweet isn't too long
-    if len(rendered) > tweet_limit and force_truncate:
-        rendered = rendered[:tweet_limit]
+    if force_truncate:
+        rendered = truncate_tweet(rendered)
     return rendered
+
+
+def generate_tweets(context, pkg_ids, is_new=False, chunk_size=100):
+    """
+    Generates tweets for many packages at once. Rather than retrieving and counting the
+    records of each package separately, the packages are retrieved in chunks with a
+    single package_search each and the records in all of a chunk's resources are
+    counted together (if the templates use the number of records). The tweets are
+    generated lazily, so a chunk isn't retrieved until its tweets are needed.
+
+    :param context: The current context.
+    :param pkg_ids: An iterable of package IDs.
+    :param is_new: Either a boolean (applied to all the packages) or a dict of package
+                   ID -> boolean. Packages missing from the dict are treated as updated.
+    :param chunk_size: The number of packages to retrieve in each search.
+    :return: generator of (package ID, tweet text) tuples, in the same order as the
+             IDs; the text is None for packages that can't be found or are private
+    """
+    pkg_ids = list(pkg_ids)
+    if isinstance(is_new, dict):
+        new_ids = is_new
+        templates = [get_template(True), get_template(False)]
+    else:
+        new_ids = dict.fromkeys(pkg_ids, is_new)
+        templates = [get_template(is_new)]
+    count_needed = any('records' in compiled.variables for compiled in templates)
+
+    for start in range(0, len(pkg_ids), chunk_size):
+        chunk = pkg_ids[start : start + chunk_size]
+        packages = _search_packages(context, chunk)
+        if count_needed:
+            # count everything in one go; the counts are cached, so each tweet then
+            # gets its count from the cache
+            resources = [
+                r
+                for pkg in packages.values()
+                for r in pkg.get('resources', [])
+                if r.get('datastore_active', True)
+            ]
+            if resources:
+                count_records(context, resources)
+        for pkg_id in chunk:
+            pkg = packages.get(pkg_id)
+            if pkg is None:
+                yield pkg_id, None
+                continue
+            yield pkg_id, generate_tweet(
+                context, pkg_id, new_ids.get(pkg_id, False), pkg_dict=pkg
+            )
+
+
+def _search_packages(context, pkg_ids):
+    """
+    Retrieves the given packages with a single package_search, including drafts and
+    private packages as package_show would. Any the search doesn't return (e.g. because
+    they haven't been indexed, or are drafts the search doesn't show this user) are
+    retrieved with package_show instead.
+
+    :param context: The current context.
+    :param pkg_ids: A list of package IDs.
+    :return: dict of package ID -> package dict, without any that can't be found
+    """
+    quoted_ids = ' OR '.join(f'"{pkg_id}"' for pkg_id in pkg_ids)
+    metrics.incr('actions.package_search')
+    result = toolkit.get_action('package_search')(
+        dict(context),
+        {
+            'fq': f'id:({quoted_ids})',
+            'rows': len(pkg_ids),
+            'include_drafts': True,
+            'include_private': True,
+        },
+    )
+    packages = {pkg['id']: pkg for pkg in result['results']}
+    for pkg_id in pkg_ids:
+        if pkg_id not in packages:
+            try:
+                packages[pkg_id] = cache_helpers.get_package(context, pkg_id)
+            except (toolkit.ObjectNotFound, toolkit.NotAuthorized):
+                pass
+    return packages
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+from ckan.plugins import toolkit
+
+from ckanext.twitter.lib import config_helpers, stores
+
+
+class PromptStore:
+    """
+    Records which packages each user should be prompted to tweet about, as an
+    alternative to keeping this in their session. Prompts are only kept for a short
+    time, as they're shown on the page loaded straight after an edit.
+    """
+
+    key_prefix = 'ckanext-twitter:prompt:'
+
+    def __init__(self, entries, ttl):
+        """
+        :param entries: The ExpiringStore to keep the prompts in.
+        :param ttl: The number of seconds a prompt is kept for.
+        """
+        self.entries = entries
+        self.ttl = ttl
+
+    def add(self, user, pkg_id):
+        """
+        Records that the user should be prompted to tweet about the package.
+
+        :param user: The user's name.
+        :param pkg_id: The package ID.
+        """
+        self.entries.set(f'{user}:{pkg_id}', 1, self.ttl)
+
+    def pop(self, user, pkg_id):
+        """
+        Checks whether the user should be prompted to tweet about the package and, if
+        so, removes the prompt so that it's only shown once.
+
+        :param user: The user's name.
+        :param pkg_id: The package ID.
+        :return: boolean
+        """
+        return self.entries.delete(f'{user}:{pkg_id}')
+
+    def remove(self, user, pkg_id):
+        """
+        Removes the prompt (if there is one).
+
+        :param user: The user's name.
+        :param pkg_id: The package ID.
+        """
+        self.pop(user, pkg_id)
+
+
+def create_store(store_type):
+    """
+    Creates a prompt store of the given type. The memory store is only suitable if the
+    page after an edit is always served by the same process.
+
+    :param store_type: session, memory or redis.
+    :return: PromptStore, or None if prompts are kept in the session
+    """
+    if store_type == 'session':
+        return None
+    if store_type not in ('memory', 'redis'):
+        raise ValueError(f'Unknown ckanext.twitter.prompt_store type: {store_type}')
+    entries = stores.create_expiring_store(store_type, PromptStore.key_prefix)
+    return PromptStore(entries, config_helpers.twitter_prompt_ttl())
+
+
+_store = stores.ConfiguredStore(
+    lambda: create_store(config_helpers.twitter_prompt_store())
+)
+
+
+def configure_store():
+    """
+    Creates the prompt store defined in the config, replacing any existing store.
+
+    :return: PromptStore or None
+    """
+    return _store.configure()
+
+
+def get_store():
+    """
+    Gets the configured prompt store, creating it if it hasn't been configured yet.
+
+    :return: PromptStore, or None if prompts are kept in the session
+    """
+    return _store.get()
+
+
+def current_user(context=None):
+    """
+    Gets the name of the user making the current request.
+
+    :param context: Optionally, an action context which may include the user.
+    :return: str
+    """
+    if context and context.get('user'):
+        return context['user']
+    return getattr(toolkit.c, 'user', None) or ''
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+import json
+import logging
+import threading
+import time
+
+from ckan.lib.redis import connect_to_redis
+
+from ckanext.twitter.lib import config_helpers
+
+logger = logging.getLogger('ckanext.twitter')
+
+# priorities for posts that are held because the rate limit has been reached; lower
+# numbers are posted first when the limit resets
+INTERACTIVE = 0
+DIGEST = 1
+BACKFILL = 2
+
+# the reason given for a post that has been held, rather than posted or rejected
+HELD = 'held'
+
+held_key = 'ckanext-twitter:held'
+
+
+class RateLimit:
+    """
+    A token bucket for the posting rate limit. The twitter API reports the size of the
+    bucket, how many tokens are left and when it refills in the x-rate-limit-* headers
+    of each response, so rather than guessing at the rate the bucket is updated from
+    those. Until a response has been seen the limit is unknown and posts are allowed.
+
+    The bucket is kept in CKAN's redis, next to the held posts, so that every web
+    process, job worker and CLI command shares the same view of the limit.
+    """
+
+    key = 'ckanext-twitter:rate-limit'
+
+    def __init__(self, connection=None):
+        """
+        :param connection: A redis connection; if not provided, CKAN's is used.
+        """
+        self.connection = connection
+
+    @property
+    def redis(self):
+        # connect on first use, as this is created when the module is imported
+        if self.connection is None:
+            self.connection = connect_to_redis()
+        return self.connection
+
+    def state(self):
+        """
+        Gets the current state of the bucket.
+
+        :return: dict of the limit and remaining tokens (int or None) and when the
+                 bucket refills (a POSIX timestamp)
+        """
+        limit, remaining, reset = self.redis.hmget(
+            self.key, 'limit', 'remaining', 'reset'
+        )
+        return {
+            'limit': int(limit) if limit is not None else None,
+            'remaining': int(remaining) if remaining is not None else None,
+            'reset': float(reset) if reset is not None else 0.0,
+        }
+
+    def acquire(self, now=None):
+        """
+        Takes a token from the bucket, if there are any left. This is done in a redis
+        transaction, so two processes can't both take the last token.
+
+        :param now: The current time (defaults to time.time()).
+        :return: True if a post can be made now, False if it should be held
+        """
+        now = time.time() if now is None else now
+        window = config_helpers.twitter_rate_limit_window()
+
+        def take(pipeline):
+            limit, remaining, reset = pipeline.hmget(
+                self.key, 'limit', 'remaining', 'reset'
+            )
+            if remaining is None:
+                return True
+            remaining = int(remaining)
+            reset = float(reset) if reset is not None else 0.0
+            if now >= reset:
+                if limit is None:
+                    # there's nothing to refill the bucket with
+                    pipeline.multi()
+                    pipeline.delete(self.key)
+                    return True
+                # we don't know how many requests other clients have made in the new
+                # window, so trust the limit until the next response says otherwise
+                remaining = int(limit)
+                reset = now + window
+            if remaining <= 0:
+                return False
+            pipeline.multi()
+            pipeline.hset(
+                self.key, mapping={'remaining': remaining - 1, 'reset': reset}
+            )
+            return True
+
+        return self.redis.transaction(take, self.key, value_from_callable=True)
+
+    def update(self, headers, status, now=None):
+        """
+        Updates the bucket from a response.
+
+        :param headers: The response's headers.
+        :param status: The response's status code.
+        :param now: The current time (defaults to time.time()).
+        """
+        now = time.time() if now is None else now
+        limit = headers.get('x-rate-limit-limit')
+        remaining = headers.get('x-rate-limit-remaining')
+        reset = headers.get('x-rate-limit-reset')
+        state = {}
+        if limit is not None:
+            state['limit'] = int(limit)
+        if remaining is not None:
+            state['remaining'] = int(remaining)
+        if reset is not None:
+            state['reset'] = float(reset)
+        if status == 429:
+            # we've been told to stop, whatever the headers said
+            state['remaining'] = 0
+            if reset is None or float(reset) <= now:
+                state['reset'] = now + config_helpers.twitter_rate_limit_window()
+        if not state:
+            return
+        pipeline = self.redis.pipeline()
+        pipeline.hset(self.key, mapping=state)
+        if status == 429:
+            pipeline.hsetnx(self.key, 'limit', 1)
+        pipeline.execute()
+
+    def available(self, now=None):
+        """
+        Gets how many posts can be made before the bucket runs out, without taking any
+        tokens.
+
+        :param now: The current time (defaults to time.time()).
+        :return: int, or None if the limit is unknown
+        """
+        now = time.time() if now is None else now
+        state = self.state()
+        if state['remaining'] is None:
+            return None
+        if now >= state['reset']:
+            return state['limit']
+        return max(0, state['remaining'])
+
+    def wait_time(self, now=None):
+        """
+        Gets the time until a post can be made.
+
+        :param now: The current time (defaults to time.time()).
+        :return: seconds (float); 0 if a post can be made now
+        """
+        now = time.time() if now is None else now
+        state = self.state()
+        if state['remaining'] is None or state['remaining'] > 0:
+            return 0.0
+        return max(0.0, state['reset'] - now)
+
+    def clear(self):
+        """
+        Forgets everything about the rate limit.
+        """
+        self.redis.delete(self.key)
+
+
+rate_limit = RateLimit()
+
+_drain_timer = None
+_drain_timer_lock = threading.Lock()
+
+
+def hold(tweet_text, pkg_id, priority, connection=None):
+    """
+    Holds a post until the rate limit resets. Held posts are kept in CKAN's redis so
+    that they survive restarts and can be drained by any process.
+
+    :param tweet_text: The text to post.
+    :param pkg_id: The package ID (or None).
+    :param priority: INTERACTIVE, DIGEST or BACKFILL.
+    :param connection: Optionally, the redis connection to use.
+    """
+    redis = connection or connect_to_redis()
+    held_at = time.time()
+    post = {
+        'tweet': tweet_text,
+        'pkg_id': pkg_id,
+        'priority': priority,
+        'held_at': held_at,
+    }
+    # sort by priority first, then by the order the posts were held in
+    redis.zadd(held_key, {json.dumps(post): priority * 1e10 + held_at})
+    logger.debug(f'Held (rate limited, priority {priority}): {tweet_text}')
+    schedule_drain()
+
+
+def held(connection=None):
+    """
+    Lists the held posts in the order they'll be posted.
+
+    :param connection: Optionally, the redis connection to use.
+    :return: list of dicts
+    """
+    redis = connection or connect_to_redis()
+    return [json.loads(post) for post in redis.zrange(held_key, 0, -1)]
+
+
+def drain(connection=None):
+    """
+    Posts held posts, most urgent first, until they've all been posted or the rate
+    limit is reached again. If tweets are posted asynchronously, the posts are queued
+    instead (in the same order), but only as many as the rate limit has room for; the
+    rest stay held.
+
+    :param connection: Optionally, the redis connection to use.
+    :return: list of (tweet text, posted, reason) tuples
+    """
+    # imported here as twitter_api holds posts using this module
+    from ckanext.twitter.lib import jobs, twitter_api
+
+    redis = connection or connect_to_redis()
+    is_async = config_helpers.twitter_async()
+    # the queued jobs take their tokens when they run, so count them off here instead
+    room = rate_limit.available() if is_async else None
+    results = []
+    while rate_limit.wait_time() == 0 and (room is None or room > 0):
+        popped = redis.zpopmin(held_key)
+        if not popped:
+            break
+        post = json.loads(popped[0][0])
+        if is_async:
+            job_id = jobs.enqueue_tweet(post['tweet'], post['pkg_id'], post['priority'])
+            results.append((post['tweet'], False, f'queued ({job_id})'))
+            if room is not None:
+                room -= 1
+            continue
+        posted, reason = twitter_api.post_tweet(
+            post['tweet'], post['pkg_id'], post['priority']
+        )
+        results.append((post['tweet'], posted, reason))
+        if reason == HELD:
+            # it's been held again, so there's no point trying the rest
+            break
+    if redis.zcard(held_key):
+        schedule_drain()
+    return results
+
+
+def schedule_drain():
+    """
+    Makes sure the held posts will be drained once the rate limit resets by starting a
+    timer in this process (if there isn't one running already).
+    """
+    global _drain_timer
+    with _drain_timer_lock:
+        if _drain_timer is not None and _drain_timer.is_alive():
+            return
+        # wait until the bucket refills (posts can be left held before it's empty if
+        # they've been queued), and a moment longer in case the clocks don't match
+        delay = max(0.0, rate_limit.state()['reset'] - time.time()) + 1
+        _drain_timer = threading.Timer(delay, _timed_drain)
+        _drain_timer.daemon = True
+        _drain_timer.start()
+
+
+def _timed_drain():
+    global _drain_timer
+    with _drain_timer_lock:
+        _drain_timer = None
+    try:
+        drain()
+    except Exception as e:
+        logger.warning(f'Could not post held tweets: {e}')
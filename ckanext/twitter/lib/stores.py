@@ -0,0 +1,609 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+import fcntl
+import heapq
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+from ckan import model
+from ckan.lib.redis import connect_to_redis
+from sqlalchemy import Column, Float, MetaData, Table, UnicodeText, and_, select
+from sqlalchemy.dialects.postgresql import insert
+
+from ckanext.twitter.lib import config_helpers
+
+# the extension's tables are kept separate from CKAN's own so that CKAN's create_all
+# and drop_all don't touch them; they're created with the twitter initdb command
+metadata = MetaData()
+
+last_tweeted_table = Table(
+    'ckanext_twitter_last_tweeted',
+    metadata,
+    Column('package_id', UnicodeText, primary_key=True),
+    Column('tweeted_at', Float, nullable=False, index=True),
+)
+
+
+class ExpiringStore(ABC):
+    """
+    Base class for key/value stores whose entries expire after a number of seconds.
+    This is the storage shared by the rest period, prompt and dedupe stores, so that
+    each only has to map its own operations onto these. Values must be JSON
+    serialisable.
+    """
+
+    @abstractmethod
+    def get(self, key):
+        """
+        Gets the value stored under the key.
+
+        :param key: The key.
+        :return: the value, or None if there isn't one (or it has expired)
+        """
+
+    def get_many(self, keys):
+        """
+        Gets the values stored under each of the keys, using a single lookup.
+
+        :param keys: A list of keys.
+        :return: a list of values (or Nones), in the same order as the keys
+        """
+        return [self.get(key) for key in keys]
+
+    @abstractmethod
+    def set(self, key, value, ttl):
+        """
+        Stores the value under the key, replacing any existing value.
+
+        :param key: The key.
+        :param value: The value.
+        :param ttl: The number of seconds to keep the value for; if this isn't
+                    positive, the key is removed instead.
+        """
+
+    @abstractmethod
+    def add(self, key, value, ttl):
+        """
+        Atomically stores the value under the key, but only if there isn't already a
+        value. When several processes try to add the same key at once, only one of
+        them will succeed.
+
+        :param key: The key.
+        :param value: The value.
+        :param ttl: The number of seconds to keep the value for.
+        :return: True if the value was added, False if the key already has one
+        """
+
+    @abstractmethod
+    def delete(self, key):
+        """
+        Removes the value stored under the key (if there is one).
+
+        :param key: The key.
+        :return: True if there was a value to remove, otherwise False
+        """
+
+    @abstractmethod
+    def clear(self):
+        """
+        Removes all entries.
+        """
+
+
+class MemoryExpiringStore(ExpiringStore):
+    """
+    Stores the entries in memory, so they're only available to a single process and
+    are lost on restart. Expired entries are evicted in bulk on each write, using a
+    heap ordered by expiry time, so memory use doesn't grow forever.
+    """
+
+    def __init__(self):
+        # key -> (value, expiry time)
+        self.entries = {}
+        # (expiry time, key) for every write; replaced entries are left in the heap and
+        # skipped when they're popped
+        self.expiry_heap = []
+        self.lock = threading.Lock()
+
+    def _evict(self, now):
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            expires, key = heapq.heappop(self.expiry_heap)
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] == expires:
+                del self.entries[key]
+
+    def _live(self, key, now):
+        entry = self.entries.get(key)
+        return entry is not None and entry[1] > now
+
+    def _set(self, key, value, ttl, now):
+        self._evict(now)
+        expires = now + ttl
+        self.entries[key] = (value, expires)
+        heapq.heappush(self.expiry_heap, (expires, key))
+
+    def get(self, key):
+        # reads don't take the lock; an expired entry is just ignored until it's evicted
+        entry = self.entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            self.delete(key)
+            return
+        with self.lock:
+            self._set(key, value, ttl, time.monotonic())
+
+    def add(self, key, value, ttl):
+        now = time.monotonic()
+        with self.lock:
+            if self._live(key, now):
+                return False
+            if ttl > 0:
+                self._set(key, value, ttl, now)
+            return True
+
+    def delete(self, key):
+        # nearly every lookup misses when the store is empty, so skip the lock then
+        if not self.entries:
+            return False
+        now = time.monotonic()
+        with self.lock:
+            live = self._live(key, now)
+            self.entries.pop(key, None)
+            return live
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.expiry_heap.clear()
+
+
+class RedisExpiringStore(ExpiringStore):
+    """
+    Stores the entries in the redis instance CKAN is configured to use, so they can be
+    shared by all the processes and servers. Entries expire from redis after their TTL.
+    """
+
+    def __init__(self, key_prefix, connection=None):
+        """
+        :param key_prefix: The prefix added to every key, which must be unique to the
+                           store.
+        :param connection: A redis connection; if not provided, CKAN's is used.
+        """
+        self.key_prefix = key_prefix
+        self.redis = connection or connect_to_redis()
+
+    def _key(self, key):
+        return f'{self.key_prefix}{key}'
+
+    def get(self, key):
+        value = self.redis.get(self._key(key))
+        return json.loads(value) if value is not None else None
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        values = self.redis.mget([self._key(key) for key in keys])
+        return [json.loads(value) if value is not None else None for value in values]
+
+    def set(self, key, value, ttl):
+        if ttl <= 0:
+            self.delete(key)
+            return
+        self.redis.set(self._key(key), json.dumps(value), px=max(1, int(ttl * 1000)))
+
+    def add(self, key, value, ttl):
+        if ttl <= 0:
+            return not self.redis.exists(self._key(key))
+        return bool(
+            self.redis.set(
+                self._key(key), json.dumps(value), nx=True, px=max(1, int(ttl * 1000))
+            )
+        )
+
+    def delete(self, key):
+        # delete returns the number of keys removed, so this is atomic
+        return bool(self.redis.delete(self._key(key)))
+
+    def clear(self):
+        keys = list(self.redis.scan_iter(f'{self.key_prefix}*'))
+        if keys:
+            self.redis.delete(*keys)
+
+
+def create_expiring_store(store_type, key_prefix):
+    """
+    Creates an expiring store of the given type.
+
+    :param store_type: memory or redis.
+    :param key_prefix: The prefix for the store's keys in redis.
+    :return: ExpiringStore
+    """
+    if store_type == 'memory':
+        return MemoryExpiringStore()
+    if store_type == 'redis':
+        return RedisExpiringStore(key_prefix)
+    raise ValueError(f'Unknown expiring store type: {store_type}')
+
+
+class ConfiguredStore:
+    """
+    Holds a store created from the config, creating it on first use. The plugin calls
+    configure again whenever the config is reloaded.
+    """
+
+    def __init__(self, factory):
+        """
+        :param factory: A function that takes no arguments and creates the store from
+                        the current config (it may return None).
+        """
+        self.factory = factory
+        self.store = None
+        self.configured = False
+
+    def configure(self):
+        """
+        Creates the store, replacing any existing store.
+
+        :return: the store
+        """
+        self.store = self.factory()
+        self.configured = True
+        return self.store
+
+    def get(self):
+        """
+        Gets the store, creating it if it hasn't been configured yet.
+
+        :return: the store
+        """
+        if not self.configured:
+            return self.configure()
+        return self.store
+
+
+class RestPeriodStore(ABC):
+    """
+    Base class for stores that record when each package was last tweeted about. The
+    times are POSIX timestamps (i.e. from time.time()) so that they can be shared
+    between processes and servers.
+    """
+
+    # whether the entries are only visible to the process that made them
+    process_local = False
+
+    @abstractmethod
+    def get(self, pkg_id):
+        """
+        Gets the time the package was last tweeted about.
+
+        :param pkg_id: The package ID.
+        :return: float, or None if the package hasn't been tweeted about
+        """
+
+    @abstractmethod
+    def set(self, pkg_id, timestamp, rest_period):
+        """
+        Records the time the package was tweeted about, replacing any existing entry.
+
+        :param pkg_id: The package ID.
+        :param timestamp: The time of the tweet.
+        :param rest_period: The rest period in seconds (some stores use this to expire
+                            the entry).
+        """
+
+    @abstractmethod
+    def claim(self, pkg_id, timestamp, rest_period):
+        """
+        Atomically records the time the package was tweeted about, but only if it
+        hasn't already been tweeted about within the rest period. When several
+        processes try to claim the same package at once, only one of them will succeed.
+
+        :param pkg_id: The package ID.
+        :param timestamp: The time of the tweet.
+        :param rest_period: The rest period in seconds.
+        :return: True if the package was claimed, False if it's still resting
+        """
+
+    @abstractmethod
+    def eligible(self, pkg_ids, timestamp, rest_period):
+        """
+        Finds which of the given packages are outside their rest period, i.e. could be
+        tweeted about, using a single lookup.
+
+        :param pkg_ids: The package IDs to check.
+        :param timestamp: The time to check against (usually now).
+        :param rest_period: The rest period in seconds.
+        :return: set of package IDs
+        """
+
+    @abstractmethod
+    def remove(self, pkg_id):
+        """
+        Removes the entry for the package (if there is one).
+
+        :param pkg_id: The package ID.
+        """
+
+    @abstractmethod
+    def clear(self):
+        """
+        Removes all entries.
+        """
+
+
+class ExpiringRestPeriodStore(RestPeriodStore):
+    """
+    Stores the times in an expiring store, each entry expiring when its rest period
+    ends.
+    """
+
+    def __init__(self, entries):
+        """
+        :param entries: The ExpiringStore to keep the times in.
+        """
+        self.entries = entries
+
+    def get(self, pkg_id):
+        return self.entries.get(pkg_id)
+
+    def set(self, pkg_id, timestamp, rest_period):
+        self.entries.set(pkg_id, timestamp, timestamp + rest_period - time.time())
+
+    def claim(self, pkg_id, timestamp, rest_period):
+        # the entry only exists during the rest period, so if it can be added it's free
+        return self.entries.add(
+            pkg_id, timestamp, timestamp + rest_period - time.time()
+        )
+
+    def eligible(self, pkg_ids, timestamp, rest_period):
+        pkg_ids = list(pkg_ids)
+        return {
+            pkg_id
+            for pkg_id, last_tweeted in zip(pkg_ids, self.entries.get_many(pkg_ids))
+            if last_tweeted is None or timestamp - last_tweeted > rest_period
+        }
+
+    def remove(self, pkg_id):
+        self.entries.delete(pkg_id)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class MemoryStore(ExpiringRestPeriodStore):
+    """
+    Stores the times in memory. This is only suitable for a single process, and the
+    times are lost on restart.
+    """
+
+    process_local = True
+
+    def __init__(self):
+        super().__init__(MemoryExpiringStore())
+
+
+class FileStore(RestPeriodStore):
+    """
+    Stores the times in a JSON file, using a lock file so that it can be shared by all
+    the processes on a server.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The path of the JSON file.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    @contextmanager
+    def _locked(self, exclusive):
+        with open(f'{self.path}.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write(self, entries, timestamp=None, rest_period=None):
+        if rest_period is not None:
+            # drop any entries whose rest period is over
+            cutoff = timestamp - rest_period
+            entries = {k: v for k, v in entries.items() if v >= cutoff}
+        # write to a temporary file first so that the file is never half written
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self.path)
+
+    def get(self, pkg_id):
+        with self._locked(exclusive=False):
+            return self._read().get(pkg_id)
+
+    def set(self, pkg_id, timestamp, rest_period):
+        with self._locked(exclusive=True):
+            entries = self._read()
+            entries[pkg_id] = timestamp
+            self._write(entries, time.time(), rest_period)
+
+    def claim(self, pkg_id, timestamp, rest_period):
+        with self._locked(exclusive=True):
+            entries = self._read()
+            last_tweeted = entries.get(pkg_id)
+            if last_tweeted is not None and timestamp - last_tweeted <= rest_period:
+                return False
+            entries[pkg_id] = timestamp
+            self._write(entries, timestamp, rest_period)
+            return True
+
+    def eligible(self, pkg_ids, timestamp, rest_period):
+        with self._locked(exclusive=False):
+            entries = self._read()
+        eligible = set()
+        for pkg_id in pkg_ids:
+            last_tweeted = entries.get(pkg_id)
+            if last_tweeted is None or timestamp - last_tweeted > rest_period:
+                eligible.add(pkg_id)
+        return eligible
+
+    def remove(self, pkg_id):
+        with self._locked(exclusive=True):
+            entries = self._read()
+            if entries.pop(pkg_id, None) is not None:
+                self._write(entries)
+
+    def clear(self):
+        with self._locked(exclusive=True):
+            self._write({})
+
+
+class RedisStore(ExpiringRestPeriodStore):
+    """
+    Stores the times in the redis instance CKAN is configured to use.
+    """
+
+    key_prefix = 'ckanext-twitter:last-tweeted:'
+
+    def __init__(self, connection=None):
+        """
+        :param connection: A redis connection; if not provided, CKAN's is used.
+        """
+        super().__init__(RedisExpiringStore(self.key_prefix, connection))
+
+
+class DatabaseStore(RestPeriodStore):
+    """
+    Stores the times in a table in CKAN's database, which must be created first with
+    the twitter initdb command. Each operation uses its own transaction so that it
+    doesn't interfere with the current request's session.
+    """
+
+    def _begin(self):
+        return model.meta.engine.begin()
+
+    def get(self, pkg_id):
+        query = last_tweeted_table.select().where(
+            last_tweeted_table.c.package_id == pkg_id
+        )
+        with self._begin() as connection:
+            row = connection.execute(query).first()
+        return row.tweeted_at if row is not None else None
+
+    def set(self, pkg_id, timestamp, rest_period):
+        statement = insert(last_tweeted_table).values(
+            package_id=pkg_id, tweeted_at=timestamp
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[last_tweeted_table.c.package_id],
+            set_={'tweeted_at': statement.excluded.tweeted_at},
+        )
+        with self._begin() as connection:
+            connection.execute(statement)
+
+    def claim(self, pkg_id, timestamp, rest_period):
+        statement = insert(last_tweeted_table).values(
+            package_id=pkg_id, tweeted_at=timestamp
+        )
+        # only overwrite the existing entry if its rest period is over
+        statement = statement.on_conflict_do_update(
+            index_elements=[last_tweeted_table.c.package_id],
+            set_={'tweeted_at': statement.excluded.tweeted_at},
+            where=last_tweeted_table.c.tweeted_at < timestamp - rest_period,
+        ).returning(last_tweeted_table.c.package_id)
+        # entries whose rest period is over are no use, so they're removed as we go
+        prune = last_tweeted_table.delete().where(
+            last_tweeted_table.c.tweeted_at < timestamp - rest_period
+        )
+        with self._begin() as connection:
+            claimed = connection.execute(statement).first() is not None
+            connection.execute(prune)
+        return claimed
+
+    def eligible(self, pkg_ids, timestamp, rest_period):
+        pkg_ids = set(pkg_ids)
+        if not pkg_ids:
+            return set()
+        query = select(last_tweeted_table.c.package_id).where(
+            and_(
+                last_tweeted_table.c.package_id.in_(pkg_ids),
+                last_tweeted_table.c.tweeted_at >= timestamp - rest_period,
+            )
+        )
+        with self._begin() as connection:
+            resting = {row.package_id for row in connection.execute(query)}
+        return pkg_ids - resting
+
+    def remove(self, pkg_id):
+        statement = last_tweeted_table.delete().where(
+            last_tweeted_table.c.package_id == pkg_id
+        )
+        with self._begin() as connection:
+            connection.execute(statement)
+
+    def clear(self):
+        with self._begin() as connection:
+            connection.execute(last_tweeted_table.delete())
+
+
+def create_tables():
+    """
+    Creates the extension's database tables, if they don't already exist.
+    """
+    metadata.create_all(model.meta.engine, checkfirst=True)
+
+
+def create_store(store_type):
+    """
+    Creates a store of the given type.
+
+    :param store_type: memory, file, redis or database.
+    :return: RestPeriodStore
+    """
+    if store_type == 'memory':
+        return MemoryStore()
+    if store_type == 'file':
+        return FileStore(config_helpers.twitter_store_path())
+    if store_type == 'redis':
+        return RedisStore()
+    if store_type == 'database':
+        return DatabaseStore()
+    raise ValueError(f'Unknown ckanext.twitter.store type: {store_type}')
+
+
+_store = ConfiguredStore(lambda: create_store(config_helpers.twitter_store()))
+
+
+def configure_store():
+    """
+    Creates the store defined in the config, replacing any existing store.
+
+    :return: RestPeriodStore
+    """
+    return _store.configure()
+
+
+def get_store():
+    """
+    Gets the configured store, creating it if it hasn't been configured yet.
+
+    :return: RestPeriodStore
+    """
+    return _store.get()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+import re
+from bisect import bisect_right
+
+# twitter counts most characters (e.g. CJK characters and emoji) as two towards the
+# length limit; only the code points in these (inclusive) ranges, which cover Latin,
+# Greek, Cyrillic, Hebrew, Arabic etc. and some punctuation, count as one
+light_ranges = [
+    (0x0000, 0x10FF),
+    (0x2000, 0x200D),
+    (0x2010, 0x201F),
+    (0x2032, 0x2037),
+]
+_light_starts = [start for start, end in light_ranges]
+_light_ends = [end for start, end in light_ranges]
+
+light_weight = 1
+heavy_weight = 2
+
+# every URL counts as this many characters, however long it is, because twitter
+# shortens them all
+url_length = 23
+
+url_rgx = re.compile(r'https?://[^\s<>"]+', re.IGNORECASE)
+
+# str.isascii is only available from python 3.7
+non_ascii_rgx = re.compile(r'[^\x00-\x7f]')
+
+
+def char_weight(char):
+    """
+    Gets the number of characters that twitter counts the given character as.
+
+    :param char: A single character.
+    :return: int
+    """
+    code_point = ord(char)
+    i = bisect_right(_light_starts, code_point) - 1
+    return light_weight if i >= 0 and code_point <= _light_ends[i] else heavy_weight
+
+
+def _text_length(text):
+    # almost all of our text is ASCII, which is all light, so skip the lookups
+    if not non_ascii_rgx.search(text):
+        return len(text)
+    return sum(char_weight(char) for char in text)
+
+
+def _segments(text):
+    """
+    Splits the text into plain text and URLs.
+
+    :param text: The text.
+    :return: generator of (segment, is_url) tuples
+    """
+    position = 0
+    for match in url_rgx.finditer(text):
+        if match.start() > position:
+            yield text[position : match.start()], False
+        yield match.group(), True
+        position = match.end()
+    if position < len(text):
+        yield text[position:], False
+
+
+def weighted_length(text):
+    """
+    Gets the length of the text as twitter counts it: URLs count as 23 characters and
+    characters outside the ranges above (e.g. CJK characters and emoji) count as two.
+
+    :param text: The text.
+    :return: int
+    """
+    if 'http' not in text and 'HTTP' not in text:
+        return _text_length(text)
+    return sum(
+        url_length if is_url else _text_length(segment)
+        for segment, is_url in _segments(text)
+    )
+
+
+def truncate(text, limit):
+    """
+    Cuts the text down so that its weighted length is no more than the limit. URLs are
+    never cut in half; if a URL doesn't fit, the text is cut before it.
+
+    :param text: The text.
+    :param limit: The maximum weighted length.
+    :return: str
+    """
+    if weighted_length(text) <= limit:
+        return text
+    kept = []
+    length = 0
+    for segment, is_url in _segments(text):
+        if is_url:
+            if length + url_length > limit:
+                break
+            kept.append(segment)
+            length += url_length
+            continue
+        segment_length = _text_length(segment)
+        if length + segment_length <= limit:
+            kept.append(segment)
+            length += segment_length
+            continue
+        # find where in this segment the limit is reached
+        for i, char in enumerate(segment):
+            length += char_weight(char)
+            if length > limit:
+                kept.append(segment[:i])
+                break
+        break
+    return ''.join(kept)
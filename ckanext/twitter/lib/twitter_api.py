@@ -5,80 +5,159 @@
 # Created by the Natural History Museum in London, UK
 
 import logging
-from contextlib import suppress
+import threading
+import time
 
-import oauth2
+from urllib3.exceptions import HTTPError
 
-from ckanext.twitter.lib import cache_helpers, config_helpers
+from ckanext.twitter.lib import cache_helpers, config_helpers, metrics, scheduler
+from ckanext.twitter.lib.client import TwitterClient
 
 logger = logging.getLogger('ckanext.twitter')
 
+# the credentials that were last verified successfully and when (from time.monotonic)
+_authenticated = None
+
+_client = None
+_client_lock = threading.Lock()
+
 
-@cache_helpers.cache_manager.cache('twitter', 'client')
 def twitter_client():
     """
     Attempts to create a client for accessing the twitter API using the credentials
-    specified in the configuration file. Does not test for success. Caches the resulting
-    client in the 'twitter' cache.
+    specified in the configuration file. Does not test for success. The client is
+    shared by all threads in the process until reset_client is called.
 
-    :return: oauth2.Client
+    :return: TwitterClient
     """
+    global _client
     logger.info('ckanext-twitter has been deprecated; please consider removing it')
 
-    (
-        consumer_key,
-        consumer_secret,
-        token_key,
-        token_secret,
-    ) = config_helpers.twitter_get_credentials()
-    consumer = oauth2.Consumer(consumer_key, consumer_secret)
-    token = oauth2.Token(token_key, token_secret)
-    client = oauth2.Client(consumer, token)
-    return client
+    with _client_lock:
+        if _client is None:
+            _client = TwitterClient(
+                *config_helpers.twitter_get_credentials(),
+                **config_helpers.twitter_http_options(),
+            )
+        return _client
+
+
+def reset_client():
+    """
+    Closes and discards the shared client, so that a new one is created next time.
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+
+
+def twitter_credentials_set():
+    """
+    Checks that none of the credentials are still set to their placeholder defaults.
+    This doesn't need to make any requests, so it's checked before trying to connect.
+
+    :return: boolean
+    """
+    return not any(
+        c.startswith('no-') and c.endswith('-set')
+        for c in config_helpers.twitter_get_credentials()
+    )
 
 
-def twitter_authenticate():
+def reset_authentication():
     """
-    Verifies that the client is able to connect to the twitter API.
+    Forgets any cached authentication result, so that the credentials are verified
+    again the next time twitter_authenticate is called.
+    """
+    global _authenticated
+    _authenticated = None
+
+
+@metrics.timed('twitter_authenticate')
+def twitter_authenticate(force=False):
+    """
+    Verifies that the client is able to connect to the twitter API. A successful
+    verification is cached for the number of seconds set in the config so that it
+    doesn't have to be repeated before every post.
 
     Refreshes any unauthenticated cached client.
+    :param force: If True, verify the credentials even if there's a cached result.
     :return: boolean
     """
+    global _authenticated
     logger.info('ckanext-twitter has been deprecated; please consider removing it')
 
-    authenticated = False
-    while not authenticated:
-        client = twitter_client()
-        url = 'https://api.twitter.com/1.1/account/verify_credentials.json'
-        response, content = client.request(url, 'GET')
-        authenticated = response.status == 200
-        if not authenticated:
-            # if the client isn't in the cache we don't care
-            with suppress(KeyError):
-                cache_helpers.cache_manager.invalidate(twitter_client)
-            break
-    if authenticated:
-        if any(
-            [
-                c.startswith('no-') and c.endswith('-set')
-                for c in config_helpers.twitter_get_credentials()
-            ]
+    # no point making a request if the credentials haven't been set
+    if not twitter_credentials_set():
+        return False
+
+    credentials = config_helpers.twitter_get_credentials()
+    if not force and _authenticated is not None:
+        authenticated_credentials, authenticated_at = _authenticated
+        age = time.monotonic() - authenticated_at
+        if (
+            authenticated_credentials == credentials
+            and age < config_helpers.twitter_auth_ttl()
         ):
-            authenticated = False
-    return authenticated
+            metrics.incr('auth_cache.hit')
+            return True
+    metrics.incr('auth_cache.miss')
 
+    client = twitter_client()
+    url = f'{config_helpers.twitter_api_url()}/account/verify_credentials.json'
+    try:
+        with metrics.timer('http.verify_credentials'):
+            response, content = client.request(url, 'GET')
+    except HTTPError as e:
+        logger.warning(f'Could not connect to twitter: {e}')
+        return False
+    if response.status == 200:
+        _authenticated = (credentials, time.monotonic())
+        return True
 
-def post_tweet(tweet_text, pkg_id):
+    reset_authentication()
+    reset_client()
+    return False
+
+
+def release(pkg_id):
+    """
+    Releases the claim on a package after a post fails, so that it can be tweeted about
+    again.
+
+    :param pkg_id: The package ID (or None).
+    """
+    if pkg_id is not None:
+        cache_helpers.remove_from_cache(pkg_id)
+
+
+@metrics.timed('post_tweet')
+def post_tweet(tweet_text, pkg_id, priority=scheduler.INTERACTIVE):
     """
     Attempts to post the tweet. Returns a boolean success variable and a message
-    describing the reason for the failure/success in posting the tweet.
+    describing the reason for the failure/success in posting the tweet. If the rate
+    limit has been reached, the tweet is held and posted once it resets, and the reason
+    is scheduler.HELD.
 
     :param tweet_text: The text to post. This is passed in rather than
     generated inside the method to allow users to change the tweet before
     posting (if enabled).
-    :param pkg_id: The package ID (for caching).
+    :param pkg_id: The package ID (for caching). If None, the tweet isn't about a single
+    package (e.g. it's a digest) and the rest period doesn't apply.
+    :param priority: How urgent the tweet is if it has to be held (see scheduler).
     :return: boolean, str
     """
+    posted, reason = _post_tweet(tweet_text, pkg_id, priority)
+    metrics.incr(f'post.{metrics.metric_name(reason)}')
+    return posted, reason
+
+
+def _post_tweet(tweet_text, pkg_id, priority):
+    """
+    Does the work of post_tweet (which records the outcome).
+    """
     logger.info('ckanext-twitter has been deprecated; please consider removing it')
 
     if config_helpers.twitter_is_debug():
@@ -86,7 +165,7 @@ def post_tweet(tweet_text, pkg_id):
         return False, 'debug'
 
     # if not enough time has passed since the last tweet
-    if not cache_helpers.expired(pkg_id):
+    if pkg_id is not None and not cache_helpers.expired(pkg_id):
         logger.debug(f'Not posted (insufficient rest period): {tweet_text}')
         return False, 'insufficient rest period'
 
@@ -95,16 +174,39 @@ def post_tweet(tweet_text, pkg_id):
         logger.debug(f'Not posted (not authenticated): {tweet_text}')
         return False, 'not authenticated'
 
+    # don't waste a request that's certain to fail
+    if not scheduler.rate_limit.acquire():
+        scheduler.hold(tweet_text, pkg_id, priority)
+        return False, scheduler.HELD
+
+    # claim the package so that no other request (or process) can tweet about it at
+    # the same time
+    if pkg_id is not None and not cache_helpers.claim(pkg_id):
+        logger.debug(f'Not posted (insufficient rest period): {tweet_text}')
+        return False, 'insufficient rest period'
+
     # try to actually post
     client = twitter_client()
-    url = 'https://api.twitter.com/1.1/statuses/update.json'
-    params = {'status': tweet_text}
-    request = oauth2.Request(method='POST', url=url, parameters=params)
-    postdata = request.to_postdata()
-    response, content = client.request(url, 'POST', postdata)
+    url = f'{config_helpers.twitter_api_url()}/statuses/update.json'
+    try:
+        with metrics.timer('http.statuses_update'):
+            response, content = client.request(url, 'POST', {'status': tweet_text})
+    except HTTPError as e:
+        release(pkg_id)
+        logger.debug(f'Not posted (connection error: {e}): {tweet_text}')
+        return False, 'connection error'
+    scheduler.rate_limit.update(response.headers, response.status)
     if response.status == 200:
-        cache_helpers.cache(pkg_id)
         logger.debug(f'Posted successfully: {tweet_text}')
-    else:
-        logger.debug(f'Not posted (tweet unsuccessful): {tweet_text}')
-    return response.status == 200, f'{response.status} {response.reason}'
+        return True, f'{response.status} {response.reason}'
+
+    release(pkg_id)
+    if response.status == 429:
+        scheduler.hold(tweet_text, pkg_id, priority)
+        return False, scheduler.HELD
+    if response.status in (401, 403) and not twitter_authenticate(force=True):
+        # the cached authentication was out of date
+        logger.debug(f'Not posted (not authenticated): {tweet_text}')
+        return False, 'not authenticated'
+    logger.debug(f'Not posted (tweet unsuccessful): {tweet_text}')
+    return False, f'{response.status} {response.reason}'
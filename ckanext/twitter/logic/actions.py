@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+from ckan.plugins import toolkit
+
+from ckanext.twitter.lib import cache_helpers
+
+
+def _forget_record_count(data_dict):
+    """
+    Clears the cached record count for the resource referenced in the data dict.
+
+    :param data_dict: A datastore action's data dict or result.
+    """
+    resource_id = data_dict.get('resource_id') or data_dict.get('id')
+    if resource_id:
+        cache_helpers.forget_record_count(resource_id)
+
+
+@toolkit.chained_action
+def datastore_create(original_action, context, data_dict):
+    """
+    Clears the cached record count for the resource after its datastore table is
+    created or added to.
+    """
+    result = original_action(context, data_dict)
+    _forget_record_count(result)
+    return result
+
+
+@toolkit.chained_action
+def datastore_upsert(original_action, context, data_dict):
+    """
+    Clears the cached record count for the resource after records are upserted.
+    """
+    result = original_action(context, data_dict)
+    _forget_record_count(data_dict)
+    return result
+
+
+@toolkit.chained_action
+def datastore_delete(original_action, context, data_dict):
+    """
+    Clears the cached record count for the resource after records are deleted.
+    """
+    result = original_action(context, data_dict)
+    _forget_record_count(data_dict)
+    return result
+
+
+@toolkit.chained_action
+def datastore_records_delete(original_action, context, data_dict):
+    """
+    Clears the cached record count for the resource after records are deleted.
+    """
+    result = original_action(context, data_dict)
+    _forget_record_count(data_dict)
+    return result
@@ -4,13 +4,39 @@
 # This file is part of ckanext-twitter
 # Created by the Natural History Museum in London, UK
 
-from beaker.cache import cache_regions
+import flask
 from ckan.common import session
 from ckan.plugins import SingletonPlugin, implements, interfaces, toolkit
 
-import ckanext.twitter.lib.config_helpers
-from ckanext.twitter import routes
-from ckanext.twitter.lib import config_helpers, helpers as twitter_helpers
+from ckanext.twitter import cli, routes
+from ckanext.twitter.logic import actions
+from ckanext.twitter.lib import (
+    cache_helpers,
+    config_helpers,
+    dedupe,
+    digest,
+    helpers as twitter_helpers,
+    jobs,
+    metrics,
+    prompts,
+    stores,
+    twitter_api,
+)
+
+
+def configure_components():
+    """
+    Sets up everything built from the config. This is called whenever the config is
+    (re)loaded.
+    """
+    # set up the store for the times each package was last tweeted about
+    stores.configure_store()
+    metrics.configure_metrics()
+    prompts.configure_store()
+    dedupe.configure_store()
+    cache_helpers.configure_record_counts()
+    # the API client holds the credentials and connection options
+    twitter_api.reset_client()
 
 
 class TwitterPlugin(SingletonPlugin):
@@ -23,19 +49,14 @@ class TwitterPlugin(SingletonPlugin):
     implements(interfaces.IPackageController, inherit=True)
     implements(interfaces.ITemplateHelpers, inherit=True)
     implements(interfaces.IBlueprint, inherit=True)
+    implements(interfaces.IActions)
+    implements(interfaces.IClick)
 
     # IConfigurable
     def configure(self, config):
-        cache_regions.update(
-            {
-                'twitter': {
-                    'expire': ckanext.twitter.lib.config_helpers.twitter_hours_between_tweets(),
-                    'type': 'memory',
-                    'enabled': True,
-                    'key_length': 250,
-                }
-            }
-        )
+        config_helpers.on_reload(configure_components)
+        # parse and check every option now so that bad values stop CKAN starting
+        config_helpers.reload_config(config)
 
     # IConfigurer
     def update_config(self, config):
@@ -45,11 +66,36 @@ class TwitterPlugin(SingletonPlugin):
         toolkit.add_resource('theme/assets', 'ckanext-twitter')
 
     # IPackageController
+    @metrics.timed('after_update')
     def after_update(self, context, pkg_dict):
+        # updates that can't show the prompt don't need checking unless they're being
+        # collected for a digest
+        if not twitter_helpers.is_interactive(context):
+            if config_helpers.twitter_digest() and twitter_helpers.twitter_pkg_suitable(
+                context, pkg_dict['id']
+            ):
+                started = digest.record(pkg_dict)
+                if started is not None:
+                    # this update started a new window, so post the digest once it has
+                    # passed (in a job, rather than in the middle of this update)
+                    digest.enqueue_flush(started)
+            return
+        # the package has just changed so any copy fetched earlier in this request is
+        # out of date
+        cache_helpers.forget_package(pkg_dict['id'])
         is_suitable = twitter_helpers.twitter_pkg_suitable(context, pkg_dict['id'])
         if is_suitable:
-            session.setdefault('twitter_is_suitable', pkg_dict['id'])
-            session.save()
+            store = prompts.get_store()
+            if store is not None:
+                store.add(prompts.current_user(context), pkg_dict['id'])
+            elif flask.has_request_context():
+                # without a request (e.g. in a background job) there's no session to
+                # keep the prompt in
+                session.setdefault('twitter_is_suitable', pkg_dict['id'])
+                session.save()
+            if config_helpers.twitter_precompute():
+                # start generating the text now so it's ready when the page loads
+                jobs.enqueue_precompute(pkg_dict['id'])
 
     # ITemplateHelpers
     def get_helpers(self):
@@ -58,8 +104,32 @@ class TwitterPlugin(SingletonPlugin):
             'tweet_ready': js_helpers.tweet_ready,
             'get_tweet': js_helpers.get_tweet,
             'disable_edit': config_helpers.twitter_disable_edit,
+            'tweet_deferred': config_helpers.twitter_deferred,
+            'tweet_limit': config_helpers.twitter_tweet_limit,
         }
 
     ## IBlueprint
     def get_blueprint(self):
         return routes.blueprints
+
+    # IActions
+    def get_actions(self):
+        # the record count cache only needs clearing when the datastore is in use (and
+        # chaining actions that don't exist is an error)
+        if not toolkit.plugin_loaded('datastore'):
+            return {}
+        from ckanext.datastore.logic import action as datastore_actions
+
+        chained = {
+            'datastore_create': actions.datastore_create,
+            'datastore_upsert': actions.datastore_upsert,
+            'datastore_delete': actions.datastore_delete,
+        }
+        # only added in CKAN 2.10
+        if hasattr(datastore_actions, 'datastore_records_delete'):
+            chained['datastore_records_delete'] = actions.datastore_records_delete
+        return chained
+
+    # IClick
+    def get_commands(self):
+        return cli.get_commands()
@@ -6,44 +6,185 @@
 
 import json
 
+from ckan import model
 from ckan.common import session
 from ckan.plugins import toolkit
-from flask import Blueprint
+from flask import Blueprint, make_response
+from werkzeug.http import is_resource_modified
 
-from ckanext.twitter.lib import cache_helpers, twitter_api
+from ckanext.twitter.lib import (
+    cache_helpers,
+    config_helpers,
+    dedupe,
+    helpers as twitter_helpers,
+    jobs,
+    metrics,
+    parsers as twitter_parsers,
+    prompts,
+    twitter_api,
+)
 
 blueprint = Blueprint(name='tweet', import_name=__name__)
 
+# log the per-request metrics summary (if it's turned on) after every request, not just
+# the ones handled by this blueprint
+blueprint.after_app_request(metrics.log_request_summary)
+
 
 @blueprint.route('/dataset/<package_id>/tweet', methods=['POST'])
 def send(package_id):
     """
     Posts the tweet given in the request body. The package ID is required for caching.
-    Returns json data for displaying success/error messages.
+    Returns json data for displaying success/error messages. If tweets are posted
+    asynchronously, the tweet is queued and the json data includes the job ID, which
+    can be passed to the status endpoint to find out what happened. Duplicate requests
+    to post the same tweet get the first request's result instead of posting it again,
+    or, if it doesn't have one yet, are told straight away that it's being posted.
 
     :param package_id: The package ID (for caching).
     :return: str
     """
+    denied = _check_update_access(package_id)
+    if denied is not None:
+        return denied
     body = toolkit.request.values
     text = body.get('tweet_text', None)
-    if text:
-        posted, reason = twitter_api.post_tweet(text, package_id)
-    else:
-        posted = False
-        reason = 'no tweet defined'
-    return json.dumps(
-        {
-            'success': posted,
-            'reason': reason,
-            'tweet': text if text else 'tweet not defined',
+    if not text:
+        return json.dumps(
+            {
+                'success': False,
+                'reason': 'no tweet defined',
+                'tweet': 'tweet not defined',
+            }
+        )
+    # duplicate requests (e.g. from a retrying proxy) get the result of the first
+    # request rather than posting again
+    result = dedupe.run(text, package_id, lambda: _send(text, package_id))
+    if result is None:
+        result = {
+            'success': False,
+            'reason': 'already being posted',
+            'pending': True,
+            'tweet': text,
         }
-    )
+    return json.dumps(result)
+
+
+def _send(text, package_id):
+    """
+    Posts (or queues) the tweet.
+
+    :param text: The tweet text.
+    :param package_id: The package ID.
+    :return: dict
+    """
+    if config_helpers.twitter_async():
+        job_id = jobs.enqueue_tweet(text, package_id)
+        return {'success': False, 'reason': 'queued', 'job_id': job_id, 'tweet': text}
+    posted, reason = twitter_api.post_tweet(text, package_id)
+    return jobs.tweet_result(text, posted, reason)
+
+
+@blueprint.route('/dataset/<package_id>/tweet/<job_id>', methods=['GET'])
+def status(package_id, job_id):
+    """
+    Gets the status of a queued tweet. Returns json data including the job's status
+    and, once the job has finished, whether the tweet was posted.
+
+    :param package_id: The package ID.
+    :param job_id: The job ID returned when the tweet was queued.
+    :return: str
+    """
+    denied = _check_update_access(package_id)
+    if denied is not None:
+        return denied
+    return json.dumps(jobs.get_job_status(job_id, package_id))
+
+
+def _check_update_access(package_id):
+    """
+    Checks that the current user can update the package, as only they are offered the
+    chance to tweet about it.
+
+    :param package_id: The package ID.
+    :return: an error response, or None if the user has access
+    """
+    try:
+        toolkit.check_access(
+            'package_update', {'user': prompts.current_user()}, {'id': package_id}
+        )
+    except toolkit.ObjectNotFound:
+        return _json_response({'success': False, 'reason': 'not found'}, 404)
+    except toolkit.NotAuthorized:
+        return _json_response({'success': False, 'reason': 'not authorised'}, 403)
+    return None
+
+
+@blueprint.route('/dataset/<package_id>/tweet-preview', methods=['GET'])
+def preview(package_id):
+    """
+    Generates the tweet text for the package without posting it. The response has an
+    ETag and Last-Modified date based on the package's metadata_modified, so if the
+    browser already has the current text the tweet isn't generated again and a 304 is
+    returned instead. Text generated in advance by a background job is used if it's
+    still current.
+
+    :param package_id: The package ID or name.
+    :return: json response
+    """
+    package = model.Package.get(package_id)
+    if package is None:
+        return _json_response({'success': False, 'reason': 'not found'}, 404)
+    try:
+        toolkit.check_access('package_show', {}, {'id': package.id})
+    except toolkit.NotAuthorized:
+        return _json_response({'success': False, 'reason': 'not authorised'}, 403)
+
+    etag = twitter_helpers.tweet_version(package)
+    last_modified = package.metadata_modified
+    if not is_resource_modified(
+        toolkit.request.environ, etag=etag, last_modified=last_modified
+    ):
+        response = make_response('', 304)
+    else:
+        precomputed = cache_helpers.get_precomputed_tweet(package.id, etag)
+        if precomputed is not None:
+            is_new = precomputed['is_new']
+            text = precomputed['tweet']
+        else:
+            is_new = twitter_helpers.package_is_new({}, package.id)
+            text = twitter_parsers.generate_tweet({}, package.id, is_new)
+        response = _json_response(
+            {
+                'success': text is not None,
+                'package_id': package.id,
+                'metadata_modified': last_modified.isoformat(),
+                'is_new': is_new,
+                'tweet': text,
+            }
+        )
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # the text depends on who's asking (private packages etc.) so it mustn't be shared,
+    # and it should always be revalidated as it changes when the package does
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def _json_response(data, status=200):
+    response = make_response(json.dumps(data), status)
+    response.content_type = 'application/json'
+    return response
 
 
 @blueprint.route('/dataset/<package_id>/tweet-clear', methods=['POST'])
 def clear(package_id):
     cache_helpers.remove_from_cache(package_id)
-    if 'twitter_is_suitable' in session:
+    store = prompts.get_store()
+    if store is not None:
+        store.remove(prompts.current_user(), package_id)
+    elif 'twitter_is_suitable' in session:
         del session['twitter_is_suitable']
         session.save()
     return ''
@@ -5,6 +5,7 @@ ckan.module('confirm-tweet', function ($, _) {
     initialize: function () {
       self = this;
       self.options.disable_edit = self.options.disable_edit === 'True';
+      self.options.deferred = String(self.options.deferred) === 'true';
       self.sandbox.client.getTemplate(
         'edit_tweet.html',
         self.options,
@@ -19,36 +20,17 @@ ckan.module('confirm-tweet', function ($, _) {
       var form = self.block.find('#edit-tweet-form');
       form.submit(function (e) {
         e.preventDefault();
+        // stop double clicks sending the tweet twice
+        var saveButton = form.find('#edit-tweet-save');
+        if (saveButton.prop('disabled')) {
+          return;
+        }
+        saveButton.prop('disabled', true);
 
-        $.post(
-          sendUrl,
-          form.serialize(),
-          function (results) {
-            let message;
-            if (results === undefined || results === null) {
-              message =
-                '<i class="fas fa-times inline-icon-left"></i> Unknown error';
-              self.flash_error('Tweet not posted due to unknown error.');
-            } else if (!results.success) {
-              message =
-                '<i class="fas fa-times inline-icon-left"></i> Not posted: ' +
-                results.reason;
-              self.flash_error(
-                'Tweet not posted! Error message: "' +
-                  results.reason +
-                  '".<br>Your tweet: "' +
-                  results.tweet +
-                  '".',
-              );
-            } else {
-              message =
-                '<i class="fas fa-check inline-icon-left"></i> Posted: ' +
-                results.tweet;
-              self.flash_success('Tweet posted!');
-            }
-            $('#edit-tweet-form').replaceWith(`<div>${message}</div>`);
+        $.post(sendUrl, form.serialize(), self._onPosted, 'json').fail(
+          function () {
+            saveButton.prop('disabled', false);
           },
-          'json',
         );
       });
 
@@ -60,6 +42,103 @@ ckan.module('confirm-tweet', function ($, _) {
       });
 
       $('#ckanext-twitter-placeholder').replaceWith(self.block);
+
+      if (self.options.deferred) {
+        self._loadTweet();
+      }
+    },
+
+    _loadTweet: function () {
+      // the page was rendered without the tweet, so fetch it now
+      var textarea = self.block.find('#field-tweet');
+      var saveButton = self.block.find('#edit-tweet-save');
+      textarea.prop('disabled', true).attr('placeholder', 'Generating tweet...');
+      saveButton.prop('disabled', true);
+      $.getJSON(self.options.preview_url)
+        .done(function (results) {
+          if (results && results.success) {
+            textarea.val(results.tweet).prop('disabled', false);
+            saveButton.prop('disabled', false);
+          } else {
+            self.block.remove();
+          }
+        })
+        .fail(function () {
+          self.block.remove();
+        });
+    },
+
+    _onPosted: function (results) {
+      if (results && results.job_id) {
+        // the tweet has been queued, so wait for the worker to post it
+        self._pollStatus(results.job_id, results.tweet);
+        return;
+      }
+      self._showResult(results);
+    },
+
+    _pollStatus: function (jobId, tweet) {
+      var statusUrl = '/dataset/' + self.options.pkgid + '/tweet/' + jobId;
+      $.getJSON(statusUrl, function (results) {
+        if (results.status === 'queued' || results.status === 'started') {
+          setTimeout(function () {
+            self._pollStatus(jobId, tweet);
+          }, self.options.poll_interval || 2000);
+        } else if (results.status === 'unknown') {
+          self._showResult({
+            success: false,
+            reason: 'tweet job not found',
+            tweet: tweet,
+          });
+        } else {
+          self._showResult(results);
+        }
+      }).fail(function () {
+        // stop polling, as we can't find out what happened to the tweet
+        self._showResult({
+          success: false,
+          reason: 'could not check whether the tweet was posted',
+          tweet: tweet,
+        });
+      });
+    },
+
+    _showResult: function (results) {
+      let message;
+      if (results === undefined || results === null) {
+        message = '<i class="fas fa-times inline-icon-left"></i> Unknown error';
+        self.flash_error('Tweet not posted due to unknown error.');
+      } else if (results.pending) {
+        // another request is posting the same tweet, so this one wasn't sent again
+        message =
+          '<i class="fas fa-clock inline-icon-left"></i> Already being posted: ' +
+          results.tweet;
+        self.flash_info('This tweet is already being posted.');
+      } else if (results.held) {
+        // the rate limit has been reached, but the tweet will be posted once it resets
+        message =
+          '<i class="fas fa-clock inline-icon-left"></i> Queued: ' + results.tweet;
+        self.flash_info(
+          'Tweet queued! It will be posted once the Twitter rate limit resets.',
+        );
+      } else if (!results.success) {
+        message =
+          '<i class="fas fa-times inline-icon-left"></i> Not posted: ' +
+          results.reason;
+        self.flash_error(
+          'Tweet not posted! Error message: "' +
+            results.reason +
+            '".<br>Your tweet: "' +
+            results.tweet +
+            '".',
+        );
+      } else {
+        message =
+          '<i class="fas fa-check inline-icon-left"></i> Posted: ' +
+          results.tweet;
+        self.flash_success('Tweet posted!');
+      }
+      $('#edit-tweet-form').replaceWith(`<div>${message}</div>`);
     },
 
     flash: function (message, category) {
@@ -75,5 +154,9 @@ ckan.module('confirm-tweet', function ($, _) {
     flash_success: function (message) {
       this.flash(message, 'alert-success');
     },
+
+    flash_info: function (message) {
+      this.flash(message, 'alert-info');
+    },
   };
 });
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+import time
+from unittest.mock import patch, MagicMock
+
+import pytest
+from ckan.tests import factories
+
+from ckanext.twitter.lib import (
+    config_helpers,
+    helpers as twitter_helpers,
+    parsers as twitter_parsers,
+)
+
+pytest.importorskip('pytest_benchmark')
+
+# these are deselected unless pytest is run with -m benchmarks
+pytestmark = pytest.mark.benchmarks
+
+# roughly how long a datastore_search with limit 0 takes against a local database
+search_latency = 0.002
+# and a datastore_search_sql counting several tables at once
+sql_latency = 0.005
+
+resource_counts = [1, 10, 100, 1000]
+author_lengths = [10, 100, 1000, 10000]
+
+
+def make_author(length):
+    authors = []
+    i = 0
+    while len('; '.join(authors)) < length:
+        authors.append(f'Forename{i} Surname{i}')
+        i += 1
+    return '; '.join(authors)[:length]
+
+
+def make_package(resources=1, author_length=30):
+    return {
+        'id': 'benchmark-package',
+        'name': 'benchmark-package',
+        'title': 'A synthetic package used for benchmarking tweet generation',
+        'author': make_author(author_length),
+        'state': 'active',
+        'private': False,
+        'notes': 'Some notes ' * 50,
+        'tags': [{'name': f'tag-{i}'} for i in range(10)],
+        'resources': [
+            {
+                'id': f'resource-{i}',
+                'state': 'active',
+                'datastore_active': True,
+                'last_modified': '2020-01-01T00:00:00',
+            }
+            for i in range(resources)
+        ],
+    }
+
+
+def fake_datastore_search(context, data_dict):
+    time.sleep(search_latency)
+    return {'total': 100, 'records': []}
+
+
+def fake_datastore_search_sql(context, data_dict):
+    time.sleep(sql_latency)
+    sql = data_dict['sql']
+    return {
+        'records': [
+            {'id': part.split("'")[1], 'total': 100} for part in sql.split(' UNION ALL ')
+        ]
+    }
+
+
+@pytest.fixture
+def datastore():
+    """
+    Stands in for the datastore actions, with realistic latencies, and makes sure every
+    count misses the record count cache.
+    """
+    actions = {
+        'datastore_search': fake_datastore_search,
+        'datastore_search_sql': fake_datastore_search_sql,
+    }
+    mock_toolkit = MagicMock(get_action=actions.get)
+    mock_cache_helpers = MagicMock(get_record_count=MagicMock(return_value=None))
+    with patch('ckanext.twitter.lib.parsers.toolkit', mock_toolkit), patch(
+        'ckanext.twitter.lib.parsers.cache_helpers', mock_cache_helpers
+    ):
+        yield
+
+
+@pytest.mark.parametrize('length', author_lengths)
+def test_truncate_author(benchmark, length):
+    author = make_author(length)
+    benchmark.group = 'truncate_author'
+    benchmark(twitter_parsers.truncate_author, author)
+
+
+@pytest.mark.parametrize('length', author_lengths)
+def test_truncate_field(benchmark, length):
+    value = make_author(length).replace(';', '')
+    benchmark.group = 'truncate_field'
+    benchmark(twitter_parsers.truncate_field, value, 70)
+
+
+@pytest.mark.parametrize('resources', resource_counts)
+def test_twitter_pkg_suitable(benchmark, resources):
+    pkg_dict = make_package(resources)
+    benchmark.group = 'twitter_pkg_suitable'
+    benchmark(twitter_helpers.twitter_pkg_suitable, {}, pkg_dict['id'], pkg_dict)
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.usefixtures('clean_db')
+@pytest.mark.parametrize('resources', [1, 10, 100])
+def test_twitter_pkg_suitable_from_model(benchmark, resources):
+    # this is the path after_update takes, checking the package in the database
+    package = factories.Dataset(
+        resources=[{'url': f'http://example.com/{i}'} for i in range(resources)]
+    )
+    benchmark.group = 'twitter_pkg_suitable_from_model'
+    benchmark(twitter_helpers.twitter_pkg_suitable, {}, package['id'])
+
+
+@pytest.mark.usefixtures('datastore')
+@pytest.mark.parametrize('resources', resource_counts)
+@pytest.mark.parametrize(
+    'options',
+    [
+        {},
+        {'ckanext.twitter.count_workers': 8},
+        {'ckanext.twitter.count_sql': True},
+    ],
+    ids=['sequential', 'threaded', 'sql'],
+)
+def test_get_number_records(benchmark, ckan_config, monkeypatch, resources, options):
+    for key, value in options.items():
+        monkeypatch.setitem(ckan_config, key, value)
+    config_helpers.reload_config()
+    pkg_dict = make_package(resources)
+    benchmark.group = 'get_number_records'
+    benchmark.pedantic(
+        twitter_parsers.get_number_records,
+        args=({}, pkg_dict['id'], pkg_dict),
+        rounds=5,
+    )
+
+
+@pytest.mark.usefixtures('datastore')
+@pytest.mark.parametrize('resources', resource_counts)
+@pytest.mark.parametrize('author_length', author_lengths)
+def test_extract_info(benchmark, resources, author_length):
+    pkg_dict = make_package(resources, author_length)
+    compiled = twitter_parsers.get_template(is_new=False)
+    benchmark.group = 'extract_info'
+    benchmark.pedantic(
+        twitter_parsers.extract_info,
+        args=(
+            {},
+            pkg_dict,
+            compiled.static_length,
+            compiled.tokens,
+            compiled.variables,
+        ),
+        rounds=5,
+    )
+
+
+@pytest.mark.usefixtures('datastore')
+@pytest.mark.parametrize('resources', resource_counts)
+@pytest.mark.parametrize('author_length', author_lengths)
+def test_generate_tweet(benchmark, resources, author_length):
+    pkg_dict = make_package(resources, author_length)
+    benchmark.group = 'generate_tweet'
+    benchmark.pedantic(
+        twitter_parsers.generate_tweet,
+        args=({}, pkg_dict['id'], False),
+        kwargs={'pkg_dict': pkg_dict},
+        rounds=5,
+    )
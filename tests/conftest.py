@@ -1,4 +1,46 @@
+from unittest.mock import patch
+
+import pytest
+
 from ckanext.datastore.tests.conftest import *
 
+from ckanext.twitter.lib import config_helpers, scheduler, stores
+
 # not sure why this doesn't work, but the above does instead
 # pytest_plugin = ("ckanext.datastore.tests", )
+
+
+@pytest.fixture(autouse=True)
+def twitter_config(ckan_config):
+    """
+    The ckan_config marks change the config for each test, so the extension's config
+    needs loading again to pick them up.
+    """
+    config_helpers.reload_config()
+    yield
+
+
+@pytest.fixture(autouse=True)
+def rate_limit():
+    """
+    The rate limit and held posts are kept in redis, so anything a test leaves behind
+    would hold the posts in later tests. Timers to drain the held posts aren't started.
+    """
+    scheduler.rate_limit.clear()
+    scheduler.rate_limit.redis.delete(scheduler.held_key)
+    with patch('ckanext.twitter.lib.scheduler.schedule_drain'):
+        yield scheduler.rate_limit
+    scheduler.rate_limit.clear()
+    scheduler.rate_limit.redis.delete(scheduler.held_key)
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def expiring_store(request):
+    """
+    Each type of expiring store, empty at the start of the test. The prompt and dedupe
+    stores are built on these.
+    """
+    store = stores.create_expiring_store(request.param, 'ckanext-twitter:test:')
+    store.clear()
+    yield store
+    store.clear()
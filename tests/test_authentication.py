@@ -12,6 +12,13 @@ from ckanext.twitter.lib import config_helpers
 from ckanext.twitter.lib import twitter_api
 
 
+@pytest.fixture(autouse=True)
+def reset_authentication():
+    twitter_api.reset_authentication()
+    yield
+    twitter_api.reset_authentication()
+
+
 @pytest.mark.ckan_config('ckanext.twitter.consumer_key', 'a-consumer-key')
 @pytest.mark.ckan_config('ckanext.twitter.consumer_secret', 'a-consumer-secret')
 @pytest.mark.ckan_config('ckanext.twitter.token_key', 'a-token-key')
@@ -63,3 +70,65 @@ def test_can_authenticate_bad_creds():
     with patch('ckanext.twitter.lib.twitter_api.twitter_client', twitter_client_mock):
         is_authenticated = twitter_api.twitter_authenticate()
         assert not is_authenticated
+    # there's no point trying to connect with the placeholder credentials
+    assert not twitter_client_mock.called
+
+
+@pytest.mark.ckan_config('ckanext.twitter.consumer_key', 'a-consumer-key')
+@pytest.mark.ckan_config('ckanext.twitter.consumer_secret', 'a-consumer-secret')
+@pytest.mark.ckan_config('ckanext.twitter.token_key', 'a-token-key')
+@pytest.mark.ckan_config('ckanext.twitter.token_secret', 'a-token-secret')
+def test_authentication_is_cached():
+    mock_response = MagicMock(status=200)
+    mock_client = MagicMock(request=MagicMock(return_value=(mock_response, None)))
+    twitter_client_mock = MagicMock(return_value=mock_client)
+    with patch('ckanext.twitter.lib.twitter_api.twitter_client', twitter_client_mock):
+        assert twitter_api.twitter_authenticate()
+        assert twitter_api.twitter_authenticate()
+        assert mock_client.request.call_count == 1
+
+        assert twitter_api.twitter_authenticate(force=True)
+        assert mock_client.request.call_count == 2
+
+
+@pytest.mark.ckan_config('ckanext.twitter.consumer_key', 'a-consumer-key')
+@pytest.mark.ckan_config('ckanext.twitter.consumer_secret', 'a-consumer-secret')
+@pytest.mark.ckan_config('ckanext.twitter.token_key', 'a-token-key')
+@pytest.mark.ckan_config('ckanext.twitter.token_secret', 'a-token-secret')
+@pytest.mark.ckan_config('ckanext.twitter.auth_ttl', 0)
+def test_authentication_cache_expires():
+    mock_response = MagicMock(status=200)
+    mock_client = MagicMock(request=MagicMock(return_value=(mock_response, None)))
+    twitter_client_mock = MagicMock(return_value=mock_client)
+    with patch('ckanext.twitter.lib.twitter_api.twitter_client', twitter_client_mock):
+        assert twitter_api.twitter_authenticate()
+        assert twitter_api.twitter_authenticate()
+        assert mock_client.request.call_count == 2
+
+
+@pytest.mark.ckan_config('debug', False)
+@pytest.mark.ckan_config('ckanext.twitter.debug', False)
+@pytest.mark.ckan_config('ckanext.twitter.consumer_key', 'a-consumer-key')
+@pytest.mark.ckan_config('ckanext.twitter.consumer_secret', 'a-consumer-secret')
+@pytest.mark.ckan_config('ckanext.twitter.token_key', 'a-token-key')
+@pytest.mark.ckan_config('ckanext.twitter.token_secret', 'a-token-secret')
+def test_reauthenticates_when_post_is_unauthorised():
+    responses = [
+        # the initial verification
+        (MagicMock(status=200), None),
+        # the post
+        (MagicMock(status=401, reason='Unauthorized'), None),
+        # the verification after the post fails
+        (MagicMock(status=401, reason='Unauthorized'), None),
+    ]
+    mock_client = MagicMock(request=MagicMock(side_effect=responses))
+    twitter_client_mock = MagicMock(return_value=mock_client)
+    mock_cache_helpers = MagicMock(expired=MagicMock(return_value=True))
+    with patch(
+        'ckanext.twitter.lib.twitter_api.twitter_client', twitter_client_mock
+    ), patch('ckanext.twitter.lib.twitter_api.cache_helpers', mock_cache_helpers):
+        posted, reason = twitter_api.post_tweet('This is a test tweet.', 'pkg-id')
+
+    assert not posted
+    assert reason == 'not authenticated'
+    assert mock_client.request.call_count == 3
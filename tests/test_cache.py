@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+import threading
+import time
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+from ckanext.twitter.lib import cache_helpers, stores
+
+
+@pytest.fixture
+def package_show():
+    package = {'id': 'some-package-id', 'name': 'some-package-name'}
+    package_show = MagicMock(return_value=package)
+    mock_toolkit = MagicMock(get_action=MagicMock(return_value=package_show))
+    with patch('ckanext.twitter.lib.cache_helpers.toolkit', mock_toolkit):
+        yield package_show
+
+
+@pytest.mark.usefixtures('with_request_context')
+def test_get_package_only_fetches_once_per_request(package_show):
+    first = cache_helpers.get_package({}, 'some-package-id')
+    second = cache_helpers.get_package({}, 'some-package-id')
+    by_name = cache_helpers.get_package({}, 'some-package-name')
+
+    assert first == second
+    assert by_name == first
+    assert package_show.call_count == 1
+
+
+@pytest.mark.usefixtures('with_request_context')
+def test_get_package_returns_copies(package_show):
+    first = cache_helpers.get_package({}, 'some-package-id')
+    first['name'] = 'changed'
+
+    assert cache_helpers.get_package({}, 'some-package-id')['name'] == (
+        'some-package-name'
+    )
+
+
+@pytest.mark.usefixtures('with_request_context')
+def test_get_package_is_cached_per_user(package_show):
+    cache_helpers.get_package({'user': 'some-user'}, 'some-package-id')
+    cache_helpers.get_package({'user': 'another-user'}, 'some-package-id')
+    cache_helpers.get_package({'user': 'some-user'}, 'some-package-id')
+
+    assert package_show.call_count == 2
+
+
+@pytest.mark.usefixtures('with_request_context')
+def test_forget_package_for_every_user(package_show):
+    cache_helpers.get_package({'user': 'some-user'}, 'some-package-id')
+    cache_helpers.get_package({'user': 'another-user'}, 'some-package-name')
+    cache_helpers.forget_package('some-package-id')
+    cache_helpers.get_package({'user': 'some-user'}, 'some-package-name')
+    cache_helpers.get_package({'user': 'another-user'}, 'some-package-id')
+
+    assert package_show.call_count == 4
+
+
+@pytest.mark.usefixtures('with_request_context')
+def test_forget_package(package_show):
+    cache_helpers.get_package({}, 'some-package-id')
+    cache_helpers.forget_package('some-package-id')
+    cache_helpers.get_package({}, 'some-package-id')
+
+    assert package_show.call_count == 2
+
+
+def test_get_package_outside_request_is_not_cached(package_show):
+    cache_helpers.get_package({}, 'some-package-id')
+    cache_helpers.get_package({}, 'some-package-id')
+
+    assert package_show.call_count == 2
+
+
+def test_record_count_cache():
+    resource = {'id': 'some-resource-id', 'last_modified': '2024-01-01T00:00:00'}
+    assert cache_helpers.get_record_count(resource) is None
+
+    cache_helpers.set_record_count(resource, 12)
+    assert cache_helpers.get_record_count(resource) == 12
+
+    cache_helpers.forget_record_count(resource['id'])
+    assert cache_helpers.get_record_count(resource) is None
+
+
+@pytest.mark.ckan_config('ckanext.twitter.count_cache.expire', 1)
+def test_record_count_cache_expires():
+    cache_helpers.configure_record_counts()
+    resource = {'id': 'expiring-resource-id', 'last_modified': '2024-01-01T00:00:00'}
+    cache_helpers.set_record_count(resource, 12)
+    assert cache_helpers.get_record_count(resource) == 12
+
+    time.sleep(1.1)
+    assert cache_helpers.get_record_count(resource) is None
+    cache_helpers.configure_record_counts()
+
+
+def test_record_count_cache_ignores_old_versions():
+    resource = {'id': 'another-resource-id', 'last_modified': '2024-01-01T00:00:00'}
+    cache_helpers.set_record_count(resource, 12)
+
+    resource['last_modified'] = '2024-01-02T00:00:00'
+    assert cache_helpers.get_record_count(resource) is None
+
+
+@pytest.fixture(params=['memory', 'file', 'redis', 'database'])
+def store(request, tmp_path):
+    if request.param == 'file':
+        store = stores.FileStore(str(tmp_path / 'last-tweeted.json'))
+    elif request.param == 'database':
+        request.getfixturevalue('clean_db')
+        stores.create_tables()
+        store = stores.DatabaseStore()
+    else:
+        store = stores.create_store(request.param)
+    store.clear()
+    yield store
+    store.clear()
+
+
+def test_store_claim(store):
+    now = time.time()
+    assert store.get('some-package-id') is None
+
+    assert store.claim('some-package-id', now, 60)
+    assert store.get('some-package-id') == pytest.approx(now)
+    # still within the rest period
+    assert not store.claim('some-package-id', now + 30, 60)
+
+    store.remove('some-package-id')
+    assert store.get('some-package-id') is None
+    assert store.claim('some-package-id', now + 30, 60)
+
+
+def test_store_claim_after_rest_period(store):
+    now = time.time()
+    store.set('some-package-id', now - 120, 60)
+    assert store.claim('some-package-id', now, 60)
+
+
+def test_store_only_one_concurrent_claim(store):
+    now = time.time()
+    results = []
+
+    def claim():
+        results.append(store.claim('some-package-id', now, 60))
+
+    threads = [threading.Thread(target=claim) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results.count(True) == 1
+
+
+@pytest.mark.ckan_config('ckanext.twitter.hours_between_tweets', 24)
+def test_expired():
+    cache_helpers.reset_cache()
+    assert cache_helpers.expired('some-package-id')
+    assert cache_helpers.claim('some-package-id')
+    assert not cache_helpers.expired('some-package-id')
+    assert not cache_helpers.claim('some-package-id')
+
+    # a tweet over a day ago is also expired
+    stores.get_store().set('some-package-id', time.time() - 25 * 3600, 24 * 3600)
+    assert cache_helpers.expired('some-package-id')
+    cache_helpers.reset_cache()
+
+
+def test_store_eligible(store):
+    now = time.time()
+    store.set('recent-package-id', now - 30, 60)
+    store.set('old-package-id', now - 120, 60)
+
+    eligible = store.eligible(
+        ['recent-package-id', 'old-package-id', 'new-package-id'], now, 60
+    )
+    assert eligible == {'old-package-id', 'new-package-id'}
+
+
+def test_expiring_store(expiring_store):
+    assert expiring_store.get('key') is None
+    expiring_store.set('key', {'some': 'value'}, 60)
+    assert expiring_store.get('key') == {'some': 'value'}
+    assert expiring_store.get_many(['key', 'another-key']) == [{'some': 'value'}, None]
+
+    assert expiring_store.delete('key')
+    assert not expiring_store.delete('key')
+    assert expiring_store.get('key') is None
+
+
+def test_expiring_store_add_is_exclusive(expiring_store):
+    assert expiring_store.add('key', 1, 60)
+    assert not expiring_store.add('key', 2, 60)
+    assert expiring_store.get('key') == 1
+    expiring_store.delete('key')
+    assert expiring_store.add('key', 2, 60)
+
+
+def test_expiring_store_entries_expire(expiring_store):
+    expiring_store.set('key', 1, 0.1)
+    time.sleep(0.2)
+    assert expiring_store.get('key') is None
+    assert expiring_store.add('key', 2, 60)
+
+
+def test_memory_expiring_store_evicts_expired_entries():
+    store = stores.MemoryExpiringStore()
+    with patch('ckanext.twitter.lib.stores.time.monotonic', return_value=1000):
+        for i in range(100):
+            store.set(f'key-{i}', i, 60)
+    assert len(store.entries) == 100
+
+    with patch('ckanext.twitter.lib.stores.time.monotonic', return_value=1061):
+        store.set('another-key', 1, 60)
+    assert list(store.entries) == ['another-key']
+    assert len(store.expiry_heap) == 1
+
+
+@pytest.mark.parametrize('base', [stores.ExpiringStore, stores.RestPeriodStore])
+def test_incomplete_store_cannot_be_created(base):
+    class IncompleteStore(base):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        IncompleteStore()
+
+
+def test_precomputed_tweet_not_read_when_disabled():
+    mock_connect = MagicMock()
+    with patch('ckanext.twitter.lib.cache_helpers.connect_to_redis', mock_connect):
+        assert cache_helpers.get_precomputed_tweet('some-package-id', 'v1') is None
+    assert not mock_connect.called
+
+
+@pytest.mark.ckan_config('ckanext.twitter.precompute', True)
+@pytest.mark.ckan_config('ckanext.twitter.precompute_ttl', 60)
+def test_precomputed_tweet_expires_after_ttl():
+    mock_redis = MagicMock()
+    with patch(
+        'ckanext.twitter.lib.cache_helpers.connect_to_redis',
+        MagicMock(return_value=mock_redis),
+    ):
+        cache_helpers.set_precomputed_tweet('some-package-id', 'v1', 'A tweet', True)
+    assert mock_redis.set.call_args[1]['ex'] == 60
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+from unittest.mock import patch, MagicMock
+
+import pytest
+from ckan.tests import factories
+from click.testing import CliRunner
+
+from ckanext.twitter import cli
+from ckanext.twitter.lib import cache_helpers, scheduler, stores
+
+
+@pytest.fixture
+def cli_runner():
+    # keep the timings and warnings out of the output being tested
+    return CliRunner(mix_stderr=False)
+
+
+@pytest.fixture(autouse=True)
+def reset_cache():
+    cache_helpers.reset_cache()
+    yield
+    cache_helpers.reset_cache()
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.ckan_config('ckan.plugins', 'twitter')
+@pytest.mark.usefixtures('clean_db', 'clean_index', 'with_plugins')
+class TestCommands(object):
+    def test_preview(self, cli_runner):
+        package = factories.Dataset(title='A package title', author='Captain Author')
+
+        result = cli_runner.invoke(
+            cli.twitter, ['preview', '--id', package['id'], '--updated']
+        )
+
+        assert result.exit_code == 0, result.output
+        assert result.output == (
+            f'{package["id"]}\tUpdated dataset: "A package title" by Author '
+            f'(0 resources).\n'
+        )
+
+    def test_preview_search(self, cli_runner):
+        factories.Dataset(title='Beetles')
+        factories.Dataset(title='Beetles again')
+        factories.Dataset(title='Moths')
+
+        result = cli_runner.invoke(cli.twitter, ['preview', 'title:beetles'])
+
+        assert result.exit_code == 0, result.output
+        assert len(result.output.splitlines()) == 2
+
+    def test_post_skips_resting_packages(self, cli_runner):
+        resting = factories.Dataset()
+        eligible = factories.Dataset()
+        cache_helpers.cache(resting['id'])
+
+        mock_post_tweet = MagicMock(return_value=(True, '200 OK'))
+        with patch('ckanext.twitter.cli.twitter_api.post_tweet', mock_post_tweet):
+            result = cli_runner.invoke(
+                cli.twitter,
+                ['post', '--id', resting['id'], '--id', eligible['id']],
+            )
+
+        assert result.exit_code == 0, result.output
+        assert mock_post_tweet.call_count == 1
+        args = mock_post_tweet.call_args[0]
+        assert args[1] == eligible['id']
+        assert args[2] == scheduler.BACKFILL
+
+    def test_post_dry_run(self, cli_runner):
+        package = factories.Dataset()
+
+        mock_post_tweet = MagicMock()
+        with patch('ckanext.twitter.cli.twitter_api.post_tweet', mock_post_tweet):
+            result = cli_runner.invoke(
+                cli.twitter, ['post', '--dry-run', '--id', package['id']]
+            )
+
+        assert result.exit_code == 0, result.output
+        assert not mock_post_tweet.called
+        assert '\tdry run\t' in result.output
+
+    @pytest.mark.ckan_config('ckanext.twitter.store', 'redis')
+    def test_cache_show_and_purge(self, cli_runner):
+        package = factories.Dataset()
+        cache_helpers.cache(package['id'])
+
+        result = cli_runner.invoke(cli.twitter, ['cache', 'show', package['id']])
+        assert result.output.strip().endswith('resting')
+
+        result = cli_runner.invoke(cli.twitter, ['cache', 'purge', package['id']])
+        assert result.exit_code == 0, result.output
+        assert cache_helpers.expired(package['id'])
+
+    def test_cache_refuses_memory_store(self, cli_runner):
+        package = factories.Dataset()
+        cache_helpers.cache(package['id'])
+
+        for args in (['show', package['id']], ['purge', package['id']]):
+            result = cli_runner.invoke(cli.twitter, ['cache'] + args)
+            assert result.exit_code != 0
+            assert 'only held by each web process' in result.stderr
+        assert not cache_helpers.expired(package['id'])
+
+    def test_drain_reports_posts_still_held(self, cli_runner):
+        scheduler.rate_limit.update(
+            {
+                'x-rate-limit-limit': '300',
+                'x-rate-limit-remaining': '0',
+                'x-rate-limit-reset': '2000000000',
+            },
+            200,
+        )
+        mock_post_tweet = MagicMock()
+        with patch('ckanext.twitter.lib.twitter_api.post_tweet', mock_post_tweet):
+            scheduler.hold('a held tweet', None, scheduler.BACKFILL)
+            result = cli_runner.invoke(cli.twitter, ['drain'])
+
+        assert result.exit_code == 0, result.output
+        assert not mock_post_tweet.called
+        assert '1 post(s) still held' in result.stderr
+
+    def test_initdb(self, cli_runner):
+        result = cli_runner.invoke(cli.twitter, ['initdb'])
+        assert result.exit_code == 0, result.output
+
+        store = stores.DatabaseStore()
+        store.set('some-package-id', 1000.0, 3600)
+        assert store.get('some-package-id') == 1000.0
+        store.clear()
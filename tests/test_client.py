@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch, MagicMock
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from ckanext.twitter.lib import config_helpers, twitter_api
+from ckanext.twitter.lib.client import TwitterClient
+
+
+class FakeTwitterHandler(BaseHTTPRequestHandler):
+    """
+    Handles requests to a fake twitter API, recording them on the server.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append(('GET', url.path, parse_qs(url.query)))
+        self._respond(200, {'id': 1})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        self.server.requests.append(('POST', self.path, parse_qs(body)))
+        self._respond(200, {'id': 2})
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_twitter():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeTwitterHandler)
+    # don't wait for kept-alive connections to be closed when shutting down
+    server.daemon_threads = True
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def reset_client():
+    twitter_api.reset_client()
+    twitter_api.reset_authentication()
+    yield
+    twitter_api.reset_client()
+    twitter_api.reset_authentication()
+
+
+def test_client_signs_requests(fake_twitter):
+    client = TwitterClient('a-consumer-key', 'a-consumer-secret', 'a-token', 'a-secret')
+    url = f'http://127.0.0.1:{fake_twitter.server_port}/statuses/update.json'
+
+    response, content = client.request(url, 'POST', {'status': 'A tweet'})
+
+    assert response.status == 200
+    assert json.loads(content) == {'id': 2}
+    method, path, params = fake_twitter.requests[0]
+    assert method == 'POST'
+    assert params['status'] == ['A tweet']
+    assert params['oauth_consumer_key'] == ['a-consumer-key']
+    assert params['oauth_token'] == ['a-token']
+    assert 'oauth_signature' in params
+
+
+def test_client_reuses_connections(fake_twitter):
+    client = TwitterClient('a-consumer-key', 'a-consumer-secret', 'a-token', 'a-secret')
+    url = f'http://127.0.0.1:{fake_twitter.server_port}/account/verify_credentials.json'
+
+    for i in range(3):
+        response, content = client.request(url)
+        assert response.status == 200
+
+    pool = client.pool.connection_from_url(url)
+    assert pool.num_connections == 1
+    assert pool.num_requests == 3
+
+
+@pytest.mark.usefixtures('reset_client')
+@pytest.mark.ckan_config('debug', False)
+@pytest.mark.ckan_config('ckanext.twitter.debug', False)
+@pytest.mark.ckan_config('ckanext.twitter.consumer_key', 'a-consumer-key')
+@pytest.mark.ckan_config('ckanext.twitter.consumer_secret', 'a-consumer-secret')
+@pytest.mark.ckan_config('ckanext.twitter.token_key', 'a-token-key')
+@pytest.mark.ckan_config('ckanext.twitter.token_secret', 'a-token-secret')
+def test_post_tweet_to_fake_server(fake_twitter, ckan_config, monkeypatch):
+    monkeypatch.setitem(
+        ckan_config,
+        'ckanext.twitter.api_url',
+        f'http://127.0.0.1:{fake_twitter.server_port}',
+    )
+    config_helpers.reload_config()
+    mock_cache_helpers = MagicMock(expired=MagicMock(return_value=True))
+    with patch('ckanext.twitter.lib.twitter_api.cache_helpers', mock_cache_helpers):
+        posted, reason = twitter_api.post_tweet('This is a test tweet.', 'pkg-id')
+
+    assert posted
+    assert reason == '200 OK'
+    assert [(m, p) for m, p, _ in fake_twitter.requests] == [
+        ('GET', '/account/verify_credentials.json'),
+        ('POST', '/statuses/update.json'),
+    ]
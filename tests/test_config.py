@@ -4,6 +4,8 @@
 # This file is part of ckanext-twitter
 # Created by the Natural History Museum in London, UK
 
+from unittest.mock import MagicMock
+
 import pytest
 
 import ckanext.twitter.lib.config_helpers as config_helpers
@@ -60,3 +62,70 @@ def test_gets_disable_edit_value_when_present():
 
 def test_gets_disable_edit_default_when_absent():
     assert not config_helpers.twitter_disable_edit()
+
+
+@pytest.mark.ckan_config('ckanext.twitter.debug', 'false')
+def test_debug_value_is_parsed():
+    assert config_helpers.twitter_is_debug() is False
+
+
+@pytest.mark.ckan_config('ckanext.twitter.hours_between_tweets', '1.5')
+def test_hours_between_tweets_is_parsed():
+    assert config_helpers.twitter_hours_between_tweets() == 1.5
+
+
+@pytest.mark.ckan_config('ckanext.twitter.disable_edit', 'true')
+def test_disable_edit_is_parsed():
+    assert config_helpers.twitter_disable_edit() is True
+
+
+@pytest.mark.parametrize(
+    'key,value',
+    [
+        ('ckanext.twitter.hours_between_tweets', 'a day'),
+        ('ckanext.twitter.hours_between_tweets', '-1'),
+        ('ckanext.twitter.debug', 'maybe'),
+        ('ckanext.twitter.count_workers', '0'),
+        ('ckanext.twitter.store', 'nowhere'),
+        ('ckanext.twitter.statsd', 'localhost'),
+        ('ckanext.twitter.new', '{{ title '),
+    ],
+)
+def test_invalid_values_are_rejected(ckan_config, monkeypatch, key, value):
+    monkeypatch.setitem(ckan_config, key, value)
+    with pytest.raises(ValueError, match=key):
+        config_helpers.load_config()
+
+
+def test_invalid_values_keep_the_current_config(ckan_config, monkeypatch):
+    current = config_helpers.get_config()
+    monkeypatch.setitem(ckan_config, 'ckanext.twitter.hours_between_tweets', 'x')
+    with pytest.raises(ValueError):
+        config_helpers.reload_config()
+    assert config_helpers.get_config() is current
+
+
+def test_config_is_immutable():
+    snapshot = config_helpers.get_config()
+    with pytest.raises(AttributeError):
+        snapshot.hours_between_tweets = 1
+    with pytest.raises(TypeError):
+        snapshot.http_options['retries'] = 10
+
+
+def test_reload_picks_up_changes(ckan_config, monkeypatch):
+    assert config_helpers.twitter_hours_between_tweets() == 24
+    monkeypatch.setitem(ckan_config, 'ckanext.twitter.hours_between_tweets', '6')
+    # nothing changes until the config is reloaded
+    assert config_helpers.twitter_hours_between_tweets() == 24
+    config_helpers.reload_config()
+    assert config_helpers.twitter_hours_between_tweets() == 6
+
+
+def test_reload_calls_hooks(monkeypatch):
+    hook = MagicMock()
+    monkeypatch.setattr(config_helpers, 'reload_hooks', [])
+    config_helpers.on_reload(hook)
+    config_helpers.on_reload(hook)
+    config_helpers.reload_config()
+    hook.assert_called_once_with()
@@ -5,11 +5,23 @@
 # Created by the Natural History Museum in London, UK
 
 import json
+from unittest.mock import patch, MagicMock
 
 import pytest
 from ckan.plugins import toolkit
 from ckan.tests import factories
 
+from ckanext.twitter.lib import jobs, scheduler
+
+
+@pytest.fixture
+def can_update():
+    """
+    Lets the (anonymous) test requests post tweets about any package.
+    """
+    with patch('ckanext.twitter.routes.tweet.toolkit.check_access'):
+        yield
+
 
 @pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
 @pytest.mark.ckan_config('ckan.plugins', 'twitter')
@@ -25,6 +37,7 @@ class TestController(object):
         response = app.post(url)
         assert response.status_code, 200
 
+    @pytest.mark.usefixtures('can_update')
     def test_debug_post_tweet(self, app):
         dataset = factories.Dataset(notes='Test dataset')
         url = toolkit.url_for('tweet.send', package_id=dataset['id'])
@@ -33,3 +46,209 @@ class TestController(object):
         assert body['reason'] == 'debug'
         assert body['tweet'] == 'this is a test tweet'
         assert not body['success']
+
+    @pytest.mark.usefixtures('can_update')
+    def test_duplicate_post_tweet_is_only_posted_once(self, app):
+        dataset = factories.Dataset(notes='Test dataset')
+        url = toolkit.url_for('tweet.send', package_id=dataset['id'])
+
+        mock_post_tweet = MagicMock(return_value=(True, '200 OK'))
+        with patch(
+            'ckanext.twitter.routes.tweet.twitter_api.post_tweet', mock_post_tweet
+        ):
+            first = app.post(url, data={'tweet_text': 'this is a test tweet'})
+            second = app.post(url, data={'tweet_text': 'this is a test tweet'})
+
+        assert mock_post_tweet.call_count == 1
+        assert json.loads(first.body) == json.loads(second.body)
+        assert json.loads(second.body)['success']
+
+    @pytest.mark.usefixtures('can_update')
+    def test_held_post_tweet_is_reported_as_held(self, app):
+        dataset = factories.Dataset(notes='Test dataset')
+        url = toolkit.url_for('tweet.send', package_id=dataset['id'])
+
+        mock_post_tweet = MagicMock(return_value=(False, scheduler.HELD))
+        with patch(
+            'ckanext.twitter.routes.tweet.twitter_api.post_tweet', mock_post_tweet
+        ):
+            response = app.post(url, data={'tweet_text': 'this is a test tweet'})
+
+        body = json.loads(response.body)
+        assert body['held']
+        assert body['reason'] == scheduler.HELD
+
+    @pytest.mark.ckan_config('ckanext.twitter.async', True)
+    @pytest.mark.usefixtures('can_update')
+    def test_async_post_tweet_is_queued(self, app):
+        dataset = factories.Dataset(notes='Test dataset')
+        url = toolkit.url_for('tweet.send', package_id=dataset['id'])
+
+        mock_enqueue_job = MagicMock(return_value=MagicMock(id='some-job-id'))
+        with patch('ckanext.twitter.lib.jobs.toolkit.enqueue_job', mock_enqueue_job):
+            response = app.post(url, data={'tweet_text': 'this is a test tweet'})
+
+        body = json.loads(response.body)
+        assert body['job_id'] == 'some-job-id'
+        assert body['reason'] == 'queued'
+        args = mock_enqueue_job.call_args[0]
+        assert args[0] == jobs.post_tweet_job
+        assert args[1] == [
+            'this is a test tweet',
+            dataset['id'],
+            scheduler.INTERACTIVE,
+        ]
+
+    @pytest.mark.usefixtures('can_update')
+    def test_tweet_job_status(self, app):
+        dataset = factories.Dataset(notes='Test dataset')
+        url = toolkit.url_for(
+            'tweet.status', package_id=dataset['id'], job_id='some-job-id'
+        )
+
+        # run the job function directly, standing in for the worker
+        result = jobs.post_tweet_job('this is a test tweet', dataset['id'])
+        mock_job = MagicMock(
+            func_name='ckanext.twitter.lib.jobs.post_tweet_job',
+            args=['this is a test tweet', dataset['id']],
+            is_finished=True,
+            result=result,
+            get_status=MagicMock(return_value='finished'),
+        )
+        mock_job_class = MagicMock(fetch=MagicMock(return_value=mock_job))
+        with patch('ckanext.twitter.lib.jobs.Job', mock_job_class):
+            response = app.get(url)
+
+        body = json.loads(response.body)
+        assert body['status'] == 'finished'
+        assert body['reason'] == 'debug'
+        assert not body['success']
+
+    @pytest.mark.usefixtures('can_update')
+    def test_tweet_job_status_other_package(self, app):
+        dataset = factories.Dataset()
+        url = toolkit.url_for(
+            'tweet.status', package_id=dataset['id'], job_id='some-job-id'
+        )
+        mock_job = MagicMock(
+            func_name='ckanext.twitter.lib.jobs.post_tweet_job',
+            args=['this is a test tweet', 'some-other-id'],
+        )
+        mock_job_class = MagicMock(fetch=MagicMock(return_value=mock_job))
+        with patch('ckanext.twitter.lib.jobs.Job', mock_job_class):
+            response = app.get(url)
+
+        assert json.loads(response.body) == {'status': 'unknown'}
+
+    def test_post_tweet_needs_update_access(self, app):
+        dataset = factories.Dataset(notes='Test dataset')
+        url = toolkit.url_for('tweet.send', package_id=dataset['id'])
+
+        mock_post_tweet = MagicMock()
+        with patch(
+            'ckanext.twitter.routes.tweet.twitter_api.post_tweet', mock_post_tweet
+        ):
+            response = app.post(
+                url, data={'tweet_text': 'this is a test tweet'}, status=403
+            )
+
+        assert json.loads(response.body)['reason'] == 'not authorised'
+        assert not mock_post_tweet.called
+
+    def test_tweet_job_status_needs_update_access(self, app):
+        dataset = factories.Dataset()
+        url = toolkit.url_for(
+            'tweet.status', package_id=dataset['id'], job_id='some-job-id'
+        )
+
+        mock_job_class = MagicMock()
+        with patch('ckanext.twitter.lib.jobs.Job', mock_job_class):
+            response = app.get(url, status=403)
+
+        assert json.loads(response.body)['reason'] == 'not authorised'
+        assert not mock_job_class.fetch.called
+
+    def test_preview(self, app):
+        dataset = factories.Dataset(title='A package title', author='Captain Author')
+        factories.Resource(package_id=dataset['id'])
+        url = toolkit.url_for('tweet.preview', package_id=dataset['id'])
+
+        response = app.get(url)
+
+        body = json.loads(response.body)
+        assert body['success']
+        assert body['package_id'] == dataset['id']
+        assert body['tweet'].startswith('New dataset: "A package title" by Author')
+        assert response.headers['ETag']
+        assert response.headers['Last-Modified']
+
+    def test_preview_not_modified(self, app):
+        dataset = factories.Dataset()
+        factories.Resource(package_id=dataset['id'])
+        url = toolkit.url_for('tweet.preview', package_id=dataset['id'])
+        etag = app.get(url).headers['ETag']
+
+        mock_generate_tweet = MagicMock()
+        with patch(
+            'ckanext.twitter.routes.tweet.twitter_parsers.generate_tweet',
+            mock_generate_tweet,
+        ):
+            response = app.get(url, headers={'If-None-Match': etag})
+
+        assert response.status_code == 304
+        assert not mock_generate_tweet.called
+
+    def test_preview_changes_with_package(self, app):
+        dataset = factories.Dataset(title='A package title')
+        factories.Resource(package_id=dataset['id'])
+        url = toolkit.url_for('tweet.preview', package_id=dataset['id'])
+        etag = app.get(url).headers['ETag']
+
+        toolkit.get_action('package_patch')(
+            {'ignore_auth': True, 'user': ''},
+            {'id': dataset['id'], 'title': 'A new title'},
+        )
+        response = app.get(url, headers={'If-None-Match': etag})
+
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+        assert '"A new title"' in json.loads(response.body)['tweet']
+
+    def test_preview_not_found(self, app):
+        url = toolkit.url_for('tweet.preview', package_id='not-a-real-id')
+        response = app.get(url, status=404)
+        assert json.loads(response.body)['reason'] == 'not found'
+
+    @pytest.mark.ckan_config('ckanext.twitter.precompute', True)
+    def test_preview_uses_precomputed_tweet(self, app):
+        dataset = factories.Dataset(title='A package title')
+        factories.Resource(package_id=dataset['id'])
+        url = toolkit.url_for('tweet.preview', package_id=dataset['id'])
+
+        # run the job function directly, standing in for the worker
+        jobs.precompute_tweet_job(dataset['id'])
+
+        mock_generate_tweet = MagicMock()
+        with patch(
+            'ckanext.twitter.routes.tweet.twitter_parsers.generate_tweet',
+            mock_generate_tweet,
+        ):
+            response = app.get(url)
+
+        assert not mock_generate_tweet.called
+        assert '"A package title"' in json.loads(response.body)['tweet']
+
+    @pytest.mark.ckan_config('ckanext.twitter.precompute', True)
+    def test_precomputed_tweet_is_ignored_once_out_of_date(self, app):
+        dataset = factories.Dataset(title='A package title')
+        factories.Resource(package_id=dataset['id'])
+        url = toolkit.url_for('tweet.preview', package_id=dataset['id'])
+
+        jobs.precompute_tweet_job(dataset['id'])
+        toolkit.get_action('package_patch')(
+            {'ignore_auth': True, 'user': ''},
+            {'id': dataset['id'], 'title': 'A new title'},
+        )
+        response = app.get(url)
+
+        assert '"A new title"' in json.loads(response.body)['tweet']
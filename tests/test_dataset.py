@@ -4,10 +4,13 @@
 # This file is part of ckanext-twitter
 # Created by the Natural History Museum in London, UK
 
+import time
+
 import pytest
+from ckan.plugins import toolkit
 from ckan.tests import factories
 from ckan.tests.helpers import call_action
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 
 from ckanext.twitter.lib import parsers as twitter_parsers
 
@@ -36,3 +39,168 @@ class TestDatasetMetadata(object):
 
         record_count = twitter_parsers.get_number_records({}, package['id'])
         assert record_count == 0
+
+    def test_record_count_cache_cleared_by_datastore_writes(self, mock_session):
+        package = factories.Dataset()
+        resource = factories.Resource(package_id=package['id'], url_type='datastore')
+
+        records = [{'x': i, 'y': 'number {}'.format(i)} for i in range(10)]
+        call_action('datastore_create', resource_id=resource['id'], records=records)
+        assert twitter_parsers.get_number_records({}, package['id']) == len(records)
+
+        more_records = [{'x': i, 'y': 'number {}'.format(i)} for i in range(10, 15)]
+        call_action(
+            'datastore_upsert',
+            resource_id=resource['id'],
+            records=more_records,
+            method='insert',
+        )
+        assert twitter_parsers.get_number_records({}, package['id']) == 15
+
+        call_action('datastore_delete', resource_id=resource['id'], filters={'x': 0})
+        assert twitter_parsers.get_number_records({}, package['id']) == 14
+
+        # datastore_records_delete was only added in CKAN 2.10
+        try:
+            toolkit.get_action('datastore_records_delete')
+        except KeyError:
+            return
+        call_action(
+            'datastore_records_delete', resource_id=resource['id'], filters={'x': 1}
+        )
+        assert twitter_parsers.get_number_records({}, package['id']) == 13
+
+    @pytest.mark.ckan_config('ckanext.twitter.count_workers', 4)
+    def test_gets_dataset_number_of_records_with_threads(self, mock_session):
+        package = factories.Dataset()
+        records = [{'x': i, 'y': 'number {}'.format(i)} for i in range(10)]
+        for i in range(3):
+            resource = factories.Resource(
+                package_id=package['id'], url_type='datastore'
+            )
+            call_action('datastore_create', resource_id=resource['id'], records=records)
+
+        record_count = twitter_parsers.get_number_records({}, package['id'])
+        assert record_count == 3 * len(records)
+
+    @pytest.mark.ckan_config('ckan.datastore.sqlsearch.enabled', True)
+    @pytest.mark.ckan_config('ckanext.twitter.count_sql', True)
+    def test_gets_dataset_number_of_records_with_sql(self, mock_session):
+        package = factories.Dataset()
+        records = [{'x': i, 'y': 'number {}'.format(i)} for i in range(10)]
+        for i in range(3):
+            resource = factories.Resource(
+                package_id=package['id'], url_type='datastore'
+            )
+            call_action('datastore_create', resource_id=resource['id'], records=records)
+
+        record_count = twitter_parsers.get_number_records({}, package['id'])
+        assert record_count == 3 * len(records)
+
+
+def test_count_records_does_not_request_rows():
+    datastore_search = MagicMock(return_value={'total': 12})
+    mock_toolkit = MagicMock(get_action=MagicMock(return_value=datastore_search))
+    with patch('ckanext.twitter.lib.parsers.toolkit', mock_toolkit):
+        counts = twitter_parsers.count_records(
+            {}, [{'id': 'resource-1'}, {'id': 'resource-2'}]
+        )
+
+    assert counts == {'resource-1': 12, 'resource-2': 12}
+    for args, kwargs in datastore_search.call_args_list:
+        assert args[1]['limit'] == 0
+
+
+@pytest.fixture
+def uncached():
+    # counts are cached by resource ID, so make sure every count is made again
+    with patch(
+        'ckanext.twitter.lib.parsers.cache_helpers.get_record_count',
+        MagicMock(return_value=None),
+    ):
+        yield
+
+
+def slow_datastore_search(context, data_dict):
+    if data_dict['resource_id'] == 'slow-resource':
+        time.sleep(1)
+    return {'total': 12}
+
+
+@pytest.mark.usefixtures('uncached')
+@pytest.mark.parametrize(
+    'resource_ids',
+    [
+        ['resource-1', 'slow-resource'],
+        ['slow-resource', 'resource-1', 'resource-2'],
+    ],
+)
+def test_count_records_skips_slow_resources(resource_ids):
+    mock_toolkit = MagicMock(get_action=MagicMock(return_value=slow_datastore_search))
+    with patch('ckanext.twitter.lib.parsers.toolkit', mock_toolkit), patch(
+        'ckanext.twitter.lib.parsers.config_helpers.twitter_count_timeout',
+        MagicMock(return_value=0.1),
+    ), patch(
+        'ckanext.twitter.lib.parsers.config_helpers.twitter_count_workers',
+        MagicMock(return_value=2),
+    ):
+        start = time.monotonic()
+        counts = twitter_parsers.count_records(
+            {}, [{'id': rid} for rid in resource_ids]
+        )
+
+    # a single timeout covers all the resources, so the others are still counted
+    assert time.monotonic() - start < 0.5
+    assert counts == {
+        rid: 0 if rid == 'slow-resource' else 12 for rid in resource_ids
+    }
+
+
+@pytest.mark.usefixtures('uncached')
+def test_count_records_serially_stops_at_timeout():
+    mock_toolkit = MagicMock(get_action=MagicMock(return_value=slow_datastore_search))
+    with patch('ckanext.twitter.lib.parsers.toolkit', mock_toolkit), patch(
+        'ckanext.twitter.lib.parsers.config_helpers.twitter_count_timeout',
+        MagicMock(return_value=0.1),
+    ):
+        counts = twitter_parsers.count_records(
+            {}, [{'id': 'slow-resource'}, {'id': 'resource-1'}]
+        )
+
+    # the slow count can't be stopped, but nothing is started after the timeout
+    assert counts == {'slow-resource': 12, 'resource-1': 0}
+
+
+def test_count_records_sql_estimates_large_tables():
+    datastore_search_sql = MagicMock(
+        return_value={
+            'records': [
+                {'id': 'small-resource', 'total': 12},
+                {'id': 'large-resource', 'total': 1001},
+            ]
+        }
+    )
+    datastore_search = MagicMock(return_value={'total': 50000})
+    actions = {
+        'datastore_search_sql': datastore_search_sql,
+        'datastore_search': datastore_search,
+    }
+    mock_toolkit = MagicMock(get_action=MagicMock(side_effect=actions.get))
+    with patch('ckanext.twitter.lib.parsers.toolkit', mock_toolkit), patch(
+        'ckanext.twitter.lib.parsers.config_helpers.twitter_count_sql',
+        MagicMock(return_value=True),
+    ), patch(
+        'ckanext.twitter.lib.parsers.config_helpers.twitter_count_estimate_threshold',
+        MagicMock(return_value=1000),
+    ):
+        counts = twitter_parsers.count_records(
+            {}, [{'id': 'small-resource'}, {'id': 'large-resource'}]
+        )
+
+    assert counts == {'small-resource': 12, 'large-resource': 50000}
+    # the query stops counting once a table is over the threshold
+    assert 'LIMIT 1001' in datastore_search_sql.call_args[0][1]['sql']
+    # only the large table is estimated
+    datastore_search.assert_called_once()
+    assert datastore_search.call_args[0][1]['resource_id'] == 'large-resource'
+    assert datastore_search.call_args[0][1]['total_estimation_threshold'] == 1000
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from ckanext.twitter.lib import dedupe
+
+
+def test_key_depends_on_text_and_package():
+    key = dedupe.dedupe_key('some text', 'pkg-1')
+    assert key == dedupe.dedupe_key('some text', 'pkg-1')
+    assert key != dedupe.dedupe_key('some other text', 'pkg-1')
+    assert key != dedupe.dedupe_key('some text', 'pkg-2')
+
+
+def test_duplicate_gets_result_of_first_request(expiring_store):
+    key = dedupe.dedupe_key('some text', 'pkg-1')
+    expiring_store.set(key, {'success': True}, 5)
+    function = MagicMock()
+    assert dedupe.run('some text', 'pkg-1', function, expiring_store) == {
+        'success': True
+    }
+    assert not function.called
+
+
+def test_duplicate_in_progress_returns_straight_away(expiring_store):
+    key = dedupe.dedupe_key('some text', 'pkg-1')
+    expiring_store.add(key, dedupe.pending, 5)
+    function = MagicMock()
+    start = time.monotonic()
+    assert dedupe.run('some text', 'pkg-1', function, expiring_store) is None
+    # the duplicate doesn't wait for the first request to finish
+    assert time.monotonic() - start < 1
+    assert not function.called
+
+
+def test_concurrent_duplicates_post_once(expiring_store):
+    started = threading.Event()
+    finish = threading.Event()
+
+    def post():
+        started.set()
+        finish.wait(5)
+        return {'success': True, 'reason': '200 OK', 'tweet': 'some text'}
+
+    function = MagicMock(side_effect=post)
+    results = []
+    first = threading.Thread(
+        target=lambda: results.append(
+            dedupe.run('some text', 'pkg-1', function, expiring_store)
+        )
+    )
+    first.start()
+    started.wait()
+    # the first request is still posting
+    assert dedupe.run('some text', 'pkg-1', function, expiring_store) is None
+    finish.set()
+    first.join()
+    # now it has finished, duplicates get its result
+    assert dedupe.run('some text', 'pkg-1', function, expiring_store) == results[0]
+
+    assert function.call_count == 1
+    assert results[0]['success']
+
+
+def test_successful_result_is_reused(expiring_store):
+    function = MagicMock(return_value={'success': True, 'reason': '200 OK'})
+    assert dedupe.run('some text', 'pkg-1', function, expiring_store)['success']
+    assert dedupe.run('some text', 'pkg-1', function, expiring_store)['success']
+    assert function.call_count == 1
+    # a different tweet is still posted
+    dedupe.run('some other text', 'pkg-1', function, expiring_store)
+    assert function.call_count == 2
+
+
+def test_failed_post_can_be_retried(expiring_store, monkeypatch):
+    monkeypatch.setattr(dedupe, 'failure_ttl', 0.1)
+    function = MagicMock(return_value={'success': False, 'reason': 'connection error'})
+    dedupe.run('some text', 'pkg-1', function, expiring_store)
+    time.sleep(0.2)
+    dedupe.run('some text', 'pkg-1', function, expiring_store)
+    assert function.call_count == 2
+
+
+def test_exception_releases_claim(expiring_store):
+    function = MagicMock(side_effect=[Exception('oops'), {'success': True}])
+    with pytest.raises(Exception):
+        dedupe.run('some text', 'pkg-1', function, expiring_store)
+    result = dedupe.run('some text', 'pkg-1', function, expiring_store)
+    assert result == {'success': True}
+
+
+def test_no_store_always_calls_function(monkeypatch):
+    monkeypatch.setattr(dedupe, 'get_store', MagicMock(return_value=None))
+    function = MagicMock(return_value={'success': True})
+    dedupe.run('some text', 'pkg-1', function)
+    dedupe.run('some text', 'pkg-1', function)
+    assert function.call_count == 2
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+from unittest.mock import patch, MagicMock
+
+import pytest
+from ckan.lib.redis import connect_to_redis
+from ckan.tests import factories
+
+from ckanext.twitter.lib import digest
+
+
+@pytest.fixture
+def redis():
+    connection = connect_to_redis()
+    connection.delete(digest.events_key, digest.started_key)
+    yield connection
+    connection.delete(digest.events_key, digest.started_key)
+
+
+def test_record_and_drain(redis):
+    assert not digest.due(redis)
+    for i in range(3):
+        digest.record({'id': f'package-{i}', 'owner_org': 'some-org-id'}, redis)
+
+    events = digest.drain(redis)
+    assert [e['id'] for e in events] == ['package-0', 'package-1', 'package-2']
+    assert digest.drain(redis) == []
+
+
+@pytest.mark.ckan_config('ckanext.twitter.digest_window', 0)
+def test_due(redis):
+    assert not digest.due(redis)
+    digest.record({'id': 'package-1', 'owner_org': 'some-org-id'}, redis)
+    assert digest.due(redis)
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.usefixtures('clean_db')
+def test_summarise():
+    botany = factories.Organization(title='Botany')
+    zoology = factories.Organization(title='Zoology')
+    events = [{'id': f'package-{i}', 'owner_org': botany['id']} for i in range(42)]
+    # the same dataset updated twice only counts once
+    events.append({'id': 'package-0', 'owner_org': botany['id']})
+    events.append({'id': 'package-42', 'owner_org': zoology['id']})
+
+    assert digest.summarise(events) == [
+        '42 datasets updated in Botany.',
+        '1 dataset updated in Zoology.',
+    ]
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.ckan_config('ckan.plugins', 'twitter')
+@pytest.mark.ckan_config('ckanext.twitter.digest', True)
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+def test_non_interactive_updates_are_collected(redis):
+    mock_enqueue_flush = MagicMock()
+    with patch('ckanext.twitter.plugin.digest.enqueue_flush', mock_enqueue_flush):
+        package = factories.Dataset()
+        # adding a resource updates the package outside of a request, so this looks
+        # like a harvester or CLI update
+        factories.Resource(package_id=package['id'])
+
+    events = digest.drain(redis)
+    assert [e['id'] for e in events] == [package['id']]
+    # the digest is posted by a job once the window has passed, not during the update
+    assert mock_enqueue_flush.call_count == 1
+
+
+def test_record_only_starts_one_window(redis):
+    started = digest.record({'id': 'package-1', 'owner_org': None}, redis)
+    assert started is not None
+    assert digest.record({'id': 'package-2', 'owner_org': None}, redis) is None
+    digest.drain(redis)
+    assert digest.record({'id': 'package-3', 'owner_org': None}, redis) is not None
+
+
+def test_flush_job_ignores_flushed_window(redis):
+    started = digest.record({'id': 'package-1', 'owner_org': None}, redis)
+    # the window is flushed from the CLI and another one started
+    digest.drain(redis)
+    digest.record({'id': 'package-2', 'owner_org': None}, redis)
+
+    mock_post_tweet = MagicMock(return_value=(True, '200 OK'))
+    with patch('ckanext.twitter.lib.digest.twitter_api.post_tweet', mock_post_tweet):
+        assert digest.flush_job(started) == []
+    assert not mock_post_tweet.called
+    assert [e['id'] for e in digest.drain(redis)] == ['package-2']
+
+
+@pytest.mark.ckan_config('debug', False)
+@pytest.mark.ckan_config('ckanext.twitter.debug', False)
+def test_flush_posts_digest(redis):
+    digest.record({'id': 'package-1', 'owner_org': None}, redis)
+
+    mock_post_tweet = MagicMock(return_value=(True, '200 OK'))
+    with patch('ckanext.twitter.lib.digest.twitter_api.post_tweet', mock_post_tweet):
+        results = digest.flush(redis)
+
+    assert results == [('1 dataset updated in no organisation.', True, '200 OK')]
+    # digests aren't about a single package
+    assert mock_post_tweet.call_args[0][1] is None
+
+
+@pytest.mark.ckan_config('debug', False)
+@pytest.mark.ckan_config('ckanext.twitter.debug', False)
+@pytest.mark.ckan_config('ckanext.twitter.async', True)
+def test_flush_job_posts_even_if_async(redis):
+    started = digest.record({'id': 'package-1', 'owner_org': None}, redis)
+
+    mock_post_tweet = MagicMock(return_value=(True, '200 OK'))
+    with patch('ckanext.twitter.lib.digest.twitter_api.post_tweet', mock_post_tweet):
+        results = digest.flush_job(started)
+
+    assert results == [('1 dataset updated in no organisation.', True, '200 OK')]
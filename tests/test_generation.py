@@ -8,8 +8,9 @@ from unittest.mock import patch, MagicMock
 import pytest
 from ckan.tests import factories
 from ckan.tests.helpers import call_action
+from jinja2.exceptions import SecurityError
 
-from ckanext.twitter.lib import parsers as twitter_parsers, twitter_api
+from ckanext.twitter.lib import parsers as twitter_parsers, tweet_length, twitter_api
 
 
 @pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
@@ -118,6 +119,7 @@ class TestTweetGeneration(object):
         correct_tweet_text = f'New dataset: "{title}" by Author et al. (0 resource).'
         assert tweet_text == correct_tweet_text
 
+    @pytest.mark.ckan_config('ckanext.twitter.tweet_limit', 140)
     def test_shortens_title(self):
         title = 'A package title that is pretty long but not ridiculously long, woo!'
         author = 'Captain Author'
@@ -128,6 +130,7 @@ class TestTweetGeneration(object):
         correct_tweet_text = f'New dataset: "{title[:43]}[...]" by Author (0 resource).'
         assert tweet_text == correct_tweet_text
 
+    @pytest.mark.ckan_config('ckanext.twitter.tweet_limit', 140)
     def test_does_not_exceed_140_chars(self):
         title = 'A package title that is pretty long but not ridiculously long, woo!'
         author = '; '.join(f'Captain Author{i}' for i in range(40))
@@ -167,3 +170,158 @@ class TestTweetGeneration(object):
 
         assert not tweeted
         assert reason == 'not authenticated'
+
+
+def test_compiled_templates_are_reused():
+    format_string = '{{ title }} / {{ author }} / {{ records }}'
+    compiled = twitter_parsers.compile_template(format_string)
+
+    assert twitter_parsers.compile_template(format_string) is compiled
+    assert compiled.tokens == ['title', 'author', 'records']
+    assert compiled.static_length == len(' /  / ')
+
+
+@pytest.mark.ckan_config('ckanext.twitter.new', '{{ title }}!')
+@pytest.mark.ckan_config('ckanext.twitter.sandbox', True)
+def test_sandboxed_template():
+    compiled = twitter_parsers.get_template(is_new=True)
+    assert compiled.template.render(title='A title') == 'A title!'
+
+    with pytest.raises(SecurityError):
+        twitter_parsers.compile_template('{{ "".__class__.__mro__ }}', sandboxed=True)
+
+
+def test_truncate_field_keeps_whole_words():
+    value = 'A package title that is pretty long'
+    assert twitter_parsers.truncate_field(value, 20) == 'A package[...]'
+    assert twitter_parsers.truncate_field('Apackagetitle', 10) == 'Apack[...]'
+
+
+def test_truncate_long_author_list():
+    author = '; '.join(f'Captain Author{i}' for i in range(10000))
+    assert twitter_parsers.truncate_author(author) == 'Author0 et al.'
+
+
+def test_truncate_author_without_forename():
+    assert twitter_parsers.truncate_author('Author; Author2') == 'Author et al.'
+
+
+def test_bulk_truncation():
+    assert twitter_parsers.truncate_authors(
+        ['Captain Author', 'Captain Author; Captain Author2', 'Captain Author']
+    ) == ['Author', 'Author et al.', 'Author']
+    assert twitter_parsers.truncate_fields(
+        ['short', 'A package title that is pretty long'], 20
+    ) == ['short', 'A package[...]']
+
+
+def test_template_variables_include_conditions():
+    compiled = twitter_parsers.compile_template(
+        '{{ title }}{{ " (with records)" if records }}'
+    )
+    assert compiled.tokens == ['title']
+    assert compiled.variables == {'title', 'records'}
+
+
+def test_records_only_counted_when_used():
+    pkg_dict = {
+        'id': 'pkg-id',
+        'title': 'A package title',
+        'author': 'Captain Author',
+        'resources': [{'id': 'resource-id'}],
+        'tags': [],
+    }
+    compiled = twitter_parsers.compile_template('{{ title }} by {{ author }}')
+
+    mock_get_number_records = MagicMock(return_value=10)
+    with patch(
+        'ckanext.twitter.lib.parsers.get_number_records', mock_get_number_records
+    ):
+        simplified = twitter_parsers.extract_info(
+            {}, pkg_dict, compiled.static_length, compiled.tokens, compiled.variables
+        )
+
+    assert not mock_get_number_records.called
+    assert simplified == {'title': 'A package title', 'author': 'Author'}
+
+
+@pytest.mark.parametrize(
+    'text,length',
+    [
+        ('A package title', 15),
+        ('Café “Zoë”', 10),
+        ('日本語', 6),
+        ('🦕🦖', 4),
+        ('See https://data.nhm.ac.uk/dataset/a-very-long-dataset-name', 27),
+    ],
+)
+def test_weighted_length(text, length):
+    assert tweet_length.weighted_length(text) == length
+
+
+def test_truncate_tweet_uses_weighted_length():
+    text = '日本語' * 100
+    truncated = twitter_parsers.truncate_tweet(text)
+    # twitter's limit of 280 allows 140 CJK characters
+    assert len(truncated) == 140
+    assert tweet_length.weighted_length(truncated) == 280
+
+
+def test_truncate_tweet_does_not_split_urls():
+    text = 'a' * 270 + ' https://data.nhm.ac.uk'
+    assert twitter_parsers.truncate_tweet(text) == 'a' * 270 + ' '
+
+
+def test_truncate_field_uses_weighted_length():
+    truncated = twitter_parsers.truncate_field('日本語の データセット', 16)
+    assert truncated == '日本語の[...]'
+    assert tweet_length.weighted_length(truncated) <= 16
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.ckan_config('ckan.plugins', 'datastore')
+@pytest.mark.usefixtures(
+    'clean_db', 'clean_datastore', 'with_plugins', 'with_request_context'
+)
+def test_generate_tweets():
+    packages = [
+        factories.Dataset(title=f'Package {i}', author='Captain Author')
+        for i in range(3)
+    ]
+    resource = factories.Resource(package_id=packages[0]['id'], url_type='datastore')
+    records = [{'x': i} for i in range(10)]
+    call_action('datastore_create', resource_id=resource['id'], records=records)
+    pkg_ids = [p['id'] for p in packages] + ['not-a-real-id']
+
+    mock_search = MagicMock(wraps=twitter_parsers._search_packages)
+    with patch('ckanext.twitter.lib.parsers._search_packages', mock_search):
+        tweets = list(twitter_parsers.generate_tweets({}, pkg_ids, chunk_size=2))
+
+    # one search for each chunk
+    assert mock_search.call_count == 2
+    assert tweets == [
+        (pkg_ids[0], 'Updated dataset: "Package 0" by Author (10 records).'),
+        (pkg_ids[1], 'Updated dataset: "Package 1" by Author (0 resources).'),
+        (pkg_ids[2], 'Updated dataset: "Package 2" by Author (0 resources).'),
+        ('not-a-real-id', None),
+    ]
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.ckan_config('ckan.plugins', 'datastore')
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'with_request_context')
+def test_generate_tweets_includes_drafts():
+    sysadmin = factories.Sysadmin()
+    draft = factories.Dataset(
+        title='Draft package', author='Captain Author', state='draft'
+    )
+    private = factories.Dataset(owner_org=factories.Organization()['id'], private=True)
+    context = {'user': sysadmin['name']}
+
+    tweets = list(twitter_parsers.generate_tweets(context, [draft['id'], private['id']]))
+
+    assert tweets == [
+        (draft['id'], 'Updated dataset: "Draft package" by Author (0 resources).'),
+        # private packages are found, but not tweeted about
+        (private['id'], None),
+    ]
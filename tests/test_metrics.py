@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+import logging
+import socket
+
+import pytest
+from ckan.tests import factories
+
+from ckanext.twitter.lib import metrics, parsers as twitter_parsers, twitter_api
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    yield
+    # metrics are off by default
+    metrics.set_sink(None)
+
+
+@pytest.fixture
+def sink():
+    memory_sink = metrics.MemorySink()
+    metrics.set_sink(memory_sink)
+    return memory_sink
+
+
+@pytest.mark.ckan_config('ckanext.twitter.debug', True)
+def test_post_outcomes_are_counted(sink):
+    twitter_api.post_tweet('This is a test tweet.', 'pkg-id')
+    twitter_api.post_tweet('This is a test tweet.', 'pkg-id')
+
+    assert sink.counts['post.debug'] == 2
+    assert len(sink.timings['post_tweet']) == 2
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.usefixtures('clean_db', 'with_request_context')
+def test_generation_is_timed_and_counted(sink):
+    package = factories.Dataset()
+
+    twitter_parsers.generate_tweet({}, package['id'], is_new=True)
+
+    assert len(sink.timings['generate_tweet']) == 1
+    assert sink.counts['actions.package_show'] == 1
+    assert sink.counts['package_cache.miss'] == 1
+
+
+def test_statsd_sink():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(5)
+    try:
+        statsd = metrics.StatsdSink(*server.getsockname(), prefix='twitter')
+        statsd.count('post.200_ok', 1)
+        statsd.timing('post_tweet', 12.5)
+
+        assert server.recv(1024) == b'twitter.post.200_ok:1|c'
+        assert server.recv(1024) == b'twitter.post_tweet:12.500|ms'
+    finally:
+        server.close()
+
+
+def test_incomplete_sink_cannot_be_created():
+    class CountingSink(metrics.Sink):
+        def count(self, name, value):
+            pass
+
+    with pytest.raises(TypeError):
+        CountingSink()
+
+
+@pytest.mark.ckan_config('ckanext.twitter.metrics', 'memory')
+@pytest.mark.ckan_config('ckanext.twitter.metrics_summary', True)
+@pytest.mark.ckan_config('ckanext.twitter.debug', True)
+@pytest.mark.ckan_config('ckan.plugins', 'twitter')
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+def test_request_summary(app, caplog):
+    url = '/dataset/some-package-id/tweet'
+    with caplog.at_level(logging.INFO, logger='ckanext.twitter'):
+        app.post(url, data={'tweet_text': 'This is a test tweet.'})
+
+    summaries = [r.message for r in caplog.records if 'POST /dataset/' in r.message]
+    assert len(summaries) == 1
+    assert 'post.debug=1' in summaries[0]
+    assert 'post_tweet=' in summaries[0]
+
+
+def test_metric_name():
+    assert metrics.metric_name('200 OK') == '200_ok'
+    assert metrics.metric_name('insufficient rest period') == 'insufficient_rest_period'
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+import time
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+from ckanext.twitter.lib import prompts, stores
+from ckanext.twitter.lib.helpers import TwitterJSHelpers
+
+
+@pytest.fixture
+def store(expiring_store):
+    return prompts.PromptStore(expiring_store, 600)
+
+
+def test_prompt_is_only_shown_once(store):
+    store.add('some-user', 'pkg-1')
+    assert store.pop('some-user', 'pkg-1')
+    assert not store.pop('some-user', 'pkg-1')
+
+
+def test_prompts_are_per_user_and_package(store):
+    store.add('some-user', 'pkg-1')
+    assert not store.pop('another-user', 'pkg-1')
+    assert not store.pop('some-user', 'pkg-2')
+    assert store.pop('some-user', 'pkg-1')
+
+
+def test_remove(store):
+    store.add('some-user', 'pkg-1')
+    store.remove('some-user', 'pkg-1')
+    assert not store.pop('some-user', 'pkg-1')
+
+
+def test_prompts_expire(store):
+    store.ttl = 0.1
+    store.add('some-user', 'pkg-1')
+    time.sleep(0.2)
+    assert not store.pop('some-user', 'pkg-1')
+
+
+def test_tweet_ready_does_not_use_session():
+    store = prompts.PromptStore(stores.MemoryExpiringStore(), 600)
+    store.add('some-user', 'pkg-1')
+    mock_session = MagicMock()
+    with patch('ckanext.twitter.lib.helpers.session', mock_session), patch(
+        'ckanext.twitter.lib.prompts.get_store', return_value=store
+    ), patch('ckanext.twitter.lib.prompts.current_user', return_value='some-user'):
+        assert TwitterJSHelpers().tweet_ready('pkg-1')
+        assert not TwitterJSHelpers().tweet_ready('pkg-1')
+    assert not mock_session.mock_calls
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of ckanext-twitter
+# Created by the Natural History Museum in London, UK
+
+from unittest.mock import patch, MagicMock
+
+import pytest
+from ckan.lib.redis import connect_to_redis
+
+from ckanext.twitter.lib import scheduler, twitter_api
+
+
+@pytest.fixture
+def redis():
+    # the rate limit and held posts are reset by the rate_limit fixture in conftest
+    return connect_to_redis()
+
+
+def rate_limit_headers(limit, remaining, reset):
+    return {
+        'x-rate-limit-limit': str(limit),
+        'x-rate-limit-remaining': str(remaining),
+        'x-rate-limit-reset': str(reset),
+    }
+
+
+def test_unknown_limit_allows_posts(redis):
+    rate_limit = scheduler.RateLimit(redis)
+    assert all(rate_limit.acquire() for _ in range(100))
+    assert rate_limit.wait_time() == 0
+
+
+def test_tokens_come_from_headers(redis):
+    rate_limit = scheduler.RateLimit(redis)
+    rate_limit.update(rate_limit_headers(300, 2, 1000), 200, now=100)
+
+    assert rate_limit.acquire(now=100)
+    assert rate_limit.acquire(now=100)
+    assert not rate_limit.acquire(now=100)
+    assert rate_limit.wait_time(now=100) == 900
+
+
+@pytest.mark.ckan_config('ckanext.twitter.rate_limit_window', 15)
+def test_bucket_refills_when_window_resets(redis):
+    rate_limit = scheduler.RateLimit(redis)
+    rate_limit.update(rate_limit_headers(300, 0, 1000), 200, now=100)
+
+    assert not rate_limit.acquire(now=999)
+    assert rate_limit.acquire(now=1000)
+    state = rate_limit.state()
+    assert state['remaining'] == 299
+    # the refilled bucket lasts for a window, until a response says otherwise
+    assert state['reset'] == 1900
+
+
+@pytest.mark.ckan_config('ckanext.twitter.rate_limit_window', 15)
+def test_too_many_requests_empties_bucket(redis):
+    rate_limit = scheduler.RateLimit(redis)
+    rate_limit.update({}, 429, now=100)
+
+    assert not rate_limit.acquire(now=100)
+    assert rate_limit.wait_time(now=100) == 900
+
+
+def test_limit_is_shared(redis):
+    # e.g. a web process and a job worker
+    scheduler.RateLimit(redis).update(rate_limit_headers(300, 1, 2e9), 200)
+    other = scheduler.RateLimit(redis)
+
+    assert other.acquire()
+    assert not scheduler.RateLimit(redis).acquire()
+    assert other.wait_time() > 0
+
+
+def test_held_posts_are_ordered_by_priority(redis):
+    scheduler.hold('backfill', 'pkg-1', scheduler.BACKFILL, redis)
+    scheduler.hold('digest', None, scheduler.DIGEST, redis)
+    scheduler.hold('interactive 1', 'pkg-2', scheduler.INTERACTIVE, redis)
+    scheduler.hold('interactive 2', 'pkg-3', scheduler.INTERACTIVE, redis)
+
+    assert [post['tweet'] for post in scheduler.held(redis)] == [
+        'interactive 1',
+        'interactive 2',
+        'digest',
+        'backfill',
+    ]
+
+
+def test_drain_stops_at_rate_limit(redis):
+    scheduler.hold('first', 'pkg-1', scheduler.INTERACTIVE, redis)
+    scheduler.hold('second', 'pkg-2', scheduler.BACKFILL, redis)
+    scheduler.hold('third', 'pkg-3', scheduler.BACKFILL, redis)
+
+    def post_tweet(tweet_text, pkg_id, priority):
+        # the first post uses up the last token
+        scheduler.rate_limit.update(rate_limit_headers(300, 0, 2e9), 200)
+        return True, '200 OK'
+
+    mock_post_tweet = MagicMock(side_effect=post_tweet)
+    with patch('ckanext.twitter.lib.twitter_api.post_tweet', mock_post_tweet):
+        results = scheduler.drain(redis)
+
+    assert results == [('first', True, '200 OK')]
+    assert [post['tweet'] for post in scheduler.held(redis)] == ['second', 'third']
+
+
+@pytest.mark.ckan_config('ckanext.twitter.async', True)
+def test_async_drain_only_queues_what_the_limit_allows(redis):
+    scheduler.rate_limit.update(rate_limit_headers(300, 2, 2e9), 200)
+    for text in ('first', 'second', 'third'):
+        scheduler.hold(text, None, scheduler.BACKFILL, redis)
+
+    mock_enqueue_tweet = MagicMock(return_value='some-job-id')
+    with patch('ckanext.twitter.lib.jobs.enqueue_tweet', mock_enqueue_tweet):
+        results = scheduler.drain(redis)
+
+    assert [text for text, _, _ in results] == ['first', 'second']
+    assert mock_enqueue_tweet.call_count == 2
+    assert [post['tweet'] for post in scheduler.held(redis)] == ['third']
+
+
+def test_available(redis):
+    assert scheduler.rate_limit.available() is None
+    scheduler.rate_limit.update(rate_limit_headers(300, 2, 1000), 200)
+    assert scheduler.rate_limit.available(now=900) == 2
+    # the bucket will have refilled
+    assert scheduler.rate_limit.available(now=1100) == 300
+
+
+@pytest.mark.ckan_config('debug', False)
+@pytest.mark.ckan_config('ckanext.twitter.debug', False)
+def test_post_tweet_holds_when_rate_limited(redis):
+    scheduler.rate_limit.update(rate_limit_headers(300, 0, 2e9), 200)
+    mock_client = MagicMock()
+    mock_cache_helpers = MagicMock(expired=MagicMock(return_value=True))
+    with patch(
+        'ckanext.twitter.lib.twitter_api.twitter_authenticate',
+        MagicMock(return_value=True),
+    ), patch(
+        'ckanext.twitter.lib.twitter_api.twitter_client',
+        MagicMock(return_value=mock_client),
+    ), patch(
+        'ckanext.twitter.lib.twitter_api.cache_helpers', mock_cache_helpers
+    ):
+        posted, reason = twitter_api.post_tweet('This is a test tweet.', 'pkg-id')
+
+    assert not posted
+    assert reason == scheduler.HELD
+    # no request was wasted and the package wasn't claimed
+    assert not mock_client.request.called
+    assert not mock_cache_helpers.claim.called
+    assert [post['tweet'] for post in scheduler.held(redis)] == [
+        'This is a test tweet.'
+    ]
+
+
+@pytest.mark.ckan_config('debug', False)
+@pytest.mark.ckan_config('ckanext.twitter.debug', False)
+def test_post_tweet_holds_on_too_many_requests(redis):
+    mock_response = MagicMock(
+        status=429, reason='Too Many Requests', headers=rate_limit_headers(300, 0, 2e9)
+    )
+    mock_client = MagicMock(request=MagicMock(return_value=(mock_response, b'')))
+    mock_cache_helpers = MagicMock(expired=MagicMock(return_value=True))
+    with patch(
+        'ckanext.twitter.lib.twitter_api.twitter_authenticate',
+        MagicMock(return_value=True),
+    ), patch(
+        'ckanext.twitter.lib.twitter_api.twitter_client',
+        MagicMock(return_value=mock_client),
+    ), patch(
+        'ckanext.twitter.lib.twitter_api.cache_helpers', mock_cache_helpers
+    ):
+        posted, reason = twitter_api.post_tweet(
+            'This is a test tweet.', 'pkg-id', scheduler.BACKFILL
+        )
+
+    assert not posted
+    assert reason == scheduler.HELD
+    mock_cache_helpers.remove_from_cache.assert_called_once_with('pkg-id')
+    assert scheduler.rate_limit.wait_time() > 0
+    assert scheduler.held(redis)[0]['priority'] == scheduler.BACKFILL
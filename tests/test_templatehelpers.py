@@ -10,7 +10,11 @@ from ckan.model import State
 from ckan.tests import factories
 from ckan.tests.helpers import call_action
 
-from ckanext.twitter.lib.helpers import TwitterJSHelpers, twitter_pkg_suitable
+from ckanext.twitter.lib.helpers import (
+    TwitterJSHelpers,
+    is_interactive,
+    twitter_pkg_suitable,
+)
 
 
 @pytest.fixture
@@ -123,3 +127,57 @@ class TestGetConfigVariables(object):
 
         is_suitable = twitter_pkg_suitable({}, package['id'])
         assert is_suitable
+
+
+def test_is_new_only_requests_a_few_activities(js_helpers):
+    package_activity_list = MagicMock(return_value=[{}, {}, {}, {}])
+    mock_toolkit = MagicMock(get_action=MagicMock(return_value=package_activity_list))
+
+    with patch('ckanext.twitter.lib.helpers.toolkit', mock_toolkit):
+        assert not js_helpers._is_new('some-package-id')
+
+    data_dict = package_activity_list.call_args[0][1]
+    assert data_dict == {'id': 'some-package-id', 'limit': 4}
+
+
+def test_every_update_is_interactive_by_default(app):
+    assert is_interactive({})
+    with app.flask_app.test_request_context('/api/3/action/package_patch'):
+        assert is_interactive({})
+        assert not is_interactive({'skip_twitter': True})
+
+
+@pytest.mark.ckan_config('ckanext.twitter.skip_non_interactive', True)
+def test_not_interactive_outside_request():
+    assert not is_interactive({})
+
+
+@pytest.mark.ckan_config('ckanext.twitter.skip_non_interactive', True)
+@pytest.mark.usefixtures('with_request_context')
+def test_interactive_in_web_request():
+    assert is_interactive({})
+    assert not is_interactive({'skip_twitter': True})
+
+
+@pytest.mark.ckan_config('ckanext.twitter.skip_non_interactive', True)
+def test_not_interactive_in_api_request(app):
+    with app.flask_app.test_request_context('/api/3/action/package_patch'):
+        assert not is_interactive({})
+
+
+@pytest.mark.filterwarnings('ignore::sqlalchemy.exc.SADeprecationWarning')
+@pytest.mark.ckan_config('ckan.plugins', 'twitter')
+@pytest.mark.ckan_config('ckanext.twitter.skip_non_interactive', True)
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+def test_api_updates_skip_suitability_check(app):
+    package = factories.Dataset()
+    factories.Resource(package_id=package['id'])
+
+    mock_suitable = MagicMock(return_value=True)
+    with patch(
+        'ckanext.twitter.plugin.twitter_helpers.twitter_pkg_suitable', mock_suitable
+    ):
+        with app.flask_app.test_request_context('/api/3/action/package_patch'):
+            call_action('package_patch', id=package['id'], notes='API update')
+
+    assert not mock_suitable.called